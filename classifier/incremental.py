@@ -0,0 +1,351 @@
+"""
+前回の学習結果から始めて、前回以降にクローリングした記事だけで追加学習する仕組み。
+
+語彙を学習データから作る `CountVectorizer` では新しい単語を扱えないため、
+単語のハッシュ値を特徴のインデックスとする `HashingVectorizer` で特徴の空間を固定し、
+`SGDClassifier.partial_fit` で新しい記事の分だけモデルを更新する。
+
+直近の記事から作った評価用のデータ (rolling evaluation set) で毎回正解率を測り、
+全ての記事で学習し直したときの正解率から `drift_threshold` を超えて下がった場合は
+全ての記事で学習し直す
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import pathlib
+import random
+import time
+from dataclasses import asdict, dataclass, field
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from classifier.utils import create_tagger, iter_dataset, tokenize_text
+from crawler.manifest import ManifestQuery
+
+if TYPE_CHECKING:
+    from sklearn.feature_extraction.text import HashingVectorizer
+    from sklearn.linear_model import SGDClassifier
+    from sklearn.preprocessing import LabelEncoder
+
+MODEL_FILE_NAME = "model.joblib"
+LABEL_ENCODER_FILE_NAME = "label-encoder.joblib"
+VECTORIZER_FILE_NAME = "vectorizer.joblib"
+EVAL_SET_FILE_NAME = "eval-set.joblib"
+STATE_FILE_NAME = "state.json"
+
+
+@dataclass
+class IncrementalConfig(object):
+    """
+    追加学習の設定
+
+    - n_features: `HashingVectorizer` の特徴の数
+    - alpha: `SGDClassifier` の正則化の強さ
+    - epochs: 学習データを何周するか
+    - eval_ratio: 新しい記事のうち評価用のデータに回す割合
+    - eval_size: 評価用のデータの件数の上限。超えた分は古いものから捨てる
+    - drift_threshold: 正解率がこの値を超えて下がったら全ての記事で学習し直す
+    - pos_filter: 残す品詞。None の場合は全ての品詞を残す
+    - stop_words: 除外する単語のリスト
+    - num_load_workers: 記事のファイルを読み込む際に使うスレッドの数
+    """
+
+    n_features: int = 2**18
+    alpha: float = 1e-5
+    epochs: int = 5
+    eval_ratio: float = 0.2
+    eval_size: int = 2000
+    drift_threshold: float = 0.05
+    pos_filter: Optional[Tuple[str, ...]] = None
+    stop_words: Optional[List[str]] = None
+    num_load_workers: int = 8
+
+
+@dataclass
+class IncrementalState(object):
+    """
+    - snapshot_at: 学習に使った記事のクローリングした時刻の上限 (UNIX 時間)。
+      次回はこれ以降にクローリングした記事だけを使う
+    - num_trained: これまでに学習に使った記事の数
+    - baseline_accuracy: 最後に全ての記事で学習し直したときの評価用のデータでの正解率
+    - history: 各回の学習の記録
+    """
+
+    snapshot_at: float
+    num_trained: int
+    baseline_accuracy: float
+    history: List[Dict[str, Any]] = field(default_factory=list)
+
+
+@dataclass
+class IncrementalBundle(object):
+    model: SGDClassifier
+    label_encoder: LabelEncoder
+    vectorizer: HashingVectorizer
+    # (分かち書きした本文, カテゴリ) のリスト。古いものから順に並ぶ
+    eval_set: List[Tuple[str, str]]
+    state: IncrementalState
+
+
+def load_tokenized_dataset(
+    dataset_dir: pathlib.Path, query: ManifestQuery, config: IncrementalConfig
+) -> List[Tuple[str, str]]:
+    tagger = create_tagger(config.pos_filter)
+    return [
+        (tokenize_text(tagger, text, config.pos_filter), category)
+        for text, category in iter_dataset(
+            dataset_dir, num_workers=config.num_load_workers, query=query
+        )
+    ]
+
+
+def split_eval_set(
+    dataset: List[Tuple[str, str]], eval_ratio: float, seed: int
+) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+    dataset = list(dataset)
+    random.Random(seed).shuffle(dataset)
+    num_eval = int(len(dataset) * eval_ratio)
+    return dataset[num_eval:], dataset[:num_eval]
+
+
+def build_hashing_vectorizer(config: IncrementalConfig) -> HashingVectorizer:
+    from sklearn.feature_extraction.text import HashingVectorizer
+
+    vectorizer = HashingVectorizer(
+        n_features=config.n_features,
+        alternate_sign=False,
+        stop_words=config.stop_words,
+    )
+    # 推論時にも学習時と同じ品詞フィルタでトークナイズできるよう vectorizer に持たせておく
+    vectorizer.pos_filter_ = config.pos_filter
+    return vectorizer
+
+
+def find_vectorizer_changes(
+    vectorizer: HashingVectorizer, config: IncrementalConfig
+) -> List[str]:
+    """
+    前回のモデルの vectorizer と `config` で、特徴の作り方が異なる設定の名前を返す。
+    異なる設定のまま追加学習すると、前回までと異なる特徴でモデルを更新してしまう
+    """
+    saved_pos_filter = getattr(vectorizer, "pos_filter_", None)
+    changes = []
+    if vectorizer.n_features != config.n_features:
+        changes.append("n_features")
+    if list(vectorizer.stop_words or []) != list(config.stop_words or []):
+        changes.append("stop_words")
+    if (tuple(saved_pos_filter) if saved_pos_filter is not None else None) != (
+        tuple(config.pos_filter) if config.pos_filter is not None else None
+    ):
+        changes.append("pos_filter")
+    return changes
+
+
+def fit_partially(
+    bundle: IncrementalBundle,
+    dataset: List[Tuple[str, str]],
+    epochs: int,
+    seed: int,
+) -> None:
+    import numpy as np
+
+    X = bundle.vectorizer.transform([text for text, _ in dataset])
+    y = bundle.label_encoder.transform([category for _, category in dataset])
+    classes = np.arange(len(bundle.label_encoder.classes_))
+
+    rng = np.random.default_rng(seed)
+    for _ in range(epochs):
+        permutation = rng.permutation(len(y))
+        bundle.model.partial_fit(X[permutation], y[permutation], classes=classes)
+
+
+def evaluate(bundle: IncrementalBundle, dataset: List[Tuple[str, str]]) -> float:
+    if len(dataset) == 0:
+        return float("nan")
+
+    X = bundle.vectorizer.transform([text for text, _ in dataset])
+    y = bundle.label_encoder.transform([category for _, category in dataset])
+    return float(bundle.model.score(X, y))
+
+
+def train_from_scratch(
+    dataset_dir: pathlib.Path,
+    config: IncrementalConfig,
+    history: Optional[List[Dict[str, Any]]] = None,
+    seed: int = 19950815,
+) -> IncrementalBundle:
+    """
+    `snapshot_at` (現在時刻) までにクローリングした全ての記事で学習する。
+    `history` には前回までの学習の記録を渡す
+    """
+    from sklearn.linear_model import SGDClassifier
+    from sklearn.preprocessing import LabelEncoder
+
+    snapshot_at = time.time()
+    dataset = load_tokenized_dataset(
+        dataset_dir, ManifestQuery(crawled_before=snapshot_at), config
+    )
+    train_dataset, eval_set = split_eval_set(dataset, config.eval_ratio, seed)
+    eval_set = eval_set[-config.eval_size :]
+
+    bundle = IncrementalBundle(
+        model=SGDClassifier(loss="log_loss", alpha=config.alpha, random_state=seed),
+        label_encoder=LabelEncoder().fit([category for _, category in dataset]),
+        vectorizer=build_hashing_vectorizer(config),
+        eval_set=eval_set,
+        state=IncrementalState(
+            snapshot_at=snapshot_at,
+            num_trained=0,
+            baseline_accuracy=0.0,
+            history=list(history or []),
+        ),
+    )
+    fit_partially(bundle, train_dataset, epochs=config.epochs, seed=seed)
+
+    accuracy = evaluate(bundle, eval_set)
+    bundle.state.num_trained = len(train_dataset)
+    bundle.state.baseline_accuracy = accuracy
+    bundle.state.history.append(
+        dict(
+            mode="full",
+            snapshot_at=snapshot_at,
+            num_articles=len(train_dataset),
+            accuracy=accuracy,
+        )
+    )
+    print(
+        f"全ての記事で学習しました (学習: {len(train_dataset)} 件, "
+        f"評価: {len(eval_set)} 件, 正解率: {accuracy:.4f})"
+    )
+    return bundle
+
+
+def train_incrementally(
+    bundle: IncrementalBundle,
+    dataset_dir: pathlib.Path,
+    config: IncrementalConfig,
+    seed: int = 19950815,
+) -> Optional[str]:
+    """
+    前回の `snapshot_at` 以降にクローリングした記事だけで `bundle` を更新する。
+    全ての記事で学習し直す必要がある場合はその理由を返す
+    """
+    changes = find_vectorizer_changes(bundle.vectorizer, config)
+    if changes:
+        return f"特徴の作り方の設定 {changes} が前回の学習と異なります"
+    # 前回の全ての記事での学習時に評価用のデータが無かった場合は、正解率の低下を検知できない
+    if math.isnan(bundle.state.baseline_accuracy):
+        return "基準の正解率がありません"
+
+    snapshot_at = time.time()
+    dataset = load_tokenized_dataset(
+        dataset_dir,
+        ManifestQuery(
+            crawled_after=bundle.state.snapshot_at, crawled_before=snapshot_at
+        ),
+        config,
+    )
+    if len(dataset) == 0:
+        print("前回の学習以降にクローリングした記事はありません")
+        return None
+
+    # 新しいカテゴリの記事は `partial_fit` では学習できない
+    unknown_categories = {category for _, category in dataset} - set(
+        bundle.label_encoder.classes_
+    )
+    if unknown_categories:
+        return f"新しいカテゴリ {sorted(unknown_categories)} の記事があります"
+
+    train_dataset, new_eval_set = split_eval_set(dataset, config.eval_ratio, seed)
+    # 更新前のモデルが新しい記事をどの程度正しく分類できるかは、データの変化の目安になる
+    accuracy_before = evaluate(bundle, new_eval_set)
+
+    fit_partially(bundle, train_dataset, epochs=config.epochs, seed=seed)
+
+    bundle.eval_set = (bundle.eval_set + new_eval_set)[-config.eval_size :]
+    accuracy = evaluate(bundle, bundle.eval_set)
+    print(
+        f"追加学習しました (学習: {len(train_dataset)} 件, "
+        f"新しい記事での更新前の正解率: {accuracy_before:.4f}, "
+        f"評価用のデータでの正解率: {accuracy:.4f}, "
+        f"基準の正解率: {bundle.state.baseline_accuracy:.4f})"
+    )
+
+    drift = bundle.state.baseline_accuracy - accuracy
+    if drift > config.drift_threshold:
+        return f"正解率が基準から {drift:.4f} 下がりました"
+
+    bundle.state.snapshot_at = snapshot_at
+    bundle.state.num_trained += len(train_dataset)
+    bundle.state.history.append(
+        dict(
+            mode="incremental",
+            snapshot_at=snapshot_at,
+            num_articles=len(train_dataset),
+            accuracy_before=accuracy_before,
+            accuracy=accuracy,
+        )
+    )
+    return None
+
+
+def load_bundle(bundle_dir: pathlib.Path) -> Optional[IncrementalBundle]:
+    import joblib
+
+    state_path = bundle_dir / STATE_FILE_NAME
+    if not state_path.exists():
+        return None
+
+    print(f"Load incremental model from {bundle_dir}")
+    with open(state_path, "r") as rf:
+        state = IncrementalState(**json.load(rf))
+
+    return IncrementalBundle(
+        model=joblib.load(bundle_dir / MODEL_FILE_NAME),
+        label_encoder=joblib.load(bundle_dir / LABEL_ENCODER_FILE_NAME),
+        vectorizer=joblib.load(bundle_dir / VECTORIZER_FILE_NAME),
+        eval_set=joblib.load(bundle_dir / EVAL_SET_FILE_NAME),
+        state=state,
+    )
+
+
+def save_bundle(bundle: IncrementalBundle, bundle_dir: pathlib.Path) -> None:
+    import joblib
+
+    bundle_dir.mkdir(parents=True, exist_ok=True)
+    joblib.dump(bundle.model, bundle_dir / MODEL_FILE_NAME)
+    joblib.dump(bundle.label_encoder, bundle_dir / LABEL_ENCODER_FILE_NAME)
+    joblib.dump(bundle.vectorizer, bundle_dir / VECTORIZER_FILE_NAME)
+    joblib.dump(bundle.eval_set, bundle_dir / EVAL_SET_FILE_NAME)
+
+    # 状態は最後に書き込み、モデルの書き込みが途中で失敗した場合に状態だけが先に進まないようにする
+    with open(bundle_dir / STATE_FILE_NAME, "w") as wf:
+        json.dump(asdict(bundle.state), wf, ensure_ascii=False, indent=4)
+    print(f"Save incremental model to {bundle_dir}")
+
+
+def update_model(
+    dataset_dir: pathlib.Path,
+    bundle_dir: pathlib.Path,
+    config: IncrementalConfig,
+    full: bool = False,
+) -> IncrementalBundle:
+    """
+    `bundle_dir` に保存した前回のモデルを新しい記事で更新する。
+    前回のモデルが無い場合や `full=True` の場合、正解率が大きく下がった場合は全ての記事で学習し直す
+    """
+    bundle = load_bundle(bundle_dir)
+
+    if bundle is None:
+        bundle = train_from_scratch(dataset_dir, config)
+    elif full:
+        bundle = train_from_scratch(dataset_dir, config, bundle.state.history)
+    else:
+        reason = train_incrementally(bundle, dataset_dir, config)
+        if reason is not None:
+            print(f"{reason}。全ての記事で学習し直します")
+            bundle = train_from_scratch(dataset_dir, config, bundle.state.history)
+
+    save_bundle(bundle, bundle_dir)
+    return bundle
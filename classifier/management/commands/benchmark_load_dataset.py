@@ -0,0 +1,204 @@
+import functools
+import json
+import os
+import pathlib
+import random
+import shutil
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from classifier.utils import (
+    iter_dataset,
+    iter_dataset_file_paths,
+    orjson,
+    parse_article_json,
+)
+
+
+def generate_synthetic_corpus(
+    corpus_dir: pathlib.Path,
+    num_files: int,
+    html_size: int,
+    content_size: int,
+    num_categories: int = 8,
+) -> None:
+    """
+    クローラが保存する記事と同じ形式の JSON ファイルを `num_files` 個作る
+    """
+    rng = random.Random(0)
+    html_chars = "abcdefghijklmnopqrstuvwxyz<>/=\\" "\n ニュース記事"
+    content_chars = "あいうえおかきくけこ日本語の記事本文。\n"
+
+    for i in range(num_categories):
+        (corpus_dir / f"category{i}").mkdir(parents=True, exist_ok=True)
+
+    # 全ての記事を別々に生成すると時間がかかるため、生成した文字列をずらして使い回す
+    html_base = "".join(rng.choice(html_chars) for _ in range(html_size * 2))
+    content_base = "".join(rng.choice(content_chars) for _ in range(content_size * 2))
+    for i in range(num_files):
+        offset = rng.randrange(html_size)
+        article: Dict[str, Any] = {
+            "html": html_base[offset : offset + html_size],
+            "title": f"記事 {i}",
+            "content": content_base[offset % content_size :][:content_size],
+            "category": f"category{i % num_categories}",
+            "url": f"https://example.com/articles/{i}",
+            "html_hash": "",
+            "extractor_version": 1,
+        }
+        file_path = corpus_dir / article["category"] / f"{i:08d}.json"
+        with open(file_path, "w") as wf:
+            json.dump(article, wf, ensure_ascii=False, indent=4)
+
+
+def drop_page_cache(corpus_dir: pathlib.Path) -> None:
+    """
+    ページキャッシュから記事のファイルを追い出し、ディスクから読み込む状態にする。
+    書き込み済みのページのみ追い出せるため、事前に `os.sync` しておく
+    """
+    os.sync()
+    for article_file_path, _ in iter_dataset_file_paths(corpus_dir):
+        fd = os.open(article_file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def load_dataset_serially(corpus_dir: pathlib.Path) -> List[Tuple[str, str]]:
+    """
+    1 スレッドで 1 ファイルずつ全体を `json.load` する、従来の読み込み方
+    """
+    dataset = []
+    for article_file_path, category in iter_dataset_file_paths(corpus_dir):
+        with open(article_file_path, "r") as rf:
+            article_dict = json.load(rf)
+        dataset.append((article_dict["content"], category))
+    return dataset
+
+
+def load_dataset_with_full_parse(corpus_dir: pathlib.Path) -> List[Tuple[str, str]]:
+    """
+    1 スレッドで 1 ファイルずつ全体を parse する (orjson があれば orjson を使う)
+    """
+    dataset = []
+    for article_file_path, category in iter_dataset_file_paths(corpus_dir):
+        with open(article_file_path, "rb") as rf:
+            article_dict = parse_article_json(rf.read())
+        dataset.append((article_dict["content"], category))
+    return dataset
+
+
+def load_dataset_in_threads(
+    corpus_dir: pathlib.Path, num_workers: int
+) -> List[Tuple[str, str]]:
+    return list(iter_dataset(corpus_dir, num_workers))
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser: CommandParser) -> None:
+        """
+        `python manage.py benchmark_load_dataset` を実行するときのコマンドラインオプション
+        """
+        parser.add_argument(
+            "--corpus-dir",
+            type=pathlib.Path,
+            default=None,
+            help="合成したコーパスを保存するディレクトリのパスの情報。指定しない場合は一時ディレクトリに作り、終了時に削除する",
+        )
+        parser.add_argument(
+            "--num-files",
+            type=int,
+            default=100000,
+            help="合成するコーパスの記事の数",
+        )
+        parser.add_argument(
+            "--html-size",
+            type=int,
+            default=10000,
+            help="合成する記事の HTML の文字数",
+        )
+        parser.add_argument(
+            "--content-size",
+            type=int,
+            default=1500,
+            help="合成する記事の本文の文字数",
+        )
+        parser.add_argument(
+            "--num-workers",
+            type=int,
+            nargs="+",
+            default=[1, 4, 8, 16],
+            help="計測するスレッドの数",
+        )
+        parser.add_argument(
+            "--cold-cache",
+            action="store_true",
+            help="計測のたびにページキャッシュから記事のファイルを追い出す",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        """
+        `python manage.py benchmark_load_dataset` を実行したときに呼び出される関数
+        """
+        corpus_dir = options["corpus_dir"]
+        remove_corpus_dir = corpus_dir is None
+        if corpus_dir is None:
+            corpus_dir = pathlib.Path(tempfile.mkdtemp())
+
+        corpus_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            if not any(iter_dataset_file_paths(corpus_dir)):
+                start_time = time.perf_counter()
+                generate_synthetic_corpus(
+                    corpus_dir,
+                    num_files=options["num_files"],
+                    html_size=options["html_size"],
+                    content_size=options["content_size"],
+                )
+                print(
+                    f"Generate {options['num_files']} articles to {corpus_dir} "
+                    f"({time.perf_counter() - start_time:.1f} 秒)"
+                )
+
+            loaders: List[Tuple[str, Callable[[], List[Tuple[str, str]]]]] = [
+                ("json.load (1 スレッド)", lambda: load_dataset_serially(corpus_dir)),
+                (
+                    f"{'orjson' if orjson is not None else 'json'} で全体を parse (1 スレッド)",
+                    lambda: load_dataset_with_full_parse(corpus_dir),
+                ),
+            ]
+            for num_workers in options["num_workers"]:
+                loaders.append(
+                    (
+                        f"iter_dataset ({num_workers} スレッド)",
+                        functools.partial(
+                            load_dataset_in_threads, corpus_dir, num_workers
+                        ),
+                    )
+                )
+
+            expected = None
+            for name, loader in loaders:
+                if options["cold_cache"]:
+                    drop_page_cache(corpus_dir)
+
+                start_time = time.perf_counter()
+                dataset = loader()
+                elapsed_time = time.perf_counter() - start_time
+
+                # どの読み込み方でも同じ内容が得られることを確認する
+                if expected is None:
+                    expected = sorted(dataset)
+                assert sorted(dataset) == expected
+
+                print(
+                    f"{name:<40} {elapsed_time:>8.2f} 秒 "
+                    f"({len(dataset) / elapsed_time:>9.0f} 記事/秒)"
+                )
+        finally:
+            if remove_corpus_dir:
+                shutil.rmtree(corpus_dir)
@@ -0,0 +1,100 @@
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, List
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+
+
+@dataclass
+class ImportTime(object):
+    module: str
+    self_us: int
+    cumulative_us: int
+
+
+def measure_import_time(module: str) -> List[ImportTime]:
+    """
+    `python -X importtime` を用いて、新しいプロセスで `module` を import したときの
+    モジュールごとの読み込み時間を計測する
+    """
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=settings.BASE_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    import_times = []
+    for line in res.stderr.splitlines():
+        # import time:       123 |        456 |   package.module
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, module_name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            continue  # ヘッダ行は飛ばす
+
+        import_times.append(
+            ImportTime(
+                module=module_name.strip(),
+                self_us=int(self_us),
+                cumulative_us=int(cumulative_us),
+            )
+        )
+
+    return import_times
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser: CommandParser) -> None:
+        """
+        `python manage.py import_time` を実行するときのコマンドラインオプション
+        """
+        parser.add_argument(
+            "--modules",
+            type=str,
+            nargs="+",
+            default=[
+                "crawler.management.commands.crawl",
+                "classifier.management.commands.train_classifier",
+                "predictor.management.commands.predict",
+                "predictor.engine",
+            ],
+            help="読み込み時間を計測するモジュール",
+        )
+        parser.add_argument(
+            "--top",
+            type=int,
+            default=15,
+            help="読み込み時間の長い順に表示するモジュールの数",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        """
+        `python manage.py import_time` を実行したときに呼び出される関数
+        """
+        for module in options["modules"]:
+            start_time = time.perf_counter()
+            import_times = measure_import_time(module)
+            elapsed_time = time.perf_counter() - start_time
+
+            total_us = max(t.cumulative_us for t in import_times)
+            print(f"### {module}")
+            print(
+                f"import 時間: {total_us / 1000:.1f} ms "
+                f"(プロセスの起動を含む時間: {elapsed_time * 1000:.1f} ms)"
+            )
+
+            # 読み込み時間 (そのモジュールが import したモジュールも含む) の長い順に表示する
+            import_times = sorted(
+                import_times, key=lambda t: t.cumulative_us, reverse=True
+            )
+            print(f"{'cumulative [ms]':>16} {'self [ms]':>10}  module")
+            for t in import_times[: options["top"]]:
+                print(
+                    f"{t.cumulative_us / 1000:>16.1f} {t.self_us / 1000:>10.1f}  {t.module}"
+                )
+            print()
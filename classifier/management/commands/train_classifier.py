@@ -1,17 +1,38 @@
+import datetime
 import pathlib
-from typing import Any
+from typing import Any, Union
 
 from django.core.management.base import BaseCommand, CommandParser
 
 from classifier.utils import (
+    FeatureConfig,
     build_model,
     load_dataset,
-    preprocess_dataset,
+    load_stop_words,
+    report_model_footprint,
     save_model,
     split_dataset,
     test_model,
+    tokenize_dataset,
     train_model,
+    vectorize_dataset,
 )
+from crawler.manifest import ManifestQuery
+from newspaper_classifier.profiling import Profiler, add_profile_arguments
+
+
+def timestamp(value: str) -> float:
+    """
+    `2023-02-01` や `2023-02-01T12:00:00` のような ISO 形式の日時を UNIX 時間に変換する
+    """
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def document_frequency(value: str) -> Union[int, float]:
+    """
+    `CountVectorizer` の min_df / max_df と同様に、整数なら文書数、小数なら文書の割合として扱う
+    """
+    return float(value) if "." in value else int(value)
 
 
 class Command(BaseCommand):
@@ -52,34 +73,196 @@ class Command(BaseCommand):
             / "pretrained-model.joblib",
             help="学習済みの classifier を保存するパスの情報",
         )
+        parser.add_argument(
+            "--min-df",
+            type=document_frequency,
+            default=1,
+            help="語彙に含める単語の最小文書頻度 (整数なら文書数、小数なら割合)",
+        )
+        parser.add_argument(
+            "--max-df",
+            type=document_frequency,
+            default=1.0,
+            help="語彙に含める単語の最大文書頻度 (整数なら文書数、小数なら割合)",
+        )
+        parser.add_argument(
+            "--max-features",
+            type=int,
+            default=None,
+            help="出現頻度の高い順に語彙に含める単語の最大数",
+        )
+        parser.add_argument(
+            "--stop-words-path",
+            type=pathlib.Path,
+            default=None,
+            help="語彙から除外する単語を 1 行に 1 つずつ記載したファイルのパスの情報",
+        )
+        parser.add_argument(
+            "--pos-filter",
+            type=str,
+            nargs="+",
+            default=None,
+            help="語彙に残す品詞 (例: 名詞 動詞 形容詞)。指定しない場合は全ての品詞を残す",
+        )
+        parser.add_argument(
+            "--feature-selection",
+            type=str,
+            choices=["none", "chi2", "l1"],
+            default="none",
+            help="特徴選択の手法",
+        )
+        parser.add_argument(
+            "--num-features",
+            type=int,
+            default=None,
+            help="特徴選択で残す特徴の数",
+        )
+        parser.add_argument(
+            "--l1-c",
+            type=float,
+            default=1.0,
+            help="L1 正則化による特徴選択に用いる正則化の強さの逆数",
+        )
+        parser.add_argument(
+            "--num-load-workers",
+            type=int,
+            default=8,
+            help="記事のファイルを読み込む際に使うスレッドの数",
+        )
+        parser.add_argument(
+            "--categories",
+            type=str,
+            nargs="+",
+            default=None,
+            help="学習に使うカテゴリ。以下のオプションを指定した場合は manifest から記事を選ぶ",
+        )
+        parser.add_argument(
+            "--crawled-after",
+            type=timestamp,
+            default=None,
+            help="この日時以降にクローリングした記事のみを使う (例: 2023-02-01)",
+        )
+        parser.add_argument(
+            "--crawled-before",
+            type=timestamp,
+            default=None,
+            help="この日時より前にクローリングした記事のみを使う (例: 2023-03-01)",
+        )
+        parser.add_argument(
+            "--per-category",
+            type=int,
+            default=None,
+            help="カテゴリごとに無作為に選ぶ記事の数の上限",
+        )
+        parser.add_argument(
+            "--balanced",
+            action="store_true",
+            help="全てのカテゴリの記事の数を、最も少ないカテゴリに揃える",
+        )
+        parser.add_argument(
+            "--sample-seed",
+            type=int,
+            default=0,
+            help="カテゴリごとに記事を無作為に選ぶ際の乱数のシード",
+        )
+        add_profile_arguments(
+            parser,
+            default_dir=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "profiles",
+        )
 
     def handle(self, *args: Any, **options: Any) -> None:
         """
         `python manage.py train_classifier` を実行したときに呼び出される関数
         """
 
-        # 1. データの読み込み
-        dataset = load_dataset(dataset_dir=options["data_root_dir"])
+        stop_words_path = options["stop_words_path"]
+        feature_config = FeatureConfig(
+            min_df=options["min_df"],
+            max_df=options["max_df"],
+            max_features=options["max_features"],
+            stop_words=load_stop_words(stop_words_path) if stop_words_path else None,
+            pos_filter=tuple(options["pos_filter"]) if options["pos_filter"] else None,
+            selection=options["feature_selection"],
+            num_features=options["num_features"],
+            l1_c=options["l1_c"],
+        )
 
-        # 2. データの train / test への分割
-        train_dataset, test_dataset = split_dataset(dataset)
+        query = None
+        if (
+            options["categories"] is not None
+            or options["crawled_after"] is not None
+            or options["crawled_before"] is not None
+            or options["per_category"] is not None
+            or options["balanced"]
+        ):
+            query = ManifestQuery(
+                categories=options["categories"],
+                crawled_after=options["crawled_after"],
+                crawled_before=options["crawled_before"],
+                per_category=options["per_category"],
+                balanced=options["balanced"],
+                seed=options["sample_seed"],
+            )
 
-        # 3. データの前処理
-        train_dataset, test_dataset = preprocess_dataset(
-            train_dataset,
-            test_dataset,
-            label_encoder_save_path=options["label_encoder_save_path"],
-            vectorizer_save_path=options["vectorizer_save_path"],
+        profiler = Profiler(
+            mode=options["profile"],
+            profile_dir=options["profile_dir"],
+            name="train_classifier",
+            interval=options["profile_interval"],
         )
+        with profiler:
+            # 1. データの読み込み
+            with profiler.stage("load_dataset"):
+                dataset = load_dataset(
+                    dataset_dir=options["data_root_dir"],
+                    num_workers=options["num_load_workers"],
+                    query=query,
+                )
+
+            # 2. データの train / test への分割
+            with profiler.stage("split_dataset"):
+                train_dataset, test_dataset = split_dataset(dataset)
+
+            # 3. データの前処理 (トークナイズ)
+            with profiler.stage("tokenize_dataset"):
+                tokenized_train_dataset, tokenized_test_dataset = tokenize_dataset(
+                    train_dataset,
+                    test_dataset,
+                    pos_filter=feature_config.pos_filter,
+                )
+
+            # 4. データの前処理 (ベクトル化、語彙の枝刈りと特徴選択)
+            with profiler.stage("vectorize_dataset"):
+                train_dataset, test_dataset = vectorize_dataset(  # type: ignore
+                    tokenized_train_dataset,
+                    tokenized_test_dataset,
+                    label_encoder_save_path=options["label_encoder_save_path"],
+                    vectorizer_save_path=options["vectorizer_save_path"],
+                    feature_config=feature_config,
+                )
+
+            # 5. 分類モデルの構築
+            model = build_model()
 
-        # 4. 分類モデルの構築
-        model = build_model()
+            # 6. 分類モデルの学習
+            with profiler.stage("train_model"):
+                model = train_model(model, train_dataset)
 
-        # 5. 分類モデルの学習
-        model = train_model(model, train_dataset)
+            # 7. test データを用いたモデルの評価
+            with profiler.stage("test_model"):
+                model = test_model(model, test_dataset)
 
-        # 6. test データを用いたモデルの評価
-        model = test_model(model, test_dataset)
+            # 8. 学習済み分類器の保存
+            with profiler.stage("save_model"):
+                save_model(model, options["model_save_path"])
 
-        # 7. 学習済み分類器の保存
-        save_model(model, options["model_save_path"])
+            # 9. 保存した分類器の語彙数・サイズ・読み込み時間・変換時間と正解率の報告
+            with profiler.stage("report_model_footprint"):
+                report_model_footprint(
+                    tokenized_test_dataset,
+                    model_save_path=options["model_save_path"],
+                    label_encoder_save_path=options["label_encoder_save_path"],
+                    vectorizer_save_path=options["vectorizer_save_path"],
+                )
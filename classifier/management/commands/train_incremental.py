@@ -0,0 +1,118 @@
+import pathlib
+import time
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from classifier.incremental import IncrementalConfig, update_model
+from classifier.utils import load_stop_words
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser: CommandParser) -> None:
+        """
+        `python manage.py train_incremental` を実行するときのコマンドラインオプション
+        """
+        parser.add_argument(
+            "--data-root-dir",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3] / "data" / "articles",
+            help="クローリングしたときに保存したデータのパスの情報",
+        )
+        parser.add_argument(
+            "--bundle-dir",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "incremental_model",
+            help="追加学習するモデルと学習の状態を保存するディレクトリのパスの情報",
+        )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="前回のモデルを使わず、全ての記事で学習し直す",
+        )
+        parser.add_argument(
+            "--n-features",
+            type=int,
+            default=2**18,
+            help="単語のハッシュ値から作る特徴の数。前回の学習と異なる場合は全ての記事で学習し直す",
+        )
+        parser.add_argument(
+            "--alpha",
+            type=float,
+            default=1e-5,
+            help="SGDClassifier の正則化の強さ",
+        )
+        parser.add_argument(
+            "--epochs",
+            type=int,
+            default=5,
+            help="学習データを何周するか",
+        )
+        parser.add_argument(
+            "--eval-ratio",
+            type=float,
+            default=0.2,
+            help="新しい記事のうち評価用のデータに回す割合",
+        )
+        parser.add_argument(
+            "--eval-size",
+            type=int,
+            default=2000,
+            help="評価用のデータの件数の上限。超えた分は古いものから捨てる",
+        )
+        parser.add_argument(
+            "--drift-threshold",
+            type=float,
+            default=0.05,
+            help="評価用のデータでの正解率がこの値を超えて下がったら全ての記事で学習し直す",
+        )
+        parser.add_argument(
+            "--stop-words-path",
+            type=pathlib.Path,
+            default=None,
+            help="語彙から除外する単語を 1 行に 1 つずつ記載したファイルのパスの情報",
+        )
+        parser.add_argument(
+            "--pos-filter",
+            type=str,
+            nargs="+",
+            default=None,
+            help="残す品詞 (例: 名詞 動詞 形容詞)。指定しない場合は全ての品詞を残す",
+        )
+        parser.add_argument(
+            "--num-load-workers",
+            type=int,
+            default=8,
+            help="記事のファイルを読み込む際に使うスレッドの数",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        """
+        `python manage.py train_incremental` を実行したときに呼び出される関数
+        """
+        stop_words_path = options["stop_words_path"]
+        config = IncrementalConfig(
+            n_features=options["n_features"],
+            alpha=options["alpha"],
+            epochs=options["epochs"],
+            eval_ratio=options["eval_ratio"],
+            eval_size=options["eval_size"],
+            drift_threshold=options["drift_threshold"],
+            pos_filter=tuple(options["pos_filter"]) if options["pos_filter"] else None,
+            stop_words=load_stop_words(stop_words_path) if stop_words_path else None,
+            num_load_workers=options["num_load_workers"],
+        )
+
+        start_time = time.perf_counter()
+        bundle = update_model(
+            dataset_dir=options["data_root_dir"],
+            bundle_dir=options["bundle_dir"],
+            config=config,
+            full=options["full"],
+        )
+        print(
+            f"学習にかかった時間: {time.perf_counter() - start_time:.1f} 秒 "
+            f"(これまでに学習に使った記事: {bundle.state.num_trained} 件)"
+        )
@@ -1,3 +1,221 @@
-from django.test import TestCase
+import json
+import math
+import pathlib
+import random
+import tempfile
+from typing import List
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase
+
+from classifier.incremental import (
+    IncrementalConfig,
+    load_bundle,
+    train_incrementally,
+    update_model,
+)
+from classifier.utils import create_tagger, select_dataset_file_paths, tokenize_text
+from crawler.manifest import ManifestQuery, thread_local
+from crawler.utils import Article, save_article
+
+
+def is_mecab_available() -> bool:
+    # natto-py を import できても、libmecab や辞書が無いと tagger の作成に失敗する
+    try:
+        create_tagger()
+    except Exception:
+        return False
+    return True
+
+
+@skipIf(not is_mecab_available(), "MeCab is not available")
+class TokenizeTextTest(SimpleTestCase):
+    text = "東京都で新しい法律が成立した。\n\n首相は会見で説明した。"
+
+    def test_tokenize_without_pos_filter(self):
+        tokens = tokenize_text(create_tagger(), self.text).split()
+
+        self.assertIn("法律", tokens)
+        self.assertIn("新しい", tokens)
+        self.assertIn("が", tokens)
+
+    def test_pos_filter_keeps_nouns(self):
+        pos_filter = ("名詞",)
+        tokens = tokenize_text(create_tagger(pos_filter), self.text, pos_filter).split()
+
+        for noun in ["法律", "成立", "首相", "会見", "説明"]:
+            self.assertIn(noun, tokens)
+        for word in ["新しい", "が", "で", "た", "。"]:
+            self.assertNotIn(word, tokens)
+
+
+class SelectDatasetFilePathsTest(SimpleTestCase):
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.data_root_dir = pathlib.Path(tmp_dir.name)
+        self.addCleanup(self.close_manifests)
+
+    def close_manifests(self) -> None:
+        for manifest in getattr(thread_local, "manifests", {}).values():
+            manifest.close()
+        thread_local.__dict__.pop("manifests", None)
+
+    def save(self, index: int) -> None:
+        article = Article(
+            html="",
+            title=f"記事{index}",
+            content="本文",
+            category="国内",
+            url=f"https://example.com/articles/{index}",
+        )
+        save_article(article, self.data_root_dir)
+
+    def test_corpus_crawled_with_manifest(self):
+        for index in range(3):
+            self.save(index)
+
+        file_paths = select_dataset_file_paths(self.data_root_dir, ManifestQuery())
+        self.assertEqual(len(file_paths), 3)
+
+    def test_corpus_predating_manifest(self):
+        # manifest を導入する前に保存した記事
+        category_dir = self.data_root_dir / "国内"
+        category_dir.mkdir()
+        for index in range(3):
+            with open(category_dir / f"old{index}.json", "w") as wf:
+                json.dump(dict(html="", title="", content="本文"), wf)
+        # その後にクローリングした記事だけが manifest に記録される
+        self.save(3)
+
+        with self.assertRaises(CommandError):
+            select_dataset_file_paths(self.data_root_dir, ManifestQuery())
+
+        call_command("build_manifest", data_root_dir=self.data_root_dir)
+        file_paths = select_dataset_file_paths(self.data_root_dir, ManifestQuery())
+        self.assertEqual(len(file_paths), 4)
+
+
+class IncrementalTrainingTest(SimpleTestCase):
+    category_words = {
+        "政治": ["選挙", "国会", "首相", "法案", "与党", "野党", "内閣", "議員"],
+        "スポーツ": ["試合", "選手", "優勝", "監督", "得点", "球団", "大会", "記録"],
+        "経済": ["株価", "円安", "金利", "企業", "決算", "投資", "物価", "市場"],
+    }
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.data_root_dir = pathlib.Path(tmp_dir.name) / "articles"
+        self.bundle_dir = pathlib.Path(tmp_dir.name) / "incremental_model"
+        self.addCleanup(self.close_manifests)
+
+        self.config = IncrementalConfig(n_features=2**10, num_load_workers=2)
+        self.rng = random.Random(0)
+        self.num_articles = 0
+
+        # MeCab が無くても動かせるよう、本文は分かち書きしたものとして保存し、トークナイズは省く
+        patchers = [
+            mock.patch("classifier.incremental.create_tagger", return_value=None),
+            mock.patch(
+                "classifier.incremental.tokenize_text",
+                side_effect=lambda tagger, text, pos_filter: text,
+            ),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def close_manifests(self) -> None:
+        for manifest in getattr(thread_local, "manifests", {}).values():
+            manifest.close()
+        thread_local.__dict__.pop("manifests", None)
+
+    def save(self, category: str, num_articles: int, words_of: str = "") -> None:
+        # `words_of` を指定すると、そのカテゴリの単語からなる記事を `category` として保存する
+        words = self.category_words[words_of or category]
+        for _ in range(num_articles):
+            self.num_articles += 1
+            article = Article(
+                html="",
+                title=f"記事{self.num_articles}",
+                content=" ".join(self.rng.choices(words, k=20)),
+                category=category,
+                url=f"https://example.com/articles/{self.num_articles}",
+            )
+            save_article(article, self.data_root_dir)
+
+    def modes(self) -> List[str]:
+        bundle = load_bundle(self.bundle_dir)
+        return [record["mode"] for record in bundle.state.history]
+
+    def train_first(self):
+        self.save("政治", 30)
+        self.save("スポーツ", 30)
+        return update_model(self.data_root_dir, self.bundle_dir, self.config)
+
+    def test_first_full_train(self):
+        bundle = self.train_first()
+
+        self.assertEqual(self.modes(), ["full"])
+        self.assertEqual(sorted(bundle.label_encoder.classes_), ["スポーツ", "政治"])
+        self.assertEqual(bundle.state.num_trained, 48)
+        self.assertGreaterEqual(bundle.state.baseline_accuracy, 0.9)
+
+    def test_increment_advances_snapshot(self):
+        bundle = self.train_first()
+        snapshot_at = bundle.state.snapshot_at
+
+        self.save("政治", 10)
+        self.save("スポーツ", 10)
+        bundle = update_model(self.data_root_dir, self.bundle_dir, self.config)
+
+        self.assertEqual(self.modes(), ["full", "incremental"])
+        self.assertGreater(bundle.state.snapshot_at, snapshot_at)
+        self.assertEqual(bundle.state.num_trained, 48 + 16)
+
+    def test_unknown_category_forces_retrain(self):
+        bundle = self.train_first()
+
+        self.save("経済", 10)
+        reason = train_incrementally(bundle, self.data_root_dir, self.config)
+        self.assertIn("経済", reason)
+
+        bundle = update_model(self.data_root_dir, self.bundle_dir, self.config)
+        self.assertEqual(self.modes(), ["full", "full"])
+        self.assertIn("経済", bundle.label_encoder.classes_)
+
+    def test_drift_is_rejected(self):
+        bundle = self.train_first()
+
+        # 政治の単語からなる記事をスポーツとして学習させ、正解率を下げる
+        self.save("スポーツ", 40, words_of="政治")
+        reason = train_incrementally(bundle, self.data_root_dir, self.config)
+        self.assertIn("正解率", reason)
+
+    def test_changed_vectorizer_config_forces_retrain(self):
+        bundle = self.train_first()
+
+        self.save("政治", 10)
+        self.config.n_features = 2**11
+        reason = train_incrementally(bundle, self.data_root_dir, self.config)
+        self.assertIn("n_features", reason)
+
+        bundle = update_model(self.data_root_dir, self.bundle_dir, self.config)
+        self.assertEqual(self.modes(), ["full", "full"])
+        self.assertEqual(bundle.vectorizer.n_features, 2**11)
+
+    def test_missing_baseline_forces_retrain(self):
+        # 記事が少なく、最初の学習で評価用のデータが無かった場合
+        self.save("政治", 2)
+        self.save("スポーツ", 2)
+        bundle = update_model(self.data_root_dir, self.bundle_dir, self.config)
+        self.assertTrue(math.isnan(bundle.state.baseline_accuracy))
+
+        self.save("政治", 30)
+        self.save("スポーツ", 30)
+        bundle = update_model(self.data_root_dir, self.bundle_dir, self.config)
+        self.assertEqual(self.modes(), ["full", "full"])
+        self.assertFalse(math.isnan(bundle.state.baseline_accuracy))
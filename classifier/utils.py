@@ -1,34 +1,197 @@
+from __future__ import annotations
+
+import collections
 import json
+import os
 import pathlib
-from typing import List, Tuple
-
-import joblib
-import numpy as np
-from natto import MeCab
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.linear_model import LogisticRegression
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelEncoder
-
-
-def load_dataset(dataset_dir: pathlib.Path) -> List[Tuple[str, str]]:
-    category_dir_pathes = [p for p in dataset_dir.iterdir() if p.is_dir()]
-    assert len(category_dir_pathes) == 8
-
-    dataset = []
-    for category_dir_path in category_dir_pathes:
-        article_file_paths = [
-            p for p in category_dir_path.iterdir() if p.suffix == ".json"
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from crawler.manifest import MANIFEST_FILE_NAME, CorpusManifest, ManifestQuery
+
+try:
+    # orjson があれば標準ライブラリの json よりも速く parse できる
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+# scikit-learn や joblib, natto などの読み込みには時間がかかるため、
+# `manage.py` の各コマンドの起動を遅くしないよう、実際に使用する関数の中で import する
+if TYPE_CHECKING:
+    import numpy as np
+    from sklearn.feature_extraction.text import CountVectorizer
+
+
+@dataclass
+class FeatureConfig(object):
+    """
+    語彙の枝刈りと特徴選択の設定
+
+    - min_df / max_df / max_features: `CountVectorizer` にそのまま渡す
+    - stop_words: 語彙から除外する単語のリスト
+    - pos_filter: 残す品詞 (例: 名詞, 動詞)。None の場合は全ての品詞を残す
+    - selection: 特徴選択の手法 ("none", "chi2", "l1")
+    - num_features: 特徴選択で残す特徴の数
+    - l1_c: L1 正則化付きロジスティック回帰の正則化の強さの逆数
+    """
+
+    min_df: float = 1
+    max_df: float = 1.0
+    max_features: Optional[int] = None
+    stop_words: Optional[List[str]] = None
+    pos_filter: Optional[Tuple[str, ...]] = None
+    selection: str = "none"
+    num_features: Optional[int] = None
+    l1_c: float = 1.0
+
+
+# `json.dump` で保存された記事の本文のキー。
+# JSON の文字列の中の `"` は必ず `\"` とエスケープされるため、これが現れるのはキーとしてのみ
+CONTENT_KEY = b'"content": '
+
+json_decoder = json.JSONDecoder()
+
+
+def parse_article_json(data: bytes) -> Dict[str, Any]:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def read_article_content(article_file_path: Union[str, pathlib.Path]) -> str:
+    """
+    記事の JSON ファイルから本文だけを読み出す。
+    学習に使わない HTML は本文の何倍も大きいため、全体を parse せずに本文のキーの位置を探し、
+    本文の文字列だけを decode する。キーが見つからない場合はファイル全体を parse する
+    """
+    with open(article_file_path, "rb") as rf:
+        data = rf.read()
+
+    start = data.find(CONTENT_KEY)
+    if start >= 0:
+        content, _ = json_decoder.raw_decode(data[start + len(CONTENT_KEY) :].decode())
+        if isinstance(content, str):
+            return content
+
+    return parse_article_json(data)["content"]
+
+
+def iter_dataset_file_paths(dataset_dir: pathlib.Path) -> Iterator[Tuple[str, str]]:
+    """
+    (記事のファイルのパス, カテゴリ) を返す。
+    `pathlib.Path.iterdir` よりも速い `os.scandir` でディレクトリを走査する
+    """
+    with os.scandir(dataset_dir) as category_entries:
+        for category_entry in category_entries:
+            if not category_entry.is_dir():
+                continue
+            with os.scandir(category_entry.path) as article_entries:
+                for article_entry in article_entries:
+                    if article_entry.name.endswith(".json"):
+                        yield article_entry.path, category_entry.name
+
+
+def read_dataset(
+    article_file_paths: Iterable[Tuple[str, str]],
+    num_workers: int = 8,
+    prefetch: int = 256,
+) -> Iterator[Tuple[str, str]]:
+    """
+    (記事のファイルのパス, カテゴリ) ごとに (本文, カテゴリ) を 1 件ずつ返す。
+    ページキャッシュに載っていないファイルの読み込みは I/O 待ちが大半を占めるため、
+    `num_workers` 個のスレッドで先読みする。先読みする件数は `prefetch` 件までに抑え、
+    コーパス全体をメモリに載せずに処理できるようにする
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending: Deque[Tuple[Future, str]] = collections.deque()
+        for article_file_path, category in article_file_paths:
+            future = executor.submit(read_article_content, article_file_path)
+            pending.append((future, category))
+
+            if len(pending) >= prefetch:
+                future, category = pending.popleft()
+                yield future.result(), category
+
+        while pending:
+            future, category = pending.popleft()
+            yield future.result(), category
+
+
+def select_dataset_file_paths(
+    dataset_dir: pathlib.Path, query: ManifestQuery
+) -> List[Tuple[str, str]]:
+    """
+    クローラが記録した manifest から `query` の条件に合う記事の (ファイルのパス, カテゴリ) を返す
+    """
+    from django.core.management.base import CommandError
+
+    manifest_path = dataset_dir / MANIFEST_FILE_NAME
+    if not manifest_path.exists():
+        raise CommandError(
+            f"{manifest_path} が見つかりません。`python manage.py build_manifest` で作成してください"
+        )
+
+    manifest = CorpusManifest(manifest_path)
+    try:
+        # manifest を導入する前に保存した記事が記録されていないと、一部の記事だけから選んでしまう
+        if not manifest.is_complete():
+            raise CommandError(
+                f"{manifest_path} に記録されていない記事があります。"
+                "`python manage.py build_manifest` で記録し直してください"
+            )
+        return [
+            (os.path.join(dataset_dir, path), category)
+            for path, category in manifest.select(query)
         ]
-
-        # assert len(article_file_paths) == 100
-
-        for article_file_path in article_file_paths:
-            with open(article_file_path, "r") as rf:
-                article_dict = json.load(rf)
-
-            data = (article_dict["content"], category_dir_path.name)
-            dataset.append(data)
+    finally:
+        manifest.close()
+
+
+def iter_dataset(
+    dataset_dir: pathlib.Path,
+    num_workers: int = 8,
+    prefetch: int = 256,
+    query: Optional[ManifestQuery] = None,
+) -> Iterator[Tuple[str, str]]:
+    """
+    (本文, カテゴリ) を 1 件ずつ返す。
+    `query` を指定した場合は manifest から条件に合う記事を選び、そのファイルだけを読み込む
+    """
+    if query is None:
+        article_file_paths: Iterable[Tuple[str, str]] = iter_dataset_file_paths(
+            dataset_dir
+        )
+    else:
+        article_file_paths = select_dataset_file_paths(dataset_dir, query)
+
+    return read_dataset(article_file_paths, num_workers=num_workers, prefetch=prefetch)
+
+
+def load_dataset(
+    dataset_dir: pathlib.Path,
+    num_workers: int = 8,
+    query: Optional[ManifestQuery] = None,
+) -> List[Tuple[str, str]]:
+    if query is None:
+        category_dir_pathes = [p for p in dataset_dir.iterdir() if p.is_dir()]
+        assert len(category_dir_pathes) == 8
+
+    dataset = list(iter_dataset(dataset_dir, num_workers=num_workers, query=query))
+    print(f"Load {len(dataset)} articles from {dataset_dir}")
 
     return dataset
 
@@ -37,16 +200,59 @@ def split_dataset(
     dataset: List[Tuple[str, str]],
     test_size: float = 0.2,
 ) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+    from sklearn.model_selection import train_test_split
+
     train_dataset, test_dataset = train_test_split(dataset, test_size=test_size)
     return train_dataset, test_dataset
 
 
-def tokenize_text(tagger, article_text: str) -> str:
+def create_tagger(pos_filter: Optional[Sequence[str]] = None):
+    """
+    `tokenize_text` に渡す MeCab の tagger を作る。
+    `-Owakati` のように出力形式を指定すると、natto-py の `node.feature` には品詞を含む素性ではなく
+    出力形式で整形した文字列 (分かち書きでは空文字列) が入るため、
+    品詞で絞り込む場合は出力形式を指定せずに起動する
+    """
+    from natto import MeCab
+
+    if pos_filter is None:
+        return MeCab("-Owakati")
+    return MeCab()
+
+
+def tokenize_paragraph_with_pos_filter(
+    tagger, paragraph: str, pos_filter: Sequence[str]
+) -> str:
+    """
+    `tagger` は `create_tagger(pos_filter)` で作ったものを使う
+    """
+    surfaces = []
+    for node in tagger.parse(paragraph, as_nodes=True):
+        if not node.is_nor():
+            continue  # 文頭・文末を表すノードは飛ばす
+        # MeCab の素性はカンマ区切りで、先頭が品詞を表す
+        pos, *_ = node.feature.split(",")
+        if pos in pos_filter:
+            surfaces.append(node.surface)
+
+    return " ".join(surfaces) + " "
+
+
+def tokenize_text(
+    tagger, article_text: str, pos_filter: Optional[Sequence[str]] = None
+) -> str:
+    # `tagger` は `create_tagger(pos_filter)` で作ったものを使う
     # "\n\n" でパラグラフごとに分割される
     article_paragraphs = article_text.split("\n\n")
 
     tokenized_text = ""
     for paragraph in article_paragraphs:
+        if pos_filter is not None:
+            tokenized_text += tokenize_paragraph_with_pos_filter(
+                tagger, paragraph, pos_filter
+            )
+            continue
+
         tmp_tokenized_text = tagger.parse(paragraph)
         assert len(tmp_tokenized_text) > 0
         tmp_tokenized_text = tmp_tokenized_text.replace("\n", " ")
@@ -56,20 +262,22 @@ def tokenize_text(tagger, article_text: str) -> str:
 
 
 def tokenize_dataset(
-    train_dataset: List[Tuple[str, str]], test_dataset: List[Tuple[str, str]]
+    train_dataset: List[Tuple[str, str]],
+    test_dataset: List[Tuple[str, str]],
+    pos_filter: Optional[Sequence[str]] = None,
 ) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
-    tagger = MeCab("-Owakati")
+    tagger = create_tagger(pos_filter)
 
     train_tokenized_dataset = []
     for train_text, train_category in train_dataset:
-        train_tokenized_text = tokenize_text(tagger, train_text)
+        train_tokenized_text = tokenize_text(tagger, train_text, pos_filter)
 
         train_tokenized_data = (train_tokenized_text, train_category)
         train_tokenized_dataset.append(train_tokenized_data)
 
     test_tokenized_dataset = []
     for test_text, test_category in test_dataset:
-        test_tokenized_text = tokenize_text(tagger, test_text)
+        test_tokenized_text = tokenize_text(tagger, test_text, pos_filter)
 
         test_tokenized_data = (test_tokenized_text, test_category)
         test_tokenized_dataset.append(test_tokenized_data)
@@ -77,26 +285,117 @@ def tokenize_dataset(
     return (train_tokenized_dataset, test_tokenized_dataset)
 
 
+def load_stop_words(stop_words_path: pathlib.Path) -> List[str]:
+    with open(stop_words_path, "r") as rf:
+        stop_words = [line.strip() for line in rf]
+    # 空行やコメント行は無視する
+    return [word for word in stop_words if word and not word.startswith("#")]
+
+
+def build_vectorizer(feature_config: FeatureConfig) -> CountVectorizer:
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    vectorizer = CountVectorizer(
+        min_df=feature_config.min_df,
+        max_df=feature_config.max_df,
+        max_features=feature_config.max_features,
+        stop_words=feature_config.stop_words,
+    )
+    return vectorizer
+
+
+def select_features(X, y, feature_config: FeatureConfig) -> np.ndarray:
+    """
+    chi2 もしくは L1 正則化付きロジスティック回帰で特徴選択を行い、残す特徴のマスクを返す
+    """
+    from sklearn.feature_selection import SelectFromModel, SelectKBest, chi2
+    from sklearn.linear_model import LogisticRegression
+
+    num_all_features = X.shape[1]
+    num_features = feature_config.num_features
+    if num_features is not None:
+        num_features = min(num_features, num_all_features)
+
+    if feature_config.selection == "chi2":
+        selector = SelectKBest(chi2, k=num_features or "all")
+    elif feature_config.selection == "l1":
+        selector = SelectFromModel(
+            LogisticRegression(
+                penalty="l1",
+                solver="saga",
+                max_iter=1000,
+                C=feature_config.l1_c,
+                random_state=19950815,
+            ),
+            max_features=num_features,
+        )
+    else:
+        raise ValueError(f"Invalid feature selection: {feature_config.selection}")
+
+    selector.fit(X, y)
+    return selector.get_support()
+
+
+def prune_vectorizer_vocabulary(
+    vectorizer: CountVectorizer, support: np.ndarray
+) -> CountVectorizer:
+    """
+    特徴選択で残った単語のみになるように vectorizer の語彙を詰め直す。
+    これにより保存される vectorizer 自体が選択後の特徴を出力するため、推論側の変更は不要
+    """
+    import numpy as np
+
+    selected_indices = np.flatnonzero(support)
+    index_to_term = {index: term for term, index in vectorizer.vocabulary_.items()}
+    vectorizer.vocabulary_ = {
+        index_to_term[old_index]: new_index
+        for new_index, old_index in enumerate(selected_indices)
+    }
+    return vectorizer
+
+
 def vectorize_dataset(
     train_dataset: List[Tuple[str, str]],
     test_dataset: List[Tuple[str, str]],
     vectorizer_save_path: pathlib.Path,
     label_encoder_save_path: pathlib.Path,
+    feature_config: Optional[FeatureConfig] = None,
 ) -> Tuple[List[Tuple[np.ndarray, int]], List[Tuple[np.ndarray, int]]]:
+    import joblib
+    from sklearn.preprocessing import LabelEncoder
+
+    feature_config = feature_config or FeatureConfig()
+
     X_train = [data[0] for data in train_dataset]
     y_train = [data[1] for data in train_dataset]
 
     X_test = [data[0] for data in test_dataset]
     y_test = [data[1] for data in test_dataset]
 
-    vectorizer = CountVectorizer()
-    X_train_vec = vectorizer.fit_transform(X_train).todense()
-    X_test_vec = vectorizer.transform(X_test).todense()
+    vectorizer = build_vectorizer(feature_config)
+    X_train_vec = vectorizer.fit_transform(X_train)
+    X_test_vec = vectorizer.transform(X_test)
+    # 推論時にも学習時と同じ品詞フィルタでトークナイズできるよう vectorizer に持たせておく
+    vectorizer.pos_filter_ = feature_config.pos_filter
+    print(f"語彙数 (枝刈り後): {len(vectorizer.vocabulary_)}")
 
     label_encoder = LabelEncoder()
     y_train = label_encoder.fit_transform(y_train)
     y_test = label_encoder.transform(y_test)
 
+    if feature_config.selection != "none":
+        support = select_features(X_train_vec, y_train, feature_config)
+        vectorizer = prune_vectorizer_vocabulary(vectorizer, support)
+        X_train_vec = X_train_vec[:, support]
+        X_test_vec = X_test_vec[:, support]
+        print(f"語彙数 (特徴選択後): {len(vectorizer.vocabulary_)}")
+
+    # `stop_words_` は枝刈りされた単語の集合で推論には不要なため、保存前に削除する
+    vectorizer.stop_words_ = None
+
+    X_train_vec = X_train_vec.todense()
+    X_test_vec = X_test_vec.todense()
+
     assert len(X_train_vec) == len(y_train)
     assert len(X_test_vec) == len(y_test)
 
@@ -128,27 +427,36 @@ def preprocess_dataset(
     test_dataset: List[Tuple[str, str]],
     label_encoder_save_path: pathlib.Path,
     vectorizer_save_path: pathlib.Path,
+    feature_config: Optional[FeatureConfig] = None,
 ):
+    feature_config = feature_config or FeatureConfig()
+
     train_dataset, test_dataset = tokenize_dataset(
         train_dataset,
         test_dataset,
+        pos_filter=feature_config.pos_filter,
     )
     train_dataset, test_dataset = vectorize_dataset(  # type: ignore
         train_dataset,
         test_dataset,
         vectorizer_save_path=vectorizer_save_path,
         label_encoder_save_path=label_encoder_save_path,
+        feature_config=feature_config,
     )
 
     return train_dataset, test_dataset
 
 
 def build_model():
+    from sklearn.linear_model import LogisticRegression
+
     clf = LogisticRegression(random_state=19950815)
     return clf
 
 
 def train_model(model, train_dataset):
+    import numpy as np
+
     X_train = [data[0] for data in train_dataset]
     y_train = [data[1] for data in train_dataset]
 
@@ -162,6 +470,8 @@ def train_model(model, train_dataset):
 
 
 def test_model(model, test_dataset):
+    import numpy as np
+
     X_test = [data[0] for data in test_dataset]
     y_test = [data[1] for data in test_dataset]
 
@@ -174,5 +484,56 @@ def test_model(model, test_dataset):
 
 
 def save_model(model, model_save_path: pathlib.Path):
+    import joblib
+
     print(f"Save model to {model_save_path}")
     joblib.dump(model, model_save_path)
+
+
+def report_model_footprint(
+    tokenized_test_dataset: List[Tuple[str, str]],
+    model_save_path: pathlib.Path,
+    label_encoder_save_path: pathlib.Path,
+    vectorizer_save_path: pathlib.Path,
+) -> None:
+    """
+    保存した成果物を読み込み直し、語彙数・ファイルサイズ・読み込み時間・
+    1 文書あたりの変換時間・正解率を表示する
+    """
+    import joblib
+    import numpy as np
+
+    artifact_paths = {
+        "model": model_save_path,
+        "label encoder": label_encoder_save_path,
+        "vectorizer": vectorizer_save_path,
+    }
+
+    artifacts = {}
+    for name, artifact_path in artifact_paths.items():
+        start_time = time.perf_counter()
+        artifacts[name] = joblib.load(artifact_path)
+        load_time = time.perf_counter() - start_time
+
+        artifact_size = os.path.getsize(artifact_path) / 1024
+        print(f"{name}: {artifact_size:.1f} KiB, 読み込み時間 {load_time * 1000:.2f} ms")
+
+    model = artifacts["model"]
+    label_encoder = artifacts["label encoder"]
+    vectorizer = artifacts["vectorizer"]
+
+    X_test = [data[0] for data in tokenized_test_dataset]
+    y_test = label_encoder.transform([data[1] for data in tokenized_test_dataset])
+
+    # 推論時と同様に 1 文書ずつ変換した場合の時間を計測する
+    transform_times = []
+    for text in X_test:
+        start_time = time.perf_counter()
+        vectorizer.transform([text])
+        transform_times.append(time.perf_counter() - start_time)
+
+    test_acc = model.score(vectorizer.transform(X_test), y_test)
+
+    print(f"語彙数: {len(vectorizer.vocabulary_)}")
+    print(f"1 文書あたりの変換時間: {np.mean(transform_times) * 1000:.3f} ms")
+    print(f"評価時正解率 (Accuracy): {test_acc}")
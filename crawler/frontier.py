@@ -0,0 +1,270 @@
+import pathlib
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+LISTING = "listing"
+ARTICLE = "article"
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS categories (
+    name TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    cursor TEXT
+);
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    category TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    lease_owner TEXT,
+    lease_expires_at REAL,
+    updated_at REAL NOT NULL DEFAULT 0
+);
+-- `lease` が種類ごとに、貸し出し可能になった順で次の URL を索引だけで引けるようにする
+DROP INDEX IF EXISTS pages_status_idx;
+CREATE INDEX IF NOT EXISTS pages_pending_idx ON pages (status, kind, next_attempt_at);
+CREATE INDEX IF NOT EXISTS pages_lease_idx ON pages (status, lease_expires_at);
+"""
+
+
+class LeaseLostError(Exception):
+    """
+    貸し出しの期限が切れ、URL が他の worker に貸し出し直されたことを表す
+    """
+
+
+@dataclass
+class FrontierItem(object):
+    url: str
+    kind: str
+    category: str
+    attempts: int
+
+
+class CrawlFrontier(object):
+    """
+    クローリングの状態 (未取得の一覧ページ・記事 URL、取得済みの URL、カテゴリごとの現在位置) を
+    SQLite に保存し、プロセスが途中で終了しても続きから再開できるようにする。
+
+    複数のプロセスから同じ SQLite ファイルを共有でき、各 URL は `lease` によって
+    一定時間 1 つの worker に貸し出される。処理に時間がかかる場合、worker は `renew` で期限を延ばす。
+    worker が落ちて期限切れになった URL は、失敗 1 回として数えたうえで他の worker に再度貸し出される
+    """
+
+    def __init__(
+        self,
+        db_path: pathlib.Path,
+        max_attempts: int = 3,
+        retry_delay: float = 30.0,
+        worker_id: str = "main",
+        lease_duration: float = 60.0,
+    ) -> None:
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.worker_id = worker_id
+        self.lease_duration = lease_duration
+
+        # autocommit モードで接続し、トランザクションは明示的に張る。
+        # 他の worker が書き込み中の場合はロックが解放されるまで待つ
+        self.conn = sqlite3.connect(str(db_path), isolation_level=None, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def reset(self) -> None:
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute("DELETE FROM pages")
+            self.conn.execute("DELETE FROM categories")
+
+    def is_initialized(self) -> bool:
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM categories").fetchone()
+        return count > 0
+
+    def add_category(self, name: str, url: str) -> None:
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute(
+                "INSERT OR IGNORE INTO categories (name, url, cursor) VALUES (?, ?, ?)",
+                (name, url, url),
+            )
+            self._add_urls([url], kind=LISTING, category=name)
+
+    def _add_urls(self, urls: List[str], kind: str, category: str) -> None:
+        # UNIQUE 制約により、一度登録された URL は二度と登録されない (重複排除)
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO pages (url, kind, category, updated_at) "
+            "VALUES (?, ?, ?, ?)",
+            [(url, kind, category, time.time()) for url in urls],
+        )
+
+    def lease(self) -> Optional[FrontierItem]:
+        """
+        現時点で取得可能な次の URL をこの worker に貸し出して返す。
+        一覧ページよりも記事を優先し、同じ種類の中では貸し出し可能になった順 (同時刻なら登録順) に取得する
+        """
+        now = time.time()
+        with self.conn:
+            # 書き込みロックを先に取得し、他の worker と同じ URL を取り合わないようにする
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._expire_leases(now)
+            # 書き込みロックを持ったまま未取得の URL 全体を並べ替えないよう、
+            # 種類ごとに `pages_pending_idx` の先頭の 1 行だけを引く
+            for kind in [ARTICLE, LISTING]:
+                row = self.conn.execute(
+                    "SELECT url, kind, category, attempts FROM pages "
+                    "WHERE status = ? AND kind = ? AND next_attempt_at <= ? "
+                    "ORDER BY next_attempt_at, id LIMIT 1",
+                    (PENDING, kind, now),
+                ).fetchone()
+                if row is not None:
+                    break
+            else:
+                return None
+
+            url, kind, category, attempts = row
+            self.conn.execute(
+                "UPDATE pages SET status = ?, lease_owner = ?, lease_expires_at = ?, "
+                "updated_at = ? WHERE url = ?",
+                (LEASED, self.worker_id, now + self.lease_duration, now, url),
+            )
+
+        return FrontierItem(url=url, kind=kind, category=category, attempts=attempts)
+
+    def _expire_leases(self, now: float) -> None:
+        # 期限切れは worker が落ちたか処理が止まったことを表すため、失敗 1 回として数える。
+        # 数えないと、worker を落とす URL が貸し出され続けてクローリングが終わらない
+        expired_rows = self.conn.execute(
+            "SELECT url, attempts FROM pages WHERE status = ? AND lease_expires_at <= ?",
+            (LEASED, now),
+        ).fetchall()
+        for url, attempts in expired_rows:
+            status, next_attempt_at = self._next_attempt(attempts + 1, now)
+            self.conn.execute(
+                "UPDATE pages SET status = ?, attempts = ?, next_attempt_at = ?, "
+                "last_error = ?, lease_owner = NULL, lease_expires_at = NULL, "
+                "updated_at = ? WHERE url = ?",
+                (status, attempts + 1, next_attempt_at, "lease expired", now, url),
+            )
+
+    def _next_attempt(self, attempts: int, now: float) -> Tuple[str, float]:
+        """
+        `attempts` 回失敗した URL の次の状態と、次に貸し出し可能になる時刻を返す。
+        `max_attempts` 回失敗した URL はそれ以上再試行しない
+        """
+        status = FAILED if attempts >= self.max_attempts else PENDING
+        # 失敗するたびに再試行までの待ち時間を倍にする
+        return status, now + self.retry_delay * 2 ** (attempts - 1)
+
+    def renew(self, item: FrontierItem) -> None:
+        """
+        `item` の貸し出しの期限を現在時刻から `lease_duration` 秒後まで延ばす。
+        期限切れとして扱われ、他の worker に貸し出し直されていた場合は `LeaseLostError` を送出する
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            cursor = self.conn.execute(
+                "UPDATE pages SET lease_expires_at = ?, updated_at = ? "
+                "WHERE url = ? AND status = ? AND lease_owner = ?",
+                (now + self.lease_duration, now, item.url, LEASED, self.worker_id),
+            )
+        if cursor.rowcount != 1:
+            raise LeaseLostError(item.url)
+
+    def next_retry_at(self) -> Optional[float]:
+        """
+        再試行待ちの URL と他の worker に貸し出し中の URL のうち、
+        最も早く貸し出し可能になる時刻を返す
+        """
+        (next_attempt_at,) = self.conn.execute(
+            "SELECT MIN(CASE WHEN status = ? THEN next_attempt_at "
+            "ELSE lease_expires_at END) FROM pages WHERE status IN (?, ?)",
+            (PENDING, PENDING, LEASED),
+        ).fetchone()
+        return next_attempt_at
+
+    def complete_listing(
+        self,
+        item: FrontierItem,
+        article_urls: List[str],
+        next_url: Optional[str],
+    ) -> None:
+        """
+        一覧ページの取得結果 (記事 URL と次ページの URL) の登録と、
+        カテゴリの現在位置の更新を 1 つのトランザクションで行う
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._add_urls(article_urls, kind=ARTICLE, category=item.category)
+            if next_url is not None:
+                self._add_urls([next_url], kind=LISTING, category=item.category)
+            self.conn.execute(
+                "UPDATE categories SET cursor = ? WHERE name = ?",
+                (next_url, item.category),
+            )
+            self._mark(item, status=DONE)
+
+    def complete_article(self, item: FrontierItem) -> None:
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._mark(item, status=DONE)
+
+    def fail(self, item: FrontierItem, error: Exception) -> None:
+        """
+        取得に失敗した URL を後で再試行できるようにする
+        """
+        attempts = item.attempts + 1
+        status, next_attempt_at = self._next_attempt(attempts, time.time())
+
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute(
+                "UPDATE pages SET status = ?, attempts = ?, next_attempt_at = ?, "
+                "last_error = ?, lease_owner = NULL, lease_expires_at = NULL, "
+                "updated_at = ? WHERE url = ? AND lease_owner = ?",
+                (
+                    status,
+                    attempts,
+                    next_attempt_at,
+                    repr(error),
+                    time.time(),
+                    item.url,
+                    self.worker_id,
+                ),
+            )
+
+    def _mark(self, item: FrontierItem, status: str) -> None:
+        # 期限切れで他の worker に貸し出し直された URL は上書きしない
+        self.conn.execute(
+            "UPDATE pages SET status = ?, lease_owner = NULL, lease_expires_at = NULL, "
+            "updated_at = ? WHERE url = ? AND lease_owner = ?",
+            (status, time.time(), item.url, self.worker_id),
+        )
+
+    def cursors(self) -> Dict[str, Optional[str]]:
+        rows = self.conn.execute("SELECT name, cursor FROM categories").fetchall()
+        return {name: cursor for name, cursor in rows}
+
+    def stats(self) -> Dict[str, int]:
+        rows = self.conn.execute(
+            "SELECT status, COUNT(*) FROM pages GROUP BY status"
+        ).fetchall()
+        stats = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        stats.update({status: count for status, count in rows})
+        return stats
@@ -0,0 +1,75 @@
+import json
+import os
+import pathlib
+from typing import Any, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from crawler.manifest import MANIFEST_FILE_NAME, CorpusManifest
+from crawler.utils import iter_article_file_paths
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser: CommandParser) -> None:
+        """
+        `python manage.py build_manifest` を実行するときのコマンドラインオプション
+        """
+        parser.add_argument(
+            "--data-root-dir",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3] / "data" / "articles",
+            help="クローリングしたときに保存したデータのパスの情報",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="1 つのトランザクションで記録する記事の数",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        """
+        `python manage.py build_manifest` を実行したときに呼び出される関数。
+        manifest を導入する前に保存した記事や、manifest と食い違ったファイルを記録し直す
+        """
+        data_root_dir = options["data_root_dir"]
+        manifest = CorpusManifest(data_root_dir / MANIFEST_FILE_NAME)
+
+        recorded_paths = set(manifest.paths())
+        found_paths = set()
+
+        articles: List[Tuple[str, str, str, str, float]] = []
+        for article_file_path in iter_article_file_paths(data_root_dir):
+            with open(article_file_path, "r") as rf:
+                article_dict = json.load(rf)
+
+            path = str(article_file_path.relative_to(data_root_dir))
+            found_paths.add(path)
+            # クローリングした時刻は記録されていないため、ファイルの更新時刻で代用する
+            articles.append(
+                (
+                    path,
+                    article_dict.get("url", ""),
+                    article_file_path.parent.name,
+                    article_dict["content"],
+                    os.path.getmtime(article_file_path),
+                )
+            )
+            if len(articles) >= options["batch_size"]:
+                manifest.record_many(articles)
+                articles = []
+        manifest.record_many(articles)
+
+        # ファイルが削除された記事は manifest からも削除する
+        missing_paths = sorted(recorded_paths - found_paths)
+        manifest.remove_many(missing_paths)
+        # 全ての記事を記録し終えたので、manifest から記事を選べるようにする
+        manifest.mark_complete()
+
+        print(
+            f"Record {len(found_paths)} articles to {manifest.db_path} "
+            f"(新規: {len(found_paths - recorded_paths)}, 削除: {len(missing_paths)})"
+        )
+        for category, count in manifest.counts().items():
+            print(f"{category}: {count}")
+        manifest.close()
@@ -1,9 +1,25 @@
+import os
 import pathlib
+import socket
 from typing import Any
 
-from django.core.management.base import BaseCommand, CommandParser
+from django.core.management.base import BaseCommand, CommandError, CommandParser
 
-from crawler.utils import crawl_all_articles, save_articles
+from crawler.frontier import CrawlFrontier
+from crawler.rate import RateControlConfig
+from crawler.utils import configure_rate_controller, crawl_all_articles_with_frontier
+from newspaper_classifier.profiling import Profiler, add_profile_arguments
+
+
+# `--classify` のパイプラインは frontier を使わずにカテゴリを先頭から辿るため、これらのオプションは効かない
+FRONTIER_OPTIONS = [
+    "resume",
+    "max_attempts",
+    "retry_delay",
+    "num_workers",
+    "lease_duration",
+    "progress_interval",
+]
 
 
 class Command(BaseCommand):
@@ -24,14 +40,203 @@ class Command(BaseCommand):
             default=pathlib.Path(__file__).resolve().parents[3] / "data" / "articles",
             help="クローリングしたときにどこに保存するかを示すパス情報",
         )
+        parser.add_argument(
+            "--frontier-path",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "frontier.sqlite3",
+            help="クローリングの状態 (未取得・取得済みの URL やホストごとの同時リクエスト数など) を保存するパス情報",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="前回中断したクローリングを続きから再開する",
+        )
+        parser.add_argument(
+            "--max-attempts",
+            type=int,
+            default=3,
+            help="1 つの URL の取得を試みる最大回数",
+        )
+        parser.add_argument(
+            "--retry-delay",
+            type=float,
+            default=30.0,
+            help="取得に失敗した URL を再試行するまでの待ち時間 (秒)。失敗するたびに倍になる",
+        )
+        parser.add_argument(
+            "--num-workers",
+            type=int,
+            default=1,
+            help="クローリングを行う worker プロセスの数",
+        )
+        parser.add_argument(
+            "--lease-duration",
+            type=float,
+            default=60.0,
+            help="worker に URL を貸し出す期間 (秒)。処理中の worker は期限を延ばし続け、期限切れになった URL は失敗 1 回として他の worker に貸し出し直される",
+        )
+        parser.add_argument(
+            "--initial-concurrency",
+            type=float,
+            default=1.0,
+            help="ホストへの同時リクエスト数の初期値。前回のクローリングで調整した値がある場合はそちらを引き継ぐ",
+        )
+        parser.add_argument(
+            "--max-concurrency",
+            type=float,
+            default=4.0,
+            help="全ての worker で合計したホストへの同時リクエスト数の上限。応答時間やエラーをもとにこの範囲で調整される",
+        )
+        parser.add_argument(
+            "--request-timeout",
+            type=float,
+            default=30.0,
+            help="1 リクエストのタイムアウト (秒)",
+        )
+        parser.add_argument(
+            "--ignore-robots-txt",
+            action="store_true",
+            help="robots.txt の Crawl-delay を無視する",
+        )
+        parser.add_argument(
+            "--progress-interval",
+            type=float,
+            default=10.0,
+            help="現在の同時リクエスト数やリクエストの速度を表示する間隔 (秒)",
+        )
+        parser.add_argument(
+            "--classify",
+            action="store_true",
+            help="取得した記事をその場で学習済みの分類器に通し、予測したカテゴリを記事と一緒に保存する",
+        )
+        parser.add_argument(
+            "--predictions-path",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "predictions.jsonl",
+            help="`--classify` を指定したときに予測結果を追記するパス情報",
+        )
+        parser.add_argument(
+            "--model-save-path",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "models"
+            / "pretrained-model.joblib",
+            help="`--classify` を指定したときに使用する学習済みの classifier のパスの情報",
+        )
+        parser.add_argument(
+            "--label-encoder-save-path",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "label_encoders"
+            / "label-encoder.joblib",
+            help="`--classify` を指定したときに使用する label encoder のパスの情報",
+        )
+        parser.add_argument(
+            "--vectorizer-save-path",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "vectorizers"
+            / "count-vectorizer.joblib",
+            help="`--classify` を指定したときに使用する vectorizer のパスの情報",
+        )
+        parser.add_argument(
+            "--queue-size",
+            type=int,
+            default=64,
+            help="`--classify` を指定したときの、各ステージ間のキューの大きさの上限",
+        )
+        add_profile_arguments(
+            parser,
+            default_dir=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "profiles",
+        )
 
     def handle(self, *args: Any, **options: Any) -> None:
         """
         `python manage.py crawl` を実行したときに呼び出される関数
         """
+        if options["classify"]:
+            parser = self.create_parser("manage.py", "crawl")
+            ignored_options = [
+                f"--{name.replace('_', '-')}"
+                for name in FRONTIER_OPTIONS
+                if options[name] != parser.get_default(name)
+            ]
+            if ignored_options:
+                raise CommandError(
+                    f"{', '.join(ignored_options)} cannot be used with --classify"
+                )
+
+        # 1 回のリクエストの途中で期限が切れないよう、期限はリクエストのタイムアウトより十分長くする
+        # (Crawl-delay や Retry-After を待つ間は worker が期限を延ばし続ける)
+        if options["lease_duration"] < options["request_timeout"] * 2:
+            raise ValueError(
+                "--lease-duration must be at least twice --request-timeout"
+            )
+
+        rate_config = RateControlConfig(
+            initial_concurrency=options["initial_concurrency"],
+            max_concurrency=options["max_concurrency"],
+            timeout=options["request_timeout"],
+            respect_robots_txt=not options["ignore_robots_txt"],
+            # 期限が切れる前に何度か延ばせるよう、期限の 1/4 ごとに延ばす
+            heartbeat_interval=options["lease_duration"] / 4,
+        )
+
+        # `--num-workers` が 2 以上の場合、各 worker プロセスの結果は `crawl-worker<i>-*` に保存される
+        profiler = Profiler(
+            mode=options["profile"],
+            profile_dir=options["profile_dir"],
+            name="crawl",
+            interval=options["profile_interval"],
+        )
+        with profiler:
+            if options["classify"]:
+                # 記事の取得から分類・保存までをパイプラインで同時に進める
+                from crawler.pipeline import crawl_and_classify_all_articles
+
+                configure_rate_controller(rate_config, options["frontier_path"])
+                with profiler.stage("crawl_and_classify"):
+                    crawl_and_classify_all_articles(
+                        url=options["base_url"],
+                        data_root_dir=options["data_root_dir"],
+                        predictions_path=options["predictions_path"],
+                        model_save_path=options["model_save_path"],
+                        label_encoder_save_path=options["label_encoder_save_path"],
+                        vectorizer_save_path=options["vectorizer_save_path"],
+                        queue_size=options["queue_size"],
+                    )
+                return
 
-        # `base_url` に対してページをクローリング & スクレイピングする
-        articles = crawl_all_articles(url=options["base_url"])
+            frontier = CrawlFrontier(
+                db_path=options["frontier_path"],
+                max_attempts=options["max_attempts"],
+                retry_delay=options["retry_delay"],
+                worker_id=f"{socket.gethostname()}-{os.getpid()}",
+                lease_duration=options["lease_duration"],
+            )
 
-        # 上記で得られたデータを `data_root_dir` へ保存する
-        save_articles(articles=articles, data_root_dir=options["data_root_dir"])
+            # `base_url` に対してページをクローリング & スクレイピングし、
+            # 得られたデータを逐次 `data_root_dir` へ保存する
+            try:
+                with profiler.stage("crawl"):
+                    crawl_all_articles_with_frontier(
+                        url=options["base_url"],
+                        frontier=frontier,
+                        data_root_dir=options["data_root_dir"],
+                        resume=options["resume"],
+                        num_workers=options["num_workers"],
+                        rate_config=rate_config,
+                        progress_interval=options["progress_interval"],
+                        profiler=profiler,
+                    )
+            finally:
+                frontier.close()
@@ -0,0 +1,66 @@
+import collections
+import functools
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from crawler.utils import iter_article_file_paths, reextract_article_file
+
+
+def reextract_article_file_safely(article_file_path: pathlib.Path, force: bool) -> str:
+    try:
+        return reextract_article_file(article_file_path, force=force)
+    except Exception as err:
+        print(f"Failed to reextract {article_file_path}: {err!r}")
+        return "failed"
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser: CommandParser) -> None:
+        """
+        `python manage.py reextract` を実行するときのコマンドラインオプション
+        """
+        parser.add_argument(
+            "--data-root-dir",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3] / "data" / "articles",
+            help="クローリングしたときに保存したデータのパスの情報",
+        )
+        parser.add_argument(
+            "--num-workers",
+            type=int,
+            default=os.cpu_count(),
+            help="HTML の解析を並列に行うプロセスの数",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="抽出方法のバージョンや HTML が変わっていない記事も抽出し直す",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        """
+        `python manage.py reextract` を実行したときに呼び出される関数
+
+        クローリング時に保存した HTML からタイトルと本文を抽出し直す。
+        ネットワークには一切アクセスしないため、抽出方法を修正した際に再クローリングは不要
+        """
+        reextract = functools.partial(
+            reextract_article_file_safely, force=options["force"]
+        )
+        # 処理中にファイル名を付け直すため、ディレクトリを走査し終えてから処理する
+        article_file_paths = list(iter_article_file_paths(options["data_root_dir"]))
+
+        counter: collections.Counter = collections.Counter()
+        with ProcessPoolExecutor(max_workers=options["num_workers"]) as executor:
+            for i, status in enumerate(
+                executor.map(reextract, article_file_paths, chunksize=64), start=1
+            ):
+                counter[status] += 1
+                if i % 1000 == 0:
+                    print(f"{i} 件処理しました: {dict(counter)}")
+
+        print(f"再抽出が完了しました: {dict(counter)}")
@@ -0,0 +1,275 @@
+import collections
+import hashlib
+import pathlib
+import random
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+# 記事を保存するディレクトリの直下に置く。カテゴリのディレクトリとは区別される
+MANIFEST_FILE_NAME = "manifest.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS articles (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL UNIQUE,
+    url TEXT NOT NULL,
+    category TEXT NOT NULL,
+    crawled_at REAL NOT NULL,
+    content_length INTEGER NOT NULL,
+    content_hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS articles_category_idx ON articles (category, crawled_at);
+CREATE INDEX IF NOT EXISTS articles_crawled_at_idx ON articles (crawled_at);
+CREATE INDEX IF NOT EXISTS articles_url_idx ON articles (url, category);
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# 全ての記事が manifest に記録されていることを表す metadata のキー
+COMPLETE_KEY = "complete"
+
+# スレッドごとに開いた manifest。SQLite への接続はスレッドをまたいで共有できないため
+thread_local = threading.local()
+
+
+@dataclass
+class ManifestQuery(object):
+    """
+    manifest から記事を選ぶ条件
+
+    - categories: 選ぶカテゴリ。None の場合は全てのカテゴリ
+    - crawled_after / crawled_before: クローリングした時刻 (UNIX 時間) の範囲
+    - per_category: カテゴリごとに選ぶ記事の数の上限
+    - balanced: 全てのカテゴリで記事の数を最も少ないカテゴリに揃える
+    - seed: カテゴリごとに記事を無作為に選ぶ際の乱数のシード
+    """
+
+    categories: Optional[List[str]] = None
+    crawled_after: Optional[float] = None
+    crawled_before: Optional[float] = None
+    per_category: Optional[int] = None
+    balanced: bool = False
+    seed: int = 0
+
+
+def compute_content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def has_article_files(data_root_dir: pathlib.Path) -> bool:
+    """
+    `data_root_dir` のカテゴリのディレクトリに記事のファイルが 1 つでもあるかを返す
+    """
+    if not data_root_dir.is_dir():
+        return False
+    for category_dir_path in data_root_dir.iterdir():
+        if category_dir_path.is_dir() and any(category_dir_path.glob("*.json")):
+            return True
+    return False
+
+
+class CorpusManifest(object):
+    """
+    保存した記事の一覧 (URL, カテゴリ, クローリングした時刻, 本文の長さとハッシュ値, 保存先) を
+    SQLite に記録する。全てのファイルを読まずに記事の数を数えたり、
+    条件に合う記事のファイルだけを読み込んだりできるようにする。
+
+    保存先は記事を保存するディレクトリからの相対パスで記録する。
+
+    manifest は記事を保存・抽出し直すたびに記録されるため、manifest を導入する前に保存した記事は
+    `build_manifest` を実行するまで記録されていない。全ての記事が記録されていることが分かっている場合
+    (`build_manifest` を実行した場合と、記事が 1 件も無いディレクトリに作った場合) のみ
+    `is_complete` が真になる
+    """
+
+    def __init__(self, db_path: pathlib.Path) -> None:
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        # 接続すると manifest のファイルが作られるため、その前に確認する
+        is_new_corpus = not db_path.exists() and not has_article_files(db_path.parent)
+
+        # 複数のスレッド・プロセスから同時に書き込まれるため、
+        # 他の接続が書き込み中の場合はロックが解放されるまで待つ
+        self.conn = sqlite3.connect(str(db_path), isolation_level=None, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        if is_new_corpus:
+            self.mark_complete()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def mark_complete(self) -> None:
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute(
+                "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
+                (COMPLETE_KEY, "1"),
+            )
+
+    def is_complete(self) -> bool:
+        row = self.conn.execute(
+            "SELECT value FROM metadata WHERE key = ?", (COMPLETE_KEY,)
+        ).fetchone()
+        return row is not None
+
+    def record(
+        self,
+        path: str,
+        url: str,
+        category: str,
+        content: str,
+        crawled_at: float,
+    ) -> None:
+        """
+        記事を記録する。同じ保存先の記事が既に記録されている場合は本文の情報を更新し、
+        クローリングした時刻は最初にクローリングした時刻のままにする
+        """
+        self.record_many([(path, url, category, content, crawled_at)])
+
+    def record_many(self, articles: List[Tuple[str, str, str, str, float]]) -> None:
+        """
+        (保存先, URL, カテゴリ, 本文, クローリングした時刻) のリストを 1 つのトランザクションで記録する
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._upsert(articles)
+
+    def _upsert(self, articles: List[Tuple[str, str, str, str, float]]) -> None:
+        self.conn.executemany(
+            "INSERT INTO articles "
+            "(path, url, category, crawled_at, content_length, content_hash) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (path) DO UPDATE SET "
+            "url = excluded.url, category = excluded.category, "
+            "crawled_at = MIN(crawled_at, excluded.crawled_at), "
+            "content_length = excluded.content_length, "
+            "content_hash = excluded.content_hash",
+            [
+                (
+                    path,
+                    url,
+                    category,
+                    crawled_at,
+                    len(content),
+                    compute_content_hash(content),
+                )
+                for path, url, category, content, crawled_at in articles
+            ],
+        )
+
+    def replace(
+        self,
+        old_paths: List[str],
+        path: str,
+        url: str,
+        category: str,
+        content: str,
+        crawled_at: float,
+    ) -> None:
+        """
+        `old_paths` に保存していた記事を `path` に保存し直したことを 1 つのトランザクションで記録する。
+        クローリングした時刻は最も早いものを引き継ぐ
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for old_path in old_paths:
+                row = self.conn.execute(
+                    "SELECT crawled_at FROM articles WHERE path = ?", (old_path,)
+                ).fetchone()
+                if row is not None:
+                    crawled_at = min(crawled_at, row[0])
+            self.conn.executemany(
+                "DELETE FROM articles WHERE path = ?", [(p,) for p in old_paths]
+            )
+            self._upsert([(path, url, category, content, crawled_at)])
+
+    def remove_many(self, paths: List[str]) -> None:
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "DELETE FROM articles WHERE path = ?", [(path,) for path in paths]
+            )
+
+    def paths(self) -> List[str]:
+        return [path for (path,) in self.conn.execute("SELECT path FROM articles")]
+
+    def paths_by_url(self, url: str, category: str) -> List[str]:
+        rows = self.conn.execute(
+            "SELECT path FROM articles WHERE url = ? AND category = ?", (url, category)
+        ).fetchall()
+        return [path for (path,) in rows]
+
+    def count(self) -> int:
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM articles").fetchone()
+        return count
+
+    def counts(self) -> Dict[str, int]:
+        """
+        カテゴリごとの記事の数を返す
+        """
+        rows = self.conn.execute(
+            "SELECT category, COUNT(*) FROM articles GROUP BY category ORDER BY category"
+        ).fetchall()
+        return dict(rows)
+
+    def select(self, query: ManifestQuery) -> List[Tuple[str, str]]:
+        """
+        `query` の条件に合う記事の (保存先, カテゴリ) を返す
+        """
+        conditions = []
+        params: List = []
+        if query.categories is not None:
+            conditions.append(f"category IN ({', '.join('?' * len(query.categories))})")
+            params += query.categories
+        if query.crawled_after is not None:
+            conditions.append("crawled_at >= ?")
+            params.append(query.crawled_after)
+        if query.crawled_before is not None:
+            conditions.append("crawled_at < ?")
+            params.append(query.crawled_before)
+
+        sql = "SELECT path, category FROM articles"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        rows = self.conn.execute(sql + " ORDER BY id", params).fetchall()
+
+        if query.per_category is None and not query.balanced:
+            return rows
+
+        category_to_rows: Dict[str, List[Tuple[str, str]]] = collections.defaultdict(
+            list
+        )
+        for row in rows:
+            category_to_rows[row[1]].append(row)
+
+        num_samples = query.per_category
+        if query.balanced and category_to_rows:
+            min_count = min(
+                len(category_rows) for category_rows in category_to_rows.values()
+            )
+            num_samples = min(num_samples or min_count, min_count)
+
+        rng = random.Random(query.seed)
+        selected = []
+        for category in sorted(category_to_rows):
+            category_rows = category_to_rows[category]
+            if num_samples is not None and len(category_rows) > num_samples:
+                category_rows = rng.sample(category_rows, num_samples)
+            selected += category_rows
+        return selected
+
+
+def get_thread_manifest(data_root_dir: pathlib.Path) -> CorpusManifest:
+    """
+    `data_root_dir` の manifest をこのスレッドで開いて返す。同じスレッドでは接続を使い回す
+    """
+    manifests = thread_local.__dict__.setdefault("manifests", {})
+    db_path = data_root_dir / MANIFEST_FILE_NAME
+    if db_path not in manifests:
+        manifests[db_path] = CorpusManifest(db_path)
+    return manifests[db_path]
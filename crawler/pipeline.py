@@ -0,0 +1,175 @@
+import json
+import logging
+import pathlib
+import queue
+import threading
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, List, Optional, Tuple
+
+from classifier.utils import create_tagger, tokenize_text
+from crawler.utils import (
+    Article,
+    Category,
+    fetch_article_html,
+    get_category_list,
+    iter_category_article_urls,
+    parse_article,
+    save_article,
+)
+from predictor.utils import (
+    get_pos_filter,
+    load_label_encoder,
+    load_model,
+    load_vectorizer,
+    predict_tokenized_category,
+)
+
+logger = logging.getLogger(__name__)
+
+# 上流のステージが全て終わったことを下流のステージに伝えるための目印
+STOP = object()
+
+
+@dataclass
+class Prediction(object):
+    url: str
+    title: str
+    category: str
+    predicted_category: str
+    probability: float
+
+
+def run_stage(
+    func: Callable[[Any], Any],
+    input_queue: queue.Queue,
+    output_queue: Optional[queue.Queue],
+    num_producers: int = 1,
+) -> None:
+    """
+    `input_queue` から取り出したものに `func` を適用して `output_queue` に入れる処理を、
+    上流の全てのステージが終わるまで繰り返す。1 件の失敗でパイプライン全体が止まらないようにする
+    """
+    num_stopped = 0
+    while num_stopped < num_producers:
+        item = input_queue.get()
+        if item is STOP:
+            num_stopped += 1
+            continue
+
+        try:
+            result = func(item)
+        except Exception as err:
+            logger.warning(f"Failed to process {item!r:.100}: {err!r}")
+            continue
+
+        if output_queue is not None:
+            output_queue.put(result)
+
+    if output_queue is not None:
+        output_queue.put(STOP)
+
+
+def fetch_category(category: Category, output_queue: queue.Queue) -> None:
+    try:
+        for article_url in iter_category_article_urls(category):
+            try:
+                html = fetch_article_html(article_url)
+            except Exception as err:
+                logger.warning(f"Failed to fetch {article_url}: {err!r}")
+                continue
+            output_queue.put((html, article_url, category.name))
+    except Exception as err:
+        logger.warning(f"Failed to crawl category {category.name}: {err!r}")
+    finally:
+        output_queue.put(STOP)
+
+
+def crawl_and_classify_all_articles(
+    url: str,
+    data_root_dir: pathlib.Path,
+    predictions_path: pathlib.Path,
+    model_save_path: pathlib.Path,
+    label_encoder_save_path: pathlib.Path,
+    vectorizer_save_path: pathlib.Path,
+    queue_size: int = 64,
+) -> None:
+    """
+    記事の取得 → HTML の解析 → 分かち書き → カテゴリの予測 → 保存 の各ステージを
+    大きさに上限のあるキューでつなぎ、それぞれを別スレッドで同時に進める。
+    予測結果は `predictions_path` に JSON Lines 形式で追記し、
+    サイト上のカテゴリと予測したカテゴリが異なる記事はその場で表示する
+    """
+    model = load_model(model_save_path)
+    label_encoder = load_label_encoder(label_encoder_save_path)
+    vectorizer = load_vectorizer(vectorizer_save_path)
+    pos_filter = get_pos_filter(vectorizer)
+
+    tagger = create_tagger(pos_filter)
+
+    def parse(item: Tuple[str, str, str]) -> Article:
+        return parse_article(*item)
+
+    def tokenize(article: Article) -> Tuple[Article, str]:
+        return article, tokenize_text(tagger, article.content, pos_filter)
+
+    def predict(item: Tuple[Article, str]) -> Tuple[Article, Prediction]:
+        article, tokenized_text = item
+        _, y_pred_label, y_pred_proba = predict_tokenized_category(
+            tokenized_text, model, label_encoder, vectorizer
+        )
+        prediction = Prediction(
+            url=article.url,
+            title=article.title,
+            category=article.category,
+            predicted_category=y_pred_label,
+            probability=float(y_pred_proba),
+        )
+        return article, prediction
+
+    predictions_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(predictions_path, "a") as wf:
+
+        def save(item: Tuple[Article, Prediction]) -> None:
+            article, prediction = item
+            save_article(article, data_root_dir)
+
+            wf.write(json.dumps(asdict(prediction), ensure_ascii=False) + "\n")
+            wf.flush()
+
+            if prediction.category != prediction.predicted_category:
+                print(
+                    f"カテゴリ不一致: {prediction.title} "
+                    f"(サイト: {prediction.category}, "
+                    f"予測: {prediction.predicted_category} {prediction.probability:.3f})"
+                )
+
+        categories = get_category_list(url)
+        assert len(categories) == 8  # カテゴリは現状8個なので
+
+        fetched_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        parsed_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        tokenized_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        predicted_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+
+        # 記事の取得はカテゴリごとにスレッドを分け、同時に行う
+        threads: List[threading.Thread] = [
+            threading.Thread(target=fetch_category, args=(category, fetched_queue))
+            for category in categories
+        ]
+        threads += [
+            threading.Thread(
+                target=run_stage,
+                args=(parse, fetched_queue, parsed_queue, len(categories)),
+            ),
+            threading.Thread(
+                target=run_stage, args=(tokenize, parsed_queue, tokenized_queue)
+            ),
+            threading.Thread(
+                target=run_stage, args=(predict, tokenized_queue, predicted_queue)
+            ),
+            threading.Thread(target=run_stage, args=(save, predicted_queue, None)),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
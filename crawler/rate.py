@@ -0,0 +1,467 @@
+import collections
+import email.utils
+import pathlib
+import sqlite3
+import threading
+import time
+import urllib.robotparser
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, Deque, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+if TYPE_CHECKING:
+    import requests
+
+# 相手のサーバが混雑していることを示すステータスコード
+THROTTLED_STATUS_CODES = (429, 503)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (
+    netloc TEXT PRIMARY KEY,
+    concurrency REAL NOT NULL,
+    crawl_delay REAL NOT NULL DEFAULT 0,
+    last_request_at REAL NOT NULL DEFAULT 0,
+    blocked_until REAL NOT NULL DEFAULT 0,
+    last_decrease_at REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS host_slots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    netloc TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS host_slots_netloc_idx ON host_slots (netloc, expires_at);
+"""
+
+
+@dataclass
+class RateControlConfig(object):
+    """
+    ホストごとの同時リクエスト数を調整する際の設定。
+    同時リクエスト数は同じ SQLite ファイルを使う全ての worker で合計した数を表す
+
+    - initial_concurrency: 同時リクエスト数の初期値
+    - max_concurrency: 同時リクエスト数の上限
+    - latency_factor: 応答時間が基準の何倍を超えたら混雑しているとみなすか。
+      基準は同じ種類のページ (パスの最初の階層が同じ URL) の直近 `latency_window` 件の応答時間の下位 10%
+    - latency_window: 応答時間の基準を計算する際に使う直近の応答の数
+    - decrease_factor: 混雑を検知したときに同時リクエスト数に掛ける値
+    - default_retry_after: `Retry-After` が無い 429/503 を受けたときに待つ時間 (秒)
+    - max_retries: 429/503 を受けたときに同じ URL を再送する回数
+    - timeout: 1 リクエストのタイムアウト (秒)
+    - respect_robots_txt: robots.txt の `Crawl-delay` に従うかどうか
+    - poll_interval: 同時リクエスト数に空きが無いときに、空きを確認し直す間隔 (秒)
+    - heartbeat_interval: リクエストの順番を待っている間に `heartbeat` を呼ぶ間隔 (秒)
+    """
+
+    initial_concurrency: float = 1.0
+    max_concurrency: float = 4.0
+    latency_factor: float = 3.0
+    latency_window: int = 100
+    decrease_factor: float = 0.5
+    default_retry_after: float = 10.0
+    max_retries: int = 3
+    timeout: float = 30.0
+    respect_robots_txt: bool = True
+    poll_interval: float = 0.05
+    heartbeat_interval: float = 5.0
+
+
+@dataclass
+class HostState(object):
+    """
+    この worker プロセスで観測したホストの応答。同時リクエスト数などの制限は `HostLimits` で共有する
+    """
+
+    ewma_latency: Optional[float] = None
+    # ページの種類 (パスの最初の階層) ごとの直近の応答時間。
+    # 一覧ページと記事ページのように応答時間が大きく異なるページを同じ基準で比べないようにする
+    latencies: Dict[str, Deque[float]] = field(default_factory=dict)
+    # 直近のリクエストの (終了時刻, 成功したかどうか)
+    history: Deque[Tuple[float, bool]] = field(
+        default_factory=lambda: collections.deque(maxlen=1000)
+    )
+
+
+@dataclass
+class HostLimit(object):
+    concurrency: float
+    in_flight: int
+    crawl_delay: float
+    blocked_until: float
+
+
+class HostLimits(object):
+    """
+    ホストごとの制限 (同時リクエスト数、robots.txt の `Crawl-delay`、`Retry-After` による停止) を
+    SQLite に保存し、同じファイルを使う全ての worker プロセス・スレッドで共有する。
+    時刻はプロセスをまたいで比べられるよう UNIX 時間で記録する。
+
+    実行中のリクエストは `host_slots` に 1 行ずつ記録する。worker が落ちても枠が埋まったままに
+    ならないよう、各行にはリクエストのタイムアウトから決めた期限を付ける
+    """
+
+    def __init__(self, db_path: pathlib.Path, config: RateControlConfig) -> None:
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.config = config
+
+        self.conn = sqlite3.connect(str(db_path), isolation_level=None, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def register(self, netloc: str, crawl_delay: float) -> None:
+        """
+        ホストを登録する。既に登録されている場合は、前回までに調整した同時リクエスト数を引き継ぐ
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute(
+                "INSERT INTO hosts (netloc, concurrency, crawl_delay) VALUES (?, ?, ?) "
+                "ON CONFLICT (netloc) DO UPDATE SET crawl_delay = excluded.crawl_delay",
+                (netloc, self.config.initial_concurrency, crawl_delay),
+            )
+
+    def try_acquire(self, netloc: str) -> Tuple[Optional[int], float]:
+        """
+        リクエストの枠を確保できた場合はその ID を、できなかった場合は次に確保を試みるまで待つ秒数を返す
+        """
+        now = time.time()
+        with self.conn:
+            # 書き込みロックを先に取得し、他の worker と同じ枠を取り合わないようにする
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute(
+                "DELETE FROM host_slots WHERE netloc = ? AND expires_at <= ?",
+                (netloc, now),
+            )
+            (
+                concurrency,
+                crawl_delay,
+                last_request_at,
+                blocked_until,
+            ) = self.conn.execute(
+                "SELECT concurrency, crawl_delay, last_request_at, blocked_until "
+                "FROM hosts WHERE netloc = ?",
+                (netloc,),
+            ).fetchone()
+
+            wait_until = max(blocked_until, last_request_at + crawl_delay)
+            if now < wait_until:
+                return None, wait_until - now
+
+            (in_flight,) = self.conn.execute(
+                "SELECT COUNT(*) FROM host_slots WHERE netloc = ?", (netloc,)
+            ).fetchone()
+            if in_flight >= int(min(concurrency, self.config.max_concurrency)):
+                return None, self.config.poll_interval
+
+            # requests の timeout は接続と読み込みのそれぞれに掛かるため、その 2 倍を期限とする
+            cursor = self.conn.execute(
+                "INSERT INTO host_slots (netloc, expires_at) VALUES (?, ?)",
+                (netloc, now + self.config.timeout * 2),
+            )
+            self.conn.execute(
+                "UPDATE hosts SET last_request_at = ? WHERE netloc = ?", (now, netloc)
+            )
+        return cursor.lastrowid, 0.0
+
+    def release(
+        self,
+        netloc: str,
+        slot_id: int,
+        congested: bool,
+        retry_after: Optional[float],
+        decrease_interval: float,
+    ) -> None:
+        """
+        リクエストの枠を返し、混雑していなければ同時リクエスト数を増やし、混雑していれば減らす。
+        同じ混雑に対して何度も減らさないよう、`decrease_interval` 秒の間に減らすのは 1 度だけにする
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute("DELETE FROM host_slots WHERE id = ?", (slot_id,))
+            concurrency, last_decrease_at = self.conn.execute(
+                "SELECT concurrency, last_decrease_at FROM hosts WHERE netloc = ?",
+                (netloc,),
+            ).fetchone()
+
+            if not congested:
+                # 同時リクエスト数ぶんの成功でおよそ 1 増える
+                concurrency = min(
+                    concurrency + 1.0 / concurrency, self.config.max_concurrency
+                )
+            elif now - last_decrease_at >= decrease_interval:
+                concurrency = max(concurrency * self.config.decrease_factor, 1.0)
+                last_decrease_at = now
+
+            self.conn.execute(
+                "UPDATE hosts SET concurrency = ?, last_decrease_at = ?, "
+                "blocked_until = MAX(blocked_until, ?) WHERE netloc = ?",
+                (
+                    concurrency,
+                    last_decrease_at,
+                    now + retry_after if retry_after is not None else 0.0,
+                    netloc,
+                ),
+            )
+
+    def get(self, netloc: str) -> HostLimit:
+        (in_flight,) = self.conn.execute(
+            "SELECT COUNT(*) FROM host_slots WHERE netloc = ? AND expires_at > ?",
+            (netloc, time.time()),
+        ).fetchone()
+        concurrency, crawl_delay, blocked_until = self.conn.execute(
+            "SELECT concurrency, crawl_delay, blocked_until FROM hosts WHERE netloc = ?",
+            (netloc,),
+        ).fetchone()
+        return HostLimit(
+            concurrency=concurrency,
+            in_flight=in_flight,
+            crawl_delay=crawl_delay,
+            blocked_until=blocked_until,
+        )
+
+
+class AdaptiveRateController(object):
+    """
+    観測した応答時間とエラーをもとに、ホストごとの同時リクエスト数を AIMD
+    (Additive Increase / Multiplicative Decrease) で調整する。
+
+    - 応答が速いうちは同時リクエスト数を少しずつ増やす
+    - 応答が遅くなったり 429/503 を受けたりしたら同時リクエスト数を半分にする
+    - `Retry-After` を受けたらその時間はホストへのリクエストを止める
+    - robots.txt の `Crawl-delay` よりも短い間隔ではリクエストしない
+
+    これらの制限は `db_path` の SQLite で全ての worker プロセスと共有するため、
+    worker を増やしてもホストへのリクエストの速度は 1 つの worker の場合と同じ範囲に収まる
+    """
+
+    def __init__(
+        self, db_path: pathlib.Path, config: Optional[RateControlConfig] = None
+    ) -> None:
+        self.db_path = db_path
+        self.config = config or RateControlConfig()
+        self.hosts: Dict[str, HostState] = {}
+        self.lock = threading.Lock()
+        # SQLite への接続はスレッドをまたいで共有できないため、スレッドごとに開く
+        self.thread_local = threading.local()
+
+    def limits(self) -> HostLimits:
+        if not hasattr(self.thread_local, "limits"):
+            self.thread_local.limits = HostLimits(self.db_path, self.config)
+        return self.thread_local.limits
+
+    def get(
+        self, url: str, heartbeat: Optional[Callable[[], None]] = None
+    ) -> "requests.Response":
+        """
+        `heartbeat` を渡した場合、各リクエストの前と、順番を待っている間に
+        `heartbeat_interval` 秒ごとに呼ぶ (frontier の貸し出しの期限を延ばすために使う)
+        """
+        import requests
+
+        netloc = urlsplit(url).netloc
+        host = self._host_state(url)
+        route = get_route(url)
+        for _ in range(self.config.max_retries + 1):
+            slot_id = self._acquire(netloc, heartbeat)
+
+            start_time = time.monotonic()
+            try:
+                res = requests.get(url, timeout=self.config.timeout)
+            except requests.RequestException:
+                self._release(host, netloc, route, slot_id, latency=None)
+                raise
+
+            latency = time.monotonic() - start_time
+            if res.status_code not in THROTTLED_STATUS_CODES:
+                self._release(host, netloc, route, slot_id, latency=latency)
+                return res
+
+            retry_after = parse_retry_after(res.headers.get("Retry-After"))
+            if retry_after is None:
+                retry_after = self.config.default_retry_after
+            self._release(
+                host, netloc, route, slot_id, latency=None, retry_after=retry_after
+            )
+
+        # 再送しても混雑が解消しない場合はそのままレスポンスを返し、呼び出し元に任せる
+        return res
+
+    def _host_state(self, url: str) -> HostState:
+        scheme, netloc, *_ = urlsplit(url)
+        with self.lock:
+            if netloc in self.hosts:
+                return self.hosts[netloc]
+
+        crawl_delay = 0.0
+        if self.config.respect_robots_txt:
+            crawl_delay = fetch_crawl_delay(
+                f"{scheme}://{netloc}/robots.txt", timeout=self.config.timeout
+            )
+        self.limits().register(netloc, crawl_delay)
+
+        with self.lock:
+            # 他のスレッドが先に登録していた場合はそちらを使う
+            return self.hosts.setdefault(netloc, HostState())
+
+    def _acquire(
+        self, netloc: str, heartbeat: Optional[Callable[[], None]] = None
+    ) -> int:
+        last_heartbeat_at = -float("inf")
+        # 他の worker プロセスが枠を返しても通知は届かないため、空きが出るまで一定間隔で確認する
+        while True:
+            if (
+                heartbeat is not None
+                and time.monotonic() - last_heartbeat_at
+                >= self.config.heartbeat_interval
+            ):
+                heartbeat()
+                last_heartbeat_at = time.monotonic()
+
+            slot_id, wait_time = self.limits().try_acquire(netloc)
+            if slot_id is not None:
+                return slot_id
+            time.sleep(min(wait_time, self.config.heartbeat_interval))
+
+    def _release(
+        self,
+        host: HostState,
+        netloc: str,
+        route: str,
+        slot_id: int,
+        latency: Optional[float],
+        retry_after: Optional[float] = None,
+    ) -> None:
+        with self.lock:
+            host.history.append((time.monotonic(), latency is not None))
+
+            # エラーや 429/503 を受けた場合は混雑しているとみなす
+            congested = True
+            if latency is not None:
+                if host.ewma_latency is None:
+                    host.ewma_latency = latency
+                host.ewma_latency = 0.8 * host.ewma_latency + 0.2 * latency
+
+                # 全期間の最小値を基準にすると、1 度だけ極端に速い応答があった場合に
+                # 以降の全ての応答が遅いとみなされるため、直近の応答時間の下位 10% を基準にする
+                latencies = host.latencies.setdefault(
+                    route, collections.deque(maxlen=self.config.latency_window)
+                )
+                latencies.append(latency)
+                baseline_latency = sorted(latencies)[len(latencies) // 10]
+                congested = latency > baseline_latency * self.config.latency_factor
+
+            decrease_interval = host.ewma_latency or 0.0
+
+        self.limits().release(
+            netloc,
+            slot_id,
+            congested=congested,
+            retry_after=retry_after,
+            decrease_interval=decrease_interval,
+        )
+
+    def report(self, window: float = 10.0) -> str:
+        """
+        ホストごとの現在の同時リクエスト数 (全ての worker の合計) と、
+        この worker の直近 `window` 秒間のリクエスト数とエラー率などを返す
+        """
+        with self.lock:
+            hosts = dict(self.hosts)
+
+        now = time.monotonic()
+        lines = []
+        for netloc, host in hosts.items():
+            limit = self.limits().get(netloc)
+            recent = [ok for t, ok in host.history if now - t <= window]
+            num_errors = recent.count(False)
+            error_rate = num_errors / len(recent) if recent else 0.0
+            line = (
+                f"{netloc}: 同時リクエスト数 {limit.in_flight}/{int(limit.concurrency)}, "
+                f"{len(recent) / window:.2f} req/s, "
+                f"エラー率 {error_rate:.1%}, "
+                f"応答時間 {(host.ewma_latency or 0.0) * 1000:.0f} ms, "
+                f"Crawl-delay {limit.crawl_delay:.1f} s"
+            )
+            if limit.blocked_until > time.time():
+                line += f", 停止中 (残り {limit.blocked_until - time.time():.1f} s)"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+def get_route(url: str) -> str:
+    """
+    URL のパスの最初の階層を返す (例: `https://gunosy.com/articles/abc` → `articles`)
+    """
+    return urlsplit(url).path.lstrip("/").split("/", 1)[0]
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    `Retry-After` ヘッダの値 (秒数もしくは HTTP-date) を待つべき秒数に変換する
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+def fetch_crawl_delay(robots_txt_url: str, timeout: float) -> float:
+    import requests
+
+    try:
+        res = requests.get(robots_txt_url, timeout=timeout)
+    except requests.RequestException:
+        return 0.0
+    if res.status_code != 200:
+        return 0.0
+
+    parser = urllib.robotparser.RobotFileParser()
+    parser.parse(res.text.splitlines())
+
+    crawl_delay = parse_crawl_delay(res.text)
+    request_rate = parser.request_rate("*")
+    if request_rate is not None:
+        crawl_delay = max(crawl_delay, request_rate.seconds / request_rate.requests)
+    return crawl_delay
+
+
+def parse_crawl_delay(robots_txt: str) -> float:
+    """
+    全てのクローラ (`User-agent: *`) に対する `Crawl-delay` (秒) を返す。
+    `urllib.robotparser` は整数の値しか読まず `Crawl-delay: 0.5` を無視するため、小数も読めるよう自前で解釈する
+    """
+    crawl_delay = 0.0
+    user_agents: List[str] = []
+    in_rules = False
+    for line in robots_txt.splitlines():
+        key, sep, value = line.split("#", 1)[0].partition(":")
+        if not sep:
+            continue
+        key, value = key.strip().lower(), value.strip()
+
+        if key == "user-agent":
+            # 規則の後に現れた User-agent から新しいグループが始まる
+            if in_rules:
+                user_agents, in_rules = [], False
+            user_agents.append(value)
+            continue
+
+        in_rules = True
+        if key == "crawl-delay" and "*" in user_agents:
+            try:
+                crawl_delay = max(crawl_delay, float(value))
+            except ValueError:
+                pass
+    return crawl_delay
@@ -1,3 +1,645 @@
-from django.test import TestCase
+import email.utils
+import hashlib
+import http.server
+import json
+import math
+import pathlib
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
 
-# Create your tests here.
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase
+
+from crawler.frontier import (
+    ARTICLE,
+    DONE,
+    FAILED,
+    LEASED,
+    LISTING,
+    PENDING,
+    CrawlFrontier,
+    LeaseLostError,
+)
+from crawler.manifest import get_thread_manifest, thread_local
+from crawler.pipeline import crawl_and_classify_all_articles
+from crawler.rate import (
+    AdaptiveRateController,
+    RateControlConfig,
+    parse_crawl_delay,
+    parse_retry_after,
+)
+from crawler.utils import (
+    Article,
+    Category,
+    compute_html_hash,
+    get_article_file_name,
+    reextract_article_file,
+    save_article,
+)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    応答時間や 429 を注入できるスタブサーバ
+
+    - `/robots.txt`: `server.robots_txt` を返す
+    - `/sleep/<秒数>`: 指定した秒数だけ待ってから 200 を返す
+    - `/throttle/<key>?retry_after=<値>`: key ごとに最初の 1 回だけ `Retry-After: <値>` 付きの 429 を返す
+    """
+
+    server: "StubServer"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        self.server.record(url.path)
+
+        if url.path == "/robots.txt":
+            return self.send_body(200, self.server.robots_txt)
+
+        _, kind, value = url.path.split("/", 2)
+        if kind == "sleep":
+            time.sleep(float(value))
+            return self.send_body(200, "ok")
+
+        if kind == "throttle" and self.server.throttle_once(value):
+            retry_after = parse_qs(url.query)["retry_after"][0]
+            return self.send_body(429, "throttled", {"Retry-After": retry_after})
+        return self.send_body(200, "ok")
+
+    def send_body(
+        self, status_code: int, body: str, headers: Optional[Dict[str, str]] = None
+    ) -> None:
+        encoded = body.encode()
+        self.send_response(status_code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.lock = threading.Lock()
+        self.robots_txt = ""
+        # (パス, リクエストを受けた時刻) のリスト
+        self.requests: List[Tuple[str, float]] = []
+        self.throttled_keys: set = set()
+
+    def record(self, path: str) -> None:
+        with self.lock:
+            self.requests.append((path, time.time()))
+
+    def throttle_once(self, key: str) -> bool:
+        with self.lock:
+            if key in self.throttled_keys:
+                return False
+            self.throttled_keys.add(key)
+            return True
+
+    def request_times(self, path_prefix: str) -> List[float]:
+        with self.lock:
+            return [t for path, t in self.requests if path.startswith(path_prefix)]
+
+
+class AdaptiveRateControllerTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.server = StubServer()
+        cls.server_thread = threading.Thread(
+            target=cls.server.serve_forever, daemon=True
+        )
+        cls.server_thread.start()
+        host, port = cls.server.server_address[:2]
+        cls.netloc = f"{host}:{port}"
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self) -> None:
+        self.server.robots_txt = ""
+        self.server.requests.clear()
+        self.server.throttled_keys.clear()
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.db_path = pathlib.Path(tmp_dir.name) / "frontier.sqlite3"
+
+    def build_controller(self, **kwargs) -> AdaptiveRateController:
+        config = RateControlConfig(**{"respect_robots_txt": False, **kwargs})
+        return AdaptiveRateController(self.db_path, config)
+
+    def url(self, path: str) -> str:
+        return f"http://{self.netloc}{path}"
+
+    def test_increase_concurrency_on_fast_responses(self):
+        controller = self.build_controller(initial_concurrency=1.0, max_concurrency=4.0)
+        for _ in range(20):
+            controller.get(self.url("/sleep/0"))
+
+        self.assertEqual(controller.limits().get(self.netloc).concurrency, 4.0)
+
+    def test_decrease_concurrency_on_slow_response(self):
+        controller = self.build_controller(initial_concurrency=4.0, max_concurrency=4.0)
+        for _ in range(10):
+            controller.get(self.url("/sleep/0.01"))
+        self.assertEqual(controller.limits().get(self.netloc).concurrency, 4.0)
+
+        controller.get(self.url("/sleep/0.3"))
+        self.assertEqual(controller.limits().get(self.netloc).concurrency, 2.0)
+
+    def test_decrease_concurrency_on_429(self):
+        controller = self.build_controller(initial_concurrency=4.0, max_concurrency=4.0)
+        res = controller.get(self.url("/throttle/a?retry_after=0"))
+
+        self.assertEqual(res.status_code, 200)
+        # 429 で半分になり、再送の成功で 1 / 2 増える
+        self.assertEqual(controller.limits().get(self.netloc).concurrency, 2.5)
+
+    def test_keep_concurrency_after_single_fast_response(self):
+        controller = self.build_controller(initial_concurrency=4.0, max_concurrency=4.0)
+        controller.get(self.url("/sleep/0"))
+        for _ in range(20):
+            controller.get(self.url("/sleep/0.05"))
+
+        self.assertEqual(controller.limits().get(self.netloc).concurrency, 4.0)
+
+    def test_retry_after_seconds(self):
+        controller = self.build_controller()
+        res = controller.get(self.url("/throttle/b?retry_after=1"))
+
+        self.assertEqual(res.status_code, 200)
+        first, second = self.server.request_times("/throttle/b")
+        self.assertGreaterEqual(second - first, 1.0)
+
+    def test_retry_after_http_date(self):
+        controller = self.build_controller()
+        # HTTP-date は秒未満を切り捨てるため、切り捨てで変わらない整数の時刻を指定する
+        retry_at = math.ceil(time.time()) + 2
+        retry_at_date = email.utils.formatdate(retry_at, usegmt=True)
+        res = controller.get(
+            self.url(f"/throttle/c?retry_after={retry_at_date.replace(' ', '%20')}")
+        )
+
+        self.assertEqual(res.status_code, 200)
+        first, second = self.server.request_times("/throttle/c")
+        # 再送は指定した時刻より前には届かない (時刻の丸め誤差の分だけ余裕を持たせる)
+        self.assertGreaterEqual(second, retry_at - 0.01)
+        self.assertGreater(second - first, 1.0)
+
+    def test_retry_after_is_shared_between_workers(self):
+        # 同じ SQLite を使う 2 つの controller は、別々の worker プロセスに相当する
+        controller = self.build_controller(max_retries=0)
+        other_controller = self.build_controller()
+
+        res = controller.get(self.url("/throttle/d?retry_after=1"))
+        self.assertEqual(res.status_code, 429)
+
+        start_time = time.time()
+        other_controller.get(self.url("/sleep/0"))
+        self.assertGreaterEqual(time.time() - start_time, 0.9)
+
+    def test_crawl_delay_spacing(self):
+        self.server.robots_txt = "User-agent: *\nCrawl-delay: 0.3\n"
+        # 2 つの worker がそれぞれ 4 スレッドでリクエストしても、間隔は Crawl-delay 以上になる
+        controllers = [
+            self.build_controller(
+                respect_robots_txt=True, initial_concurrency=4.0, max_concurrency=4.0
+            )
+            for _ in range(2)
+        ]
+        threads = [
+            threading.Thread(target=controller.get, args=(self.url("/sleep/0"),))
+            for controller in controllers
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        request_times = sorted(self.server.request_times("/sleep/"))
+        self.assertEqual(len(request_times), 8)
+        for previous, current in zip(request_times, request_times[1:]):
+            self.assertGreaterEqual(current - previous, 0.29)
+
+    def test_concurrency_is_shared_between_workers(self):
+        controllers = [
+            self.build_controller(initial_concurrency=2.0, max_concurrency=2.0)
+            for _ in range(2)
+        ]
+        threads = [
+            threading.Thread(target=controller.get, args=(self.url("/sleep/0.2"),))
+            for controller in controllers
+            for _ in range(3)
+        ]
+        start_time = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # 6 リクエストを同時に 2 つまでしか送らないため、0.2 秒ずつ 3 回に分かれる
+        self.assertGreaterEqual(time.time() - start_time, 0.6)
+
+
+class ParseRetryAfterTest(SimpleTestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after("120"), 120.0)
+
+    def test_http_date(self):
+        retry_at = email.utils.formatdate(time.time() + 60, usegmt=True)
+        self.assertAlmostEqual(parse_retry_after(retry_at), 60.0, delta=1.5)
+
+    def test_invalid(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after("soon"))
+
+
+class ParseCrawlDelayTest(SimpleTestCase):
+    def test_fractional_crawl_delay(self):
+        self.assertEqual(parse_crawl_delay("User-agent: *\nCrawl-delay: 0.5\n"), 0.5)
+
+    def test_only_wildcard_group(self):
+        robots_txt = (
+            "User-agent: foo\n"
+            "Crawl-delay: 10\n"
+            "\n"
+            "User-agent: *\n"
+            "Disallow: /private\n"
+            "Crawl-delay: 2 # comment\n"
+        )
+        self.assertEqual(parse_crawl_delay(robots_txt), 2.0)
+
+
+class CrawlFrontierTest(SimpleTestCase):
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.db_path = pathlib.Path(tmp_dir.name) / "frontier.sqlite3"
+
+        # 貸し出しの期限を待たずに確認できるよう、frontier が参照する時刻を差し替える
+        self.now = 1000.0
+        patcher = mock.patch("crawler.frontier.time.time", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.frontier = self.build_frontier("worker-a")
+        self.frontier.add_category(name="国内", url="https://example.com/categories/1")
+        # 一覧ページは使わず、記事の URL だけで確認する
+        self.frontier.conn.execute("DELETE FROM pages")
+        self.frontier.conn.execute(
+            "INSERT INTO pages (url, kind, category) VALUES (?, ?, ?)",
+            ("https://example.com/articles/1", ARTICLE, "国内"),
+        )
+
+    def build_frontier(self, worker_id: str) -> CrawlFrontier:
+        frontier = CrawlFrontier(
+            db_path=self.db_path,
+            max_attempts=3,
+            retry_delay=10.0,
+            worker_id=worker_id,
+            lease_duration=60.0,
+        )
+        self.addCleanup(frontier.close)
+        return frontier
+
+    def status(self) -> Tuple[str, int]:
+        return self.frontier.conn.execute(
+            "SELECT status, attempts FROM pages WHERE url = ?",
+            ("https://example.com/articles/1",),
+        ).fetchone()
+
+    def test_lease_is_exclusive(self):
+        other = self.build_frontier("worker-b")
+
+        item = self.frontier.lease()
+        self.assertIsNotNone(item)
+        self.assertIsNone(other.lease())
+        self.assertEqual(self.status(), (LEASED, 0))
+
+    def test_renew_extends_lease(self):
+        other = self.build_frontier("worker-b")
+        item = self.frontier.lease()
+
+        self.now += 50
+        self.frontier.renew(item)
+        self.now += 50
+        # 最初の期限 (60 秒後) は過ぎたが、延ばした期限の前なので貸し出されない
+        self.assertIsNone(other.lease())
+
+        self.frontier.complete_article(item)
+        self.assertEqual(self.status(), (DONE, 0))
+
+    def test_expired_lease_counts_as_attempt(self):
+        other = self.build_frontier("worker-b")
+        item = self.frontier.lease()
+
+        self.now += 61
+        # 期限切れは失敗 1 回として数え、再試行までの待ち時間が過ぎるまで貸し出さない
+        self.assertIsNone(other.lease())
+        self.assertEqual(self.status(), (PENDING, 1))
+
+        self.now += 10
+        other_item = other.lease()
+        self.assertIsNotNone(other_item)
+        self.assertEqual(other_item.attempts, 1)
+
+        # 期限が切れた worker は期限を延ばせず、取得済みとして記録もできない
+        with self.assertRaises(LeaseLostError):
+            self.frontier.renew(item)
+        self.frontier.complete_article(item)
+        self.assertEqual(self.status(), (LEASED, 1))
+
+    def test_repeatedly_expired_url_gives_up(self):
+        # worker を落とし続ける URL でも、`max_attempts` 回でクローリングが終わる
+        for attempts in range(1, 3):
+            self.assertIsNotNone(self.frontier.lease())
+            self.now += 61
+            self.assertIsNone(self.frontier.lease())
+            self.assertEqual(self.status(), (PENDING, attempts))
+            self.now += 10 * 2 ** (attempts - 1)
+
+        self.assertIsNotNone(self.frontier.lease())
+        self.now += 61
+        self.assertIsNone(self.frontier.lease())
+        self.assertEqual(self.status(), (FAILED, 3))
+        self.assertIsNone(self.frontier.next_retry_at())
+
+    def test_complete_twice(self):
+        item = self.frontier.lease()
+        self.frontier.complete_article(item)
+        self.frontier.complete_article(item)
+
+        self.assertEqual(self.status(), (DONE, 0))
+        self.assertIsNone(self.frontier.lease())
+        self.assertIsNone(self.frontier.next_retry_at())
+
+    def test_fail_retries_with_backoff(self):
+        item = self.frontier.lease()
+        self.frontier.fail(item, RuntimeError("boom"))
+        self.assertEqual(self.status(), (PENDING, 1))
+
+        self.now += 9
+        self.assertIsNone(self.frontier.lease())
+        self.now += 1
+        item = self.frontier.lease()
+        self.assertEqual(item.attempts, 1)
+
+    def test_lease_articles_before_listings(self):
+        self.frontier.conn.execute(
+            "INSERT INTO pages (url, kind, category) VALUES (?, ?, ?)",
+            ("https://example.com/categories/1?page=2", LISTING, "国内"),
+        )
+        self.frontier.conn.execute(
+            "INSERT INTO pages (url, kind, category) VALUES (?, ?, ?)",
+            ("https://example.com/articles/2", ARTICLE, "国内"),
+        )
+
+        kinds_and_urls = []
+        while (item := self.frontier.lease()) is not None:
+            kinds_and_urls.append((item.kind, item.url))
+        self.assertEqual(
+            kinds_and_urls,
+            [
+                (ARTICLE, "https://example.com/articles/1"),
+                (ARTICLE, "https://example.com/articles/2"),
+                (LISTING, "https://example.com/categories/1?page=2"),
+            ],
+        )
+
+    def test_lease_does_not_sort_pending_urls(self) -> None:
+        # 未取得の URL 全体を並べ替えると、書き込みロックを持つ時間が URL の数に比例して延びる
+        statements: List[str] = []
+        self.frontier.conn.set_trace_callback(statements.append)
+        self.frontier.lease()
+        self.frontier.conn.set_trace_callback(None)
+
+        select_statements = [
+            statement
+            for statement in statements
+            if statement.startswith("SELECT url, kind")
+        ]
+        self.assertTrue(select_statements)
+        for statement in select_statements:
+            plan = self.frontier.conn.execute(
+                f"EXPLAIN QUERY PLAN {statement}"
+            ).fetchall()
+            details = " ".join(row[-1] for row in plan)
+            self.assertIn("pages_pending_idx", details)
+            self.assertNotIn("TEMP B-TREE", details)
+
+
+class ArticleFileTest(SimpleTestCase):
+    url = "https://example.com/articles/1"
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.data_root_dir = pathlib.Path(tmp_dir.name)
+        self.manifest = get_thread_manifest(self.data_root_dir)
+        self.addCleanup(self.close_manifest)
+
+    def close_manifest(self) -> None:
+        thread_local.manifests.pop(self.manifest.db_path).close()
+
+    def build_article(self, title: str) -> Article:
+        html = f'<h1>{title}</h1><div class="article"><p>本文</p></div>'
+        return Article(
+            html=html,
+            title=title,
+            content="本文",
+            category="国内",
+            url=self.url,
+            html_hash=compute_html_hash(html),
+        )
+
+    def saved_paths(self) -> List[str]:
+        return sorted(
+            str(path.relative_to(self.data_root_dir))
+            for path in self.data_root_dir.glob("*/*.json")
+        )
+
+    def test_save_same_url_with_new_title(self):
+        save_article(self.build_article("旧タイトル"), self.data_root_dir)
+        save_article(self.build_article("新タイトル"), self.data_root_dir)
+
+        path = f"国内/{get_article_file_name(self.url, '新タイトル')}"
+        self.assertEqual(self.saved_paths(), [path])
+        self.assertEqual(self.manifest.paths(), [path])
+
+    def test_save_replaces_file_named_by_title(self):
+        # タイトルのハッシュ値を名前にしていた頃に保存した記事
+        article = self.build_article("タイトル")
+        title_hash = hashlib.md5(article.title.encode()).hexdigest()
+        old_path = f"国内/{title_hash}.json"
+        (self.data_root_dir / "国内").mkdir()
+        (self.data_root_dir / old_path).write_text("{}")
+        self.manifest.record(old_path, self.url, "国内", "本文", crawled_at=1.0)
+
+        save_article(article, self.data_root_dir)
+
+        path = f"国内/{get_article_file_name(self.url, 'タイトル')}"
+        self.assertEqual(self.saved_paths(), [path])
+        self.assertEqual(self.manifest.paths(), [path])
+        # 最初にクローリングした時刻を引き継ぐ
+        (crawled_at,) = self.manifest.conn.execute(
+            "SELECT crawled_at FROM articles WHERE path = ?", (path,)
+        ).fetchone()
+        self.assertEqual(crawled_at, 1.0)
+
+    def test_reextract_renames_file_named_by_title(self):
+        article = self.build_article("新タイトル")
+        article.extractor_version = 0
+        title_hash = hashlib.md5("旧タイトル".encode()).hexdigest()
+        old_file_path = self.data_root_dir / "国内" / f"{title_hash}.json"
+        old_file_path.parent.mkdir()
+        old_file_path.write_text(json.dumps(article.__dict__, ensure_ascii=False))
+        self.manifest.record(
+            str(old_file_path.relative_to(self.data_root_dir)),
+            self.url,
+            "国内",
+            "本文",
+            crawled_at=1.0,
+        )
+
+        self.assertEqual(reextract_article_file(old_file_path), "updated")
+
+        path = f"国内/{get_article_file_name(self.url, '新タイトル')}"
+        self.assertEqual(self.saved_paths(), [path])
+        self.assertEqual(self.manifest.paths(), [path])
+        # 名前を付け直した後は抽出し直す必要も名前を付け直す必要もない
+        file_path = self.data_root_dir / path
+        self.assertEqual(reextract_article_file(file_path), "skipped")
+
+        # 同じ URL の記事をクローリングし直しても重複しない
+        save_article(self.build_article("新タイトル"), self.data_root_dir)
+        self.assertEqual(self.saved_paths(), [path])
+
+
+class CrawlAndClassifyPipelineTest(SimpleTestCase):
+    num_articles_per_category = 5
+    failing_url = "https://example.com/categories/3/articles/2"
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.data_root_dir = pathlib.Path(tmp_dir.name) / "articles"
+        self.predictions_path = pathlib.Path(tmp_dir.name) / "predictions.jsonl"
+
+        self.categories = [
+            Category(url=f"https://example.com/categories/{i}", name=f"カテゴリ{i}")
+            for i in range(8)
+        ]
+        self.predicted_texts: List[str] = []
+        self.lock = threading.Lock()
+
+        # ネットワークと学習済みのモデルの代わりに、記事の URL を本文とするスタブを使う
+        patchers = [
+            mock.patch(
+                "crawler.pipeline.get_category_list", return_value=self.categories
+            ),
+            mock.patch(
+                "crawler.pipeline.iter_category_article_urls",
+                side_effect=self.iter_category_article_urls,
+            ),
+            mock.patch(
+                "crawler.pipeline.fetch_article_html",
+                side_effect=self.fetch_article_html,
+            ),
+            mock.patch(
+                "crawler.pipeline.predict_tokenized_category",
+                side_effect=self.predict_tokenized_category,
+            ),
+            mock.patch("crawler.pipeline.load_model"),
+            mock.patch("crawler.pipeline.load_label_encoder"),
+            mock.patch("crawler.pipeline.load_vectorizer"),
+            mock.patch("crawler.pipeline.get_pos_filter", return_value=None),
+            mock.patch("crawler.pipeline.create_tagger", return_value=None),
+            mock.patch(
+                "crawler.pipeline.tokenize_text",
+                side_effect=lambda tagger, text, pos_filter: text,
+            ),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def iter_category_article_urls(self, category: Category) -> List[str]:
+        return [
+            f"{category.url}/articles/{j}"
+            for j in range(self.num_articles_per_category)
+        ]
+
+    def fetch_article_html(self, article_url: str) -> str:
+        if article_url == self.failing_url:
+            raise RuntimeError("boom")
+        return (
+            f"<h1>{article_url}</h1>" f'<div class="article"><p>{article_url}</p></div>'
+        )
+
+    def predict_tokenized_category(
+        self, tokenized_text, model, label_encoder, vectorizer
+    ):
+        with self.lock:
+            self.predicted_texts.append(tokenized_text)
+        # カテゴリ0 の記事だけ予測が一致する
+        return 0, "カテゴリ0", 0.9
+
+    def test_every_article_is_saved_and_classified_once(self):
+        crawl_and_classify_all_articles(
+            url="https://example.com",
+            data_root_dir=self.data_root_dir,
+            predictions_path=self.predictions_path,
+            model_save_path=pathlib.Path("model.joblib"),
+            label_encoder_save_path=pathlib.Path("label-encoder.joblib"),
+            vectorizer_save_path=pathlib.Path("vectorizer.joblib"),
+            queue_size=2,
+        )
+
+        expected_urls = {
+            url
+            for category in self.categories
+            for url in self.iter_category_article_urls(category)
+        } - {self.failing_url}
+
+        self.assertEqual(sorted(self.predicted_texts), sorted(expected_urls))
+
+        with open(self.predictions_path, "r") as rf:
+            predictions = [json.loads(line) for line in rf]
+        self.assertEqual(
+            sorted(prediction["url"] for prediction in predictions),
+            sorted(expected_urls),
+        )
+
+        saved_urls = []
+        for file_path in self.data_root_dir.glob("*/*.json"):
+            with open(file_path, "r") as rf:
+                article_dict = json.load(rf)
+            self.assertEqual(article_dict["title"], article_dict["url"])
+            self.assertEqual(file_path.parent.name, article_dict["category"])
+            saved_urls.append(article_dict["url"])
+        self.assertEqual(sorted(saved_urls), sorted(expected_urls))
+
+    def test_frontier_options_are_rejected(self):
+        for option in [
+            dict(resume=True),
+            dict(num_workers=4),
+            dict(max_attempts=5),
+            dict(lease_duration=120.0),
+        ]:
+            with self.assertRaises(CommandError):
+                call_command("crawl", classify=True, **option)
@@ -1,16 +1,38 @@
+from __future__ import annotations
+
+import functools
 import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import pathlib
+import socket
+import tempfile
+import threading
+import time
 from dataclasses import asdict, dataclass
-from typing import Iterator, List, Optional
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional
+
+from crawler.frontier import LISTING, CrawlFrontier, FrontierItem, LeaseLostError
+from crawler.manifest import CorpusManifest, get_thread_manifest
+from crawler.rate import AdaptiveRateController, RateControlConfig
+from newspaper_classifier.profiling import Profiler
 
-import requests
-from bs4 import BeautifulSoup
+# requests や BeautifulSoup は実際に HTTP リクエストや HTML の解析を行う関数の中で import する
+if TYPE_CHECKING:
+    import requests
+    from bs4 import BeautifulSoup
 
 logger = logging.getLogger(__name__)
 
+# クローリング中に用いる、ホストごとのリクエストの速度を調整する controller
+rate_controller: Optional[AdaptiveRateController] = None
+
+# `scrape_article_title` や `scrape_article_content` の抽出方法を変更したら 1 つ上げる。
+# `manage.py reextract` はこの値が古い記事のみ、保存済みの HTML から抽出し直す
+EXTRACTOR_VERSION = 1
+
 
 @dataclass
 class Article(object):
@@ -18,6 +40,9 @@ class Article(object):
     title: str
     content: str
     category: str
+    url: str = ""
+    html_hash: str = ""
+    extractor_version: int = 0
 
 
 @dataclass
@@ -26,8 +51,37 @@ class Category(object):
     name: str
 
 
+def configure_rate_controller(
+    config: RateControlConfig, db_path: pathlib.Path
+) -> AdaptiveRateController:
+    """
+    ホストごとの制限は `db_path` の SQLite に保存し、同じファイルを使う全ての worker で共有する
+    """
+    global rate_controller
+    rate_controller = AdaptiveRateController(db_path, config)
+    return rate_controller
+
+
+def http_get(
+    url: str, heartbeat: Optional[Callable[[], None]] = None
+) -> requests.Response:
+    """
+    `rate_controller` が設定されている場合はそれを通して、そうでない場合はそのまま GET する。
+    `heartbeat` はリクエストの前や順番を待っている間に呼ばれる
+    """
+    import requests
+
+    if rate_controller is None:
+        if heartbeat is not None:
+            heartbeat()
+        return requests.get(url)
+    return rate_controller.get(url, heartbeat=heartbeat)
+
+
 def get_category_list(url: str) -> List[Category]:
-    res = requests.get(url)
+    from bs4 import BeautifulSoup
+
+    res = http_get(url)
     soup = BeautifulSoup(res.text, "html.parser")
 
     nav_tag = soup.find("nav", class_="nav")
@@ -49,9 +103,14 @@ def get_category_list(url: str) -> List[Category]:
 
 
 def get_article_url_list_from_article_list(category_url: str) -> List[str]:
-    res = requests.get(category_url)
+    from bs4 import BeautifulSoup
+
+    res = http_get(category_url)
     soup = BeautifulSoup(res.text, "html.parser")
+    return scrape_article_url_list(soup)
+
 
+def scrape_article_url_list(soup: BeautifulSoup) -> List[str]:
     div_article_list_tag = soup.find("div", class_="article_list")
     div_list_content_tags = div_article_list_tag.find_all("div", class_="list_content")
 
@@ -82,25 +141,53 @@ def scrape_article_content(soup: BeautifulSoup) -> str:
     return article_content
 
 
-def scrape_article(article_url: str, category_name: str) -> Article:
+def compute_html_hash(html: str) -> str:
+    return hashlib.sha256(html.encode()).hexdigest()
+
+
+def fetch_article_html(
+    article_url: str, heartbeat: Optional[Callable[[], None]] = None
+) -> str:
     print(f"現在の URL: {article_url}")
 
-    res = requests.get(article_url)
-    soup = BeautifulSoup(res.text, "html.parser")
+    res = http_get(article_url, heartbeat=heartbeat)
+    res.raise_for_status()
+    return res.text
+
+
+def parse_article(html: str, article_url: str, category_name: str) -> Article:
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html.parser")
 
     article = Article(
-        html=res.text,
+        html=html,
         title=scrape_article_title(soup),
         content=scrape_article_content(soup),
         category=category_name,
+        url=article_url,
+        html_hash=compute_html_hash(html),
+        extractor_version=EXTRACTOR_VERSION,
     )
     return article
 
 
+def scrape_article(article_url: str, category_name: str) -> Article:
+    html = fetch_article_html(article_url)
+    return parse_article(html, article_url, category_name)
+
+
 def get_next_url_for_article_list(category_url: str) -> Optional[str]:
-    res = requests.get(category_url)
+    from bs4 import BeautifulSoup
+
+    res = http_get(category_url)
     soup = BeautifulSoup(res.text, "html.parser")
+    return scrape_next_url_for_article_list(soup, category_url)
 
+
+def scrape_next_url_for_article_list(
+    soup: BeautifulSoup, category_url: str
+) -> Optional[str]:
     next_page_div_tag = soup.find("div", class_="pager-link-option")
     if next_page_div_tag is None:
         return None  # つぎのページへのタグが見つからなかったら None を返す
@@ -115,17 +202,24 @@ def get_next_url_for_article_list(category_url: str) -> Optional[str]:
     return next_page_a_tag_url
 
 
+def iter_category_article_urls(category: Category) -> Iterator[str]:
+    from bs4 import BeautifulSoup
+
+    next_page_url: Optional[str] = category.url
+    # 再帰呼び出しだとページ数が多い場合に再帰の上限に達するため、ループで次ページを辿る
+    while next_page_url is not None:
+        res = http_get(next_page_url)
+        soup = BeautifulSoup(res.text, "html.parser")
+
+        yield from scrape_article_url_list(soup)
+
+        next_page_url = scrape_next_url_for_article_list(soup, next_page_url)
+
+
 def crawl_category(category: Category) -> Iterator[Article]:
-    article_url_list = get_article_url_list_from_article_list(category.url)
-    for article_url in article_url_list:
+    for article_url in iter_category_article_urls(category):
         yield scrape_article(article_url, category.name)
 
-    next_page_url = get_next_url_for_article_list(category.url)
-    if next_page_url is not None:
-        category = Category(url=next_page_url, name=category.name)
-        # 次ページの URL をもとに、再度この関数を呼ぶ (再起関数)
-        yield from crawl_category(category)
-
 
 def crawl_all_articles(url: str) -> List[Article]:
     categories = get_category_list(url)
@@ -139,21 +233,270 @@ def crawl_all_articles(url: str) -> List[Article]:
     return articles
 
 
-def save_article(article: Article, data_root_dir: pathlib.Path) -> None:
-    category_root_dir = data_root_dir / article.category
-    if not os.path.exists(category_root_dir):
-        os.makedirs(category_root_dir)
+def crawl_frontier_item(
+    frontier: CrawlFrontier, item: FrontierItem, data_root_dir: pathlib.Path
+) -> None:
+    from bs4 import BeautifulSoup
+
+    # Crawl-delay や Retry-After、再送を待つ間も貸し出しの期限を延ばし続け、
+    # 他の worker に貸し出し直されて同じ URL が二重に取得されないようにする
+    heartbeat = functools.partial(frontier.renew, item)
+
+    if item.kind == LISTING:
+        res = http_get(item.url, heartbeat=heartbeat)
+        res.raise_for_status()
+        # 応答を待つ間に他の worker に貸し出し直されていないか確認してから結果を登録する
+        frontier.renew(item)
+        soup = BeautifulSoup(res.text, "html.parser")
+
+        frontier.complete_listing(
+            item,
+            article_urls=scrape_article_url_list(soup),
+            next_url=scrape_next_url_for_article_list(soup, item.url),
+        )
+    else:
+        html = fetch_article_html(item.url, heartbeat=heartbeat)
+        frontier.renew(item)
+        article = parse_article(html, item.url, item.category)
+        # 保存が完了してから取得済みとして記録する
+        save_article(article, data_root_dir)
+        frontier.complete_article(item)
+
+
+def initialize_frontier(url: str, frontier: CrawlFrontier, resume: bool) -> None:
+    if resume and frontier.is_initialized():
+        print(f"前回の続きからクローリングを再開します: {frontier.stats()}")
+        return
+
+    frontier.reset()
+
+    categories = get_category_list(url)
+    assert len(categories) == 8  # カテゴリは現状8個なので
+    for category in categories:
+        frontier.add_category(name=category.name, url=category.url)
+
+
+def run_crawl_worker(
+    frontier: CrawlFrontier,
+    data_root_dir: pathlib.Path,
+    poll_interval: float = 0.2,
+) -> None:
+    """
+    `frontier` から URL を借りてはクローリングする処理を、未取得の URL がなくなるまで繰り返す
+    """
+    while True:
+        item = frontier.lease()
+        if item is None:
+            next_retry_at = frontier.next_retry_at()
+            if next_retry_at is None:
+                break  # 未取得・貸し出し中の URL がなくなったら終了
+            # 再試行待ちや他の worker に貸し出し中の URL しか残っていない場合は、
+            # 新しい URL が追加されるか貸し出し可能になるまで待つ
+            time.sleep(min(max(next_retry_at - time.time(), 0), poll_interval))
+            continue
+
+        try:
+            crawl_frontier_item(frontier, item, data_root_dir)
+        except LeaseLostError:
+            # 期限切れで他の worker に貸し出し直された URL は、その worker に任せる
+            logger.warning(f"Lease expired for {item.url}; skip")
+        except Exception as err:
+            logger.warning(f"Failed to crawl {item.url}: {err!r}")
+            frontier.fail(item, err)
+
+
+def run_crawl_thread(
+    db_path: pathlib.Path,
+    data_root_dir: pathlib.Path,
+    worker_id: str,
+    max_attempts: int,
+    retry_delay: float,
+    lease_duration: float,
+) -> None:
+    # SQLite への接続はスレッドをまたいで共有できないため、スレッドごとに作る
+    frontier = CrawlFrontier(
+        db_path=db_path,
+        max_attempts=max_attempts,
+        retry_delay=retry_delay,
+        worker_id=worker_id,
+        lease_duration=lease_duration,
+    )
+    try:
+        run_crawl_worker(frontier, data_root_dir)
+    finally:
+        frontier.close()
+
+
+def crawl_worker_process(
+    db_path: pathlib.Path,
+    data_root_dir: pathlib.Path,
+    max_attempts: int,
+    retry_delay: float,
+    lease_duration: float,
+    rate_config: RateControlConfig,
+    progress_interval: float = 10.0,
+    profiler: Optional[Profiler] = None,
+) -> None:
+    """
+    1 つの worker プロセスの処理。同時リクエスト数の上限と同じ数のスレッドを起動し、
+    実際に同時に送るリクエスト数は `rate_controller` が応答時間やエラーをもとに調整する。
+    `profiler` を渡した場合は、この worker プロセスの処理をプロファイリングする
+    """
+    if profiler is not None:
+        with profiler, profiler.stage("crawl_worker"):
+            crawl_worker_process(
+                db_path=db_path,
+                data_root_dir=data_root_dir,
+                max_attempts=max_attempts,
+                retry_delay=retry_delay,
+                lease_duration=lease_duration,
+                rate_config=rate_config,
+                progress_interval=progress_interval,
+            )
+        return
+
+    controller = configure_rate_controller(rate_config, db_path)
+
+    threads = [
+        threading.Thread(
+            target=run_crawl_thread,
+            kwargs=dict(
+                db_path=db_path,
+                data_root_dir=data_root_dir,
+                worker_id=f"{socket.gethostname()}-{os.getpid()}-{i}",
+                max_attempts=max_attempts,
+                retry_delay=retry_delay,
+                lease_duration=lease_duration,
+            ),
+        )
+        for i in range(max(int(rate_config.max_concurrency), 1))
+    ]
+    for thread in threads:
+        thread.start()
+
+    # 全てのスレッドが終わるまで、定期的に現在の同時リクエスト数やリクエストの速度を表示する
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(timeout=progress_interval / len(threads))
+        print(f"[worker {os.getpid()}] {controller.report()}")
 
-    title_hash = hashlib.md5(article.title.encode()).hexdigest()
-    file_path = category_root_dir / f"{title_hash}.json"
 
-    with open(file_path, "w") as wf:
+def crawl_all_articles_with_frontier(
+    url: str,
+    frontier: CrawlFrontier,
+    data_root_dir: pathlib.Path,
+    resume: bool = False,
+    num_workers: int = 1,
+    rate_config: Optional[RateControlConfig] = None,
+    progress_interval: float = 10.0,
+    profiler: Optional[Profiler] = None,
+) -> None:
+    """
+    クローリングの状態を `frontier` に保存しながら全記事を取得し、`data_root_dir` へ保存する。
+    `resume=True` の場合は前回の続きからクローリングを再開する。
+    `num_workers` が 2 以上の場合は、同じ `frontier` を共有する worker プロセスを起動する。
+    その際 `profiler` を渡すと、各 worker プロセスも同じ設定でプロファイリングする
+    """
+    rate_config = rate_config or RateControlConfig()
+
+    configure_rate_controller(rate_config, frontier.db_path)
+    initialize_frontier(url, frontier, resume=resume)
+
+    worker_kwargs = dict(
+        db_path=frontier.db_path,
+        data_root_dir=data_root_dir,
+        max_attempts=frontier.max_attempts,
+        retry_delay=frontier.retry_delay,
+        lease_duration=frontier.lease_duration,
+        rate_config=rate_config,
+        progress_interval=progress_interval,
+    )
+    if num_workers <= 1:
+        crawl_worker_process(**worker_kwargs)  # type: ignore
+    else:
+        # fork すると親プロセスの SQLite 接続を引き継いでしまうため spawn で起動する
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(
+                target=crawl_worker_process,
+                kwargs=dict(
+                    worker_kwargs,
+                    profiler=(
+                        profiler.child(f"crawl-worker{i}")
+                        if profiler is not None
+                        else None
+                    ),
+                ),
+            )
+            for i in range(num_workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+    print(f"クローリングが完了しました: {frontier.stats()}")
+
+
+def write_json_atomically(obj: Dict[str, Any], file_path: pathlib.Path) -> None:
+    """
+    同じディレクトリの一時ファイルに書き込んでから置き換えることで、
+    書き込み途中のファイルが読まれたり残ったりしないようにする
+    """
+    with tempfile.NamedTemporaryFile(
+        "w", dir=file_path.parent, suffix=".tmp", delete=False
+    ) as wf:
         json.dump(
-            obj=asdict(article),
+            obj=obj,
             fp=wf,
             ensure_ascii=False,
             indent=4,
         )
+    # 一時ファイルは所有者しか読めない権限で作られるため、通常のファイルと同じ権限に戻す
+    os.chmod(wf.name, 0o644)
+    os.replace(wf.name, file_path)
+
+
+def get_article_file_name(url: str, title: str) -> str:
+    """
+    記事を保存するファイル名を返す。タイトルは抽出し直すと変わりうるため、URL のハッシュ値を使う。
+    URL を記録していない記事に限りタイトルのハッシュ値を使う
+    """
+    key = url if url else title
+    return f"{hashlib.md5(key.encode()).hexdigest()}.json"
+
+
+def save_article(article: Article, data_root_dir: pathlib.Path) -> None:
+    category_root_dir = data_root_dir / article.category
+    # 複数のスレッドから同時に呼ばれても失敗しないよう `exist_ok=True` とする
+    os.makedirs(category_root_dir, exist_ok=True)
+
+    file_path = category_root_dir / get_article_file_name(article.url, article.title)
+    path = str(file_path.relative_to(data_root_dir))
+
+    # 記事が 1 件も無いうちに manifest を作れば全ての記事が記録されるため、書き込む前に開く
+    manifest = get_thread_manifest(data_root_dir)
+    write_json_atomically(asdict(article), file_path)
+
+    # 同じ URL の記事が別の名前で保存されている場合 (タイトルのハッシュ値を名前にしていた頃の記事) は、
+    # 重複しないよう削除する
+    old_paths = [
+        old_path
+        for old_path in manifest.paths_by_url(article.url, article.category)
+        if old_path != path
+    ]
+    for old_path in old_paths:
+        (data_root_dir / old_path).unlink(missing_ok=True)
+
+    # 保存が完了してから manifest に記録する
+    manifest.replace(
+        old_paths=old_paths,
+        path=path,
+        url=article.url,
+        category=article.category,
+        content=article.content,
+        crawled_at=time.time(),
+    )
 
 
 def save_articles(
@@ -162,3 +505,85 @@ def save_articles(
 ) -> None:
     for article in articles:
         save_article(article, data_root_dir)
+
+
+def iter_article_file_paths(data_root_dir: pathlib.Path) -> Iterator[pathlib.Path]:
+    for category_dir_path in sorted(data_root_dir.iterdir()):
+        if not category_dir_path.is_dir():
+            continue
+        for article_file_path in category_dir_path.iterdir():
+            if article_file_path.suffix == ".json":
+                yield article_file_path
+
+
+def record_article_file(
+    manifest: CorpusManifest,
+    article_file_path: pathlib.Path,
+    article_dict: Dict[str, Any],
+    crawled_at: float,
+) -> None:
+    data_root_dir = manifest.db_path.parent
+    manifest.record(
+        path=str(article_file_path.relative_to(data_root_dir)),
+        url=article_dict.get("url", ""),
+        category=article_file_path.parent.name,
+        content=article_dict["content"],
+        crawled_at=crawled_at,
+    )
+
+
+def reextract_article_file(article_file_path: pathlib.Path, force: bool = False) -> str:
+    """
+    保存済みの記事の HTML からタイトルと本文を抽出し直し、ファイルを書き換える。
+    抽出方法のバージョンと HTML のハッシュ値が前回の抽出時と同じ場合は抽出し直さない。
+    ファイル名が URL のハッシュ値になっていない場合は名前を付け直す
+    """
+    from bs4 import BeautifulSoup
+
+    with open(article_file_path, "r") as rf:
+        article_dict = json.load(rf)
+    # ファイルを書き換える前の更新時刻を、クローリングした時刻とみなす
+    crawled_at = os.path.getmtime(article_file_path)
+
+    html_hash = compute_html_hash(article_dict["html"])
+    is_up_to_date = (
+        article_dict.get("extractor_version") == EXTRACTOR_VERSION
+        and article_dict.get("html_hash") == html_hash
+    )
+    status = "skipped"
+    if not is_up_to_date or force:
+        soup = BeautifulSoup(article_dict["html"], "html.parser")
+        article_dict.update(
+            title=scrape_article_title(soup),
+            content=scrape_article_content(soup),
+            html_hash=html_hash,
+            extractor_version=EXTRACTOR_VERSION,
+        )
+        write_json_atomically(article_dict, article_file_path)
+        status = "updated"
+
+    # タイトルのハッシュ値を名前にしていた頃のファイルは、抽出し直す必要がなくても名前を付け直す
+    target_file_path = article_file_path.with_name(
+        get_article_file_name(article_dict.get("url", ""), article_dict["title"])
+    )
+    if target_file_path == article_file_path and status == "skipped":
+        return status
+
+    # 本文が変わるため manifest の本文の長さとハッシュ値も更新する。
+    # 名前を付け直す場合は置き換えで移し、古い名前の記録を消す
+    manifest = get_thread_manifest(article_file_path.parents[1])
+    if target_file_path == article_file_path:
+        record_article_file(manifest, article_file_path, article_dict, crawled_at)
+        return status
+
+    os.replace(article_file_path, target_file_path)
+    data_root_dir = manifest.db_path.parent
+    manifest.replace(
+        old_paths=[str(article_file_path.relative_to(data_root_dir))],
+        path=str(target_file_path.relative_to(data_root_dir)),
+        url=article_dict.get("url", ""),
+        category=target_file_path.parent.name,
+        content=article_dict["content"],
+        crawled_at=crawled_at,
+    )
+    return "renamed" if status == "skipped" else status
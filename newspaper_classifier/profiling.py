@@ -0,0 +1,309 @@
+"""
+crawl / train_classifier / predict の各コマンドで共通して使うプロファイリングの仕組み
+
+- `deterministic`: cProfile で全ての関数呼び出しを記録し、tracemalloc でステージごとの
+  メモリ使用量のピークを記録する。オーバーヘッドは大きいが詳細な情報が得られる。
+  Python 3.11 までの cProfile は `enable` を呼んだスレッドしか記録しないため、プロファイリング中に
+  起動したスレッドではそれぞれ別の cProfile を動かし、終了時に 1 つにまとめる。
+  Python 3.12 以降の cProfile は `sys.monitoring` を使い、1 つでプロセスの全スレッドを記録する
+- `sampling`: 別スレッドから一定間隔で全スレッドのスタックを記録する。
+  tracemalloc を使わないためオーバーヘッドはほぼ無く、本番環境でもたまに使うことができる
+
+どちらの場合も、ステージごとに RSS の増減と、その時点までのプロセスの最大 RSS を記録する。
+別プロセスで動く worker は `child` で作った Profiler で、worker ごとに別のファイルに記録する
+
+結果は `profile_dir` に以下の形式で保存される:
+- `<name>-<timestamp>-<pid>.pstats`: `python -m pstats` や snakeviz で読める形式 (deterministic のみ)
+- `<name>-<timestamp>-<pid>.collapsed`: flamegraph.pl や speedscope で読める collapsed stack 形式
+- `<name>-<timestamp>-<pid>.stages.json`: ステージごとの経過時間とメモリ使用量
+"""
+
+import argparse
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import pathlib
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from typing import Any, Counter, Dict, Iterator, List, Optional, Tuple
+
+DETERMINISTIC = "deterministic"
+SAMPLING = "sampling"
+
+# Python 3.12 以降では cProfile を同時に 1 つしか有効にできず、スレッドごとに有効にしようとすると
+# "Another profiling tool is already active" でスレッドの起動に失敗する
+PROFILE_EACH_THREAD = sys.version_info < (3, 12)
+
+
+@dataclass
+class StageRecord(object):
+    name: str
+    elapsed_time: float
+    # そのステージ中の tracemalloc のピーク (KiB)。sampling の場合は None
+    peak_memory_kib: Optional[float]
+    # ステージの開始から終了までの RSS の増減 (KiB)
+    rss_delta_kib: float
+    # ステージ終了時点での、プロセスの開始からの最大 RSS (KiB)。
+    # 以前のステージの最大値も含むため、そのステージ単独のピークではない
+    process_max_rss_kib: float
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser, default_dir: pathlib.Path):
+    parser.add_argument(
+        "--profile",
+        type=str,
+        choices=[DETERMINISTIC, SAMPLING],
+        default=None,
+        help="プロファイリングの方法。sampling はオーバーヘッドがほぼ無く本番環境でも使える",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=pathlib.Path,
+        default=default_dir,
+        help="プロファイリングの結果を保存するディレクトリのパスの情報",
+    )
+    parser.add_argument(
+        "--profile-interval",
+        type=float,
+        default=0.01,
+        help="sampling でスタックを記録する間隔 (秒)",
+    )
+
+
+def get_rss_kib() -> float:
+    """
+    現在のプロセスの RSS (KiB) を `/proc/self/statm` から読み取る (Linux のみ)
+    """
+    with open("/proc/self/statm", "r") as rf:
+        resident_pages = int(rf.read().split()[1])
+    return resident_pages * resource.getpagesize() / 1024
+
+
+def get_process_max_rss_kib() -> float:
+    # Linux では KiB 単位で返ってくる
+    return float(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def format_frame(filename: str, lineno: int, function_name: str) -> str:
+    return f"{function_name} ({os.path.basename(filename)}:{lineno})"
+
+
+class StackSampler(threading.Thread):
+    """
+    一定間隔で全スレッドのスタックを記録し、同じスタックが記録された回数を数える
+    """
+
+    def __init__(self, interval: float) -> None:
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stacks: Counter[str] = collections.Counter()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue  # 自分自身のスタックは記録しない
+
+                stack = []
+                current_frame: Any = frame
+                while current_frame is not None:
+                    code = current_frame.f_code
+                    stack.append(
+                        format_frame(
+                            code.co_filename, code.co_firstlineno, code.co_name
+                        )
+                    )
+                    current_frame = current_frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+
+def pstats_to_collapsed(stats: pstats.Stats, max_depth: int = 64) -> Counter[str]:
+    """
+    cProfile は関数の呼び出し元と呼び出し先の関係しか記録しないため、
+    呼び出し先の累積時間を呼び出し元ごとの割合で按分してスタックごとの時間 (マイクロ秒) を推定する
+    """
+    raw_stats: Dict = stats.stats  # type: ignore
+
+    callees: Dict[Tuple, Dict[Tuple, float]] = collections.defaultdict(dict)
+    for func, (_, _, _, _, callers) in raw_stats.items():
+        for caller, (_, _, _, caller_cumtime) in callers.items():
+            callees[caller][func] = caller_cumtime
+
+    stacks: Counter[str] = collections.Counter()
+
+    def emit(func: Tuple, path: List[Tuple], scale: float) -> None:
+        _, _, tottime, _, _ = raw_stats[func]
+        frames = ";".join(format_frame(*f) for f in path)
+        stacks[frames] += int(tottime * scale * 1e6)
+
+        if len(path) >= max_depth:
+            return
+        for callee, edge_cumtime in callees[func].items():
+            callee_cumtime = raw_stats[callee][3]
+            if callee in path or callee_cumtime <= 0:
+                continue  # 再帰呼び出しは辿らない
+            callee_scale = scale * edge_cumtime / callee_cumtime
+            if callee_cumtime * callee_scale < 1e-6:
+                continue  # 1 マイクロ秒に満たないスタックは省略する
+            emit(callee, path + [callee], callee_scale)
+
+    roots = [func for func, (*_, callers) in raw_stats.items() if not callers]
+    for root in roots:
+        emit(root, [root], 1.0)
+
+    return collections.Counter({k: v for k, v in stacks.items() if v > 0})
+
+
+class Profiler(object):
+    """
+    `mode` が None の場合は何もしないため、呼び出し側は常に `stage` で処理を囲んでおけばよい
+    """
+
+    def __init__(
+        self,
+        mode: Optional[str],
+        profile_dir: pathlib.Path,
+        name: str,
+        interval: float = 0.01,
+    ) -> None:
+        self.mode = mode
+        self.profile_dir = profile_dir
+        self.name = name
+        self.interval = interval
+        self.stages: List[StageRecord] = []
+
+        self.cprofile: Optional[cProfile.Profile] = None
+        # プロファイリング中に起動したスレッドごとの cProfile。
+        # `list.append` はスレッドセーフであり、また lock を持たせると pickle できなくなるため lock は使わない
+        self.thread_profiles: List[cProfile.Profile] = []
+        self.sampler: Optional[StackSampler] = None
+
+    def child(self, name: str) -> "Profiler":
+        """
+        別プロセスで動く worker 用に、同じ設定の Profiler を作る。
+        `with` に入る前の Profiler は pickle できるため、spawn するプロセスの引数として渡せる
+        """
+        return Profiler(
+            mode=self.mode,
+            profile_dir=self.profile_dir,
+            name=name,
+            interval=self.interval,
+        )
+
+    def start_thread_profile(self, frame: Any, event: str, arg: Any) -> None:
+        # `threading.setprofile` で登録しておくと、新しいスレッドの最初の関数呼び出しで呼ばれる。
+        # ここでそのスレッド用の cProfile を有効にし、以降の呼び出しは cProfile が記録する
+        profile = cProfile.Profile()
+        self.thread_profiles.append(profile)
+        profile.enable()
+
+    def __enter__(self) -> "Profiler":
+        if self.mode == DETERMINISTIC:
+            tracemalloc.start()
+            if PROFILE_EACH_THREAD:
+                threading.setprofile(self.start_thread_profile)
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        elif self.mode == SAMPLING:
+            self.sampler = StackSampler(self.interval)
+            self.sampler.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        if self.mode is None:
+            return
+
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        prefix = self.profile_dir / (
+            f"{self.name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        )
+
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            if PROFILE_EACH_THREAD:
+                threading.setprofile(None)
+            tracemalloc.stop()
+
+            # 各スレッドの記録をまとめる。まだ動いているスレッドはその時点までの記録を使う
+            stats = pstats.Stats(self.cprofile)
+            thread_profiles = list(self.thread_profiles)
+            for profile in thread_profiles:
+                stats.add(profile)
+
+            stats.dump_stats(f"{prefix}.pstats")
+            stacks = pstats_to_collapsed(stats)
+            if PROFILE_EACH_THREAD:
+                print(
+                    f"Save profile to {prefix}.pstats "
+                    f"(スレッド数: {len(thread_profiles) + 1})"
+                )
+            else:
+                print(f"Save profile to {prefix}.pstats")
+        elif self.sampler is not None:
+            self.sampler.stop()
+            stacks = self.sampler.stacks
+
+        with open(f"{prefix}.collapsed", "w") as wf:
+            for stack, count in stacks.most_common():
+                wf.write(f"{stack} {count}\n")
+        print(f"Save collapsed stacks to {prefix}.collapsed")
+
+        with open(f"{prefix}.stages.json", "w") as wf:
+            json.dump(
+                [asdict(stage) for stage in self.stages],
+                wf,
+                ensure_ascii=False,
+                indent=4,
+            )
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if self.mode is None:
+            yield
+            return
+
+        if self.mode == DETERMINISTIC:
+            tracemalloc.reset_peak()
+
+        start_rss_kib = get_rss_kib()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+            peak_memory_kib = None
+            if self.mode == DETERMINISTIC:
+                _, peak_memory = tracemalloc.get_traced_memory()
+                peak_memory_kib = peak_memory / 1024
+
+            stage_record = StageRecord(
+                name=name,
+                elapsed_time=elapsed_time,
+                peak_memory_kib=peak_memory_kib,
+                rss_delta_kib=get_rss_kib() - start_rss_kib,
+                process_max_rss_kib=get_process_max_rss_kib(),
+            )
+            self.stages.append(stage_record)
+            print(f"[profile] {format_stage_record(stage_record)}")
+
+
+def format_stage_record(stage_record: StageRecord) -> str:
+    message = f"{stage_record.name}: {stage_record.elapsed_time:.3f} 秒, "
+    if stage_record.peak_memory_kib is not None:
+        message += f"ピークメモリ {stage_record.peak_memory_kib / 1024:.1f} MiB, "
+    return message + (
+        f"RSS の増減 {stage_record.rss_delta_kib / 1024:+.1f} MiB, "
+        f"プロセスの最大 RSS {stage_record.process_max_rss_kib / 1024:.1f} MiB"
+    )
@@ -0,0 +1,52 @@
+import pathlib
+import pstats
+import tempfile
+import threading
+from typing import List
+
+from django.test import SimpleTestCase
+
+from newspaper_classifier.profiling import DETERMINISTIC, SAMPLING, Profiler
+
+
+def count_up(results: List[int]) -> None:
+    results.append(sum(range(1000)))
+
+
+class ProfilerTest(SimpleTestCase):
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.profile_dir = pathlib.Path(tmp_dir.name)
+
+    def run_threads(self, mode: str) -> List[int]:
+        results: List[int] = []
+        with Profiler(
+            mode=mode, profile_dir=self.profile_dir, name="test", interval=0.001
+        ) as profiler:
+            with profiler.stage("threads"):
+                threads = [
+                    threading.Thread(target=count_up, args=(results,)) for _ in range(3)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        return results
+
+    def test_deterministic_profiles_threads(self):
+        results = self.run_threads(DETERMINISTIC)
+
+        # プロファイリング中に起動したスレッドも実際に処理を行う
+        self.assertEqual(results, [499500] * 3)
+        (pstats_path,) = self.profile_dir.glob("*.pstats")
+        stats = pstats.Stats(str(pstats_path))
+        function_names = {name for _, _, name in stats.stats}
+        self.assertIn("count_up", function_names)
+
+        (stages_path,) = self.profile_dir.glob("*.stages.json")
+        self.assertIn('"threads"', stages_path.read_text())
+
+    def test_sampling_runs_threads(self):
+        self.assertEqual(self.run_threads(SAMPLING), [499500] * 3)
+        self.assertEqual(len(list(self.profile_dir.glob("*.collapsed"))), 1)
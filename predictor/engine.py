@@ -0,0 +1,181 @@
+"""
+scikit-learn を使わずに、NumPy のみで記事のカテゴリを予測する推論エンジン。
+
+`export_shared_model` で書き出した語彙と係数を読み込み、
+分かち書きした本文の単語を語彙のインデックスに引き当てて、係数との内積から確率を計算する。
+`CountVectorizer.transform` や `LogisticRegression.predict_proba` と同じ結果を返すが、
+scikit-learn の読み込みや入力の検証、密な行列への変換を行わないため、起動も 1 回の推論も速い
+"""
+
+import json
+import pathlib
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from predictor.shared_model import (
+    COEF_FILE_NAME,
+    INTERCEPT_FILE_NAME,
+    METADATA_FILE_NAME,
+    TERM_BLOB_FILE_NAME,
+    TERM_OFFSETS_FILE_NAME,
+)
+
+
+# `CountVectorizer` の既定の token_pattern。2 文字以上の単語の文字 (`\w`) の並びを 1 単語とする
+DEFAULT_TOKEN_PATTERN = r"(?u)\b\w\w+\b"
+
+
+def sigmoid(x: np.ndarray) -> np.ndarray:
+    # 1 / (1 + exp(-x)) をオーバーフローさせずに計算する
+    return np.exp(-np.logaddexp(0.0, -x))
+
+
+class InferenceEngine(object):
+    """
+    - coef / intercept: ロジスティック回帰の係数と切片
+    - vocabulary: 単語 → coef の列のインデックス
+    - labels: coef の各行に対応するカテゴリ名
+    - probability: 確率の計算方法 ("softmax", "ovr", "binary")
+    """
+
+    def __init__(
+        self,
+        coef: np.ndarray,
+        intercept: np.ndarray,
+        vocabulary: Dict[str, int],
+        labels: List[str],
+        probability: str,
+        token_pattern: str,
+        lowercase: bool,
+        binary: bool,
+        pos_filter: Optional[Sequence[str]],
+    ) -> None:
+        self.coef = coef
+        self.intercept = intercept
+        self.vocabulary = vocabulary
+        self.labels = labels
+        self.probability = probability
+        self.token_pattern = re.compile(token_pattern)
+        self.lowercase = lowercase
+        self.binary = binary
+        self.pos_filter = tuple(pos_filter) if pos_filter is not None else None
+
+    def tokenize(self, tokenized_text: str) -> List[str]:
+        if self.lowercase:
+            tokenized_text = tokenized_text.lower()
+        if self.token_pattern.pattern != DEFAULT_TOKEN_PATTERN:
+            return self.token_pattern.findall(tokenized_text)
+
+        # 既定の token_pattern は空白をまたがないため、空白で区切った単語ごとに適用しても結果は同じになる。
+        # 分かち書きした本文の単語の大半は `\w` のみからなり、正規表現を使わずに判定できる
+        # (`\w` は `str.isalnum()` が真になる文字と `_` にあたる)
+        terms: List[str] = []
+        for token in tokenized_text.split():
+            if token.isalnum():
+                if len(token) >= 2:
+                    terms.append(token)
+            else:
+                terms += self.token_pattern.findall(token)
+        return terms
+
+    def transform(
+        self, tokenized_texts: Sequence[str]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        分かち書きした本文に現れた語彙の単語を、(文書の番号, 特徴のインデックス) の 2 つの配列で返す。
+        同じ単語が複数回現れた場合はその回数だけ要素が現れるため、文書ごとに数えると出現回数になる
+        """
+        doc_ids: List[int] = []
+        indices: List[int] = []
+        for doc_id, tokenized_text in enumerate(tokenized_texts):
+            terms = self.tokenize(tokenized_text)
+            if self.binary:
+                terms = list(dict.fromkeys(terms))
+
+            doc_indices = [
+                index for index in map(self.vocabulary.get, terms) if index is not None
+            ]
+            doc_ids += [doc_id] * len(doc_indices)
+            indices += doc_indices
+
+        return np.array(doc_ids, dtype=np.int64), np.array(indices, dtype=np.int64)
+
+    def decision_function(self, tokenized_texts: Sequence[str]) -> np.ndarray:
+        doc_ids, indices = self.transform(tokenized_texts)
+
+        # 出現した単語の係数の列だけを取り出し、文書ごとに足し合わせる (出現回数との内積になる)
+        contributions = self.coef[:, indices]
+        if len(tokenized_texts) == 1:
+            return contributions.sum(axis=1)[np.newaxis] + self.intercept
+
+        scores = np.empty((len(tokenized_texts), self.coef.shape[0]))
+        for i, row in enumerate(contributions):
+            scores[:, i] = np.bincount(
+                doc_ids, weights=row, minlength=len(tokenized_texts)
+            )
+        return scores + self.intercept
+
+    def predict_proba(self, tokenized_texts: Sequence[str]) -> np.ndarray:
+        scores = self.decision_function(tokenized_texts)
+
+        if self.probability == "binary":
+            positive = sigmoid(scores[:, 0])
+            return np.stack([1.0 - positive, positive], axis=1)
+
+        if self.probability == "ovr":
+            probas = sigmoid(scores)
+        else:
+            probas = np.exp(scores - scores.max(axis=1, keepdims=True))
+        return probas / probas.sum(axis=1, keepdims=True)
+
+    def predict_top_k(
+        self, tokenized_texts: Sequence[str], k: int = 1
+    ) -> List[List[Tuple[int, str, float]]]:
+        """
+        文書ごとに、確率の高い順に k 個の (カテゴリの番号, カテゴリ名, 確率) を返す
+        """
+        probas = self.predict_proba(tokenized_texts)
+        top_k = np.argsort(-probas, axis=1, kind="stable")[:, :k]
+        return [
+            [(int(i), self.labels[i], float(doc_probas[i])) for i in doc_top_k]
+            for doc_probas, doc_top_k in zip(probas, top_k)
+        ]
+
+
+def load_inference_engine(export_dir: pathlib.Path) -> InferenceEngine:
+    """
+    `export_shared_model` で書き出したモデルを読み込む。係数は `mmap` で読み込むため、
+    同じホストの worker 間で物理メモリが共有される。
+    語彙はハッシュ値の二分探索よりも速く引けるよう、Python の dict に展開する
+    """
+    metadata_path = export_dir / METADATA_FILE_NAME
+    if not metadata_path.exists():
+        raise FileNotFoundError(
+            f"{metadata_path} が見つかりません。`python manage.py export_shared_model` で書き出し直してください"
+        )
+
+    print(f"Load inference engine from {export_dir}")
+    with open(metadata_path, "r") as rf:
+        metadata = json.load(rf)
+
+    term_offsets = np.load(export_dir / TERM_OFFSETS_FILE_NAME).tolist()
+    term_blob = np.load(export_dir / TERM_BLOB_FILE_NAME).tobytes()
+    vocabulary = {
+        term_blob[start:end].decode(): index
+        for index, (start, end) in enumerate(zip(term_offsets, term_offsets[1:]))
+    }
+
+    return InferenceEngine(
+        # `np.memmap` のままだと演算のたびに memmap が作られて遅いため、同じメモリを指す ndarray にする
+        coef=np.asarray(np.load(export_dir / COEF_FILE_NAME, mmap_mode="r")),
+        intercept=np.load(export_dir / INTERCEPT_FILE_NAME),
+        vocabulary=vocabulary,
+        labels=metadata["labels"],
+        probability=metadata["probability"],
+        token_pattern=metadata["token_pattern"],
+        lowercase=metadata["lowercase"],
+        binary=metadata["binary"],
+        pos_filter=metadata["pos_filter"],
+    )
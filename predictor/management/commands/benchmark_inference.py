@@ -0,0 +1,162 @@
+import itertools
+import pathlib
+import tempfile
+import time
+from typing import Any, Callable, List
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from classifier.utils import create_tagger, iter_dataset, tokenize_text
+from predictor.engine import load_inference_engine
+from predictor.shared_model import export_shared_model
+from predictor.utils import (
+    load_label_encoder,
+    load_model,
+    load_vectorizer,
+    predict_tokenized_category,
+)
+
+
+def measure_latencies(func: Callable[[str], Any], documents: List[str]) -> List[float]:
+    latencies = []
+    for document in documents:
+        start_time = time.perf_counter()
+        func(document)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def format_latencies(latencies: List[float]) -> str:
+    import numpy as np
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1e6
+    return f"p50 {p50:>8.1f} us, p95 {p95:>8.1f} us, p99 {p99:>8.1f} us"
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser: CommandParser) -> None:
+        """
+        `python manage.py benchmark_inference` を実行するときのコマンドラインオプション
+        """
+        parser.add_argument(
+            "--data-root-dir",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3] / "data" / "articles",
+            help="クローリングしたときに保存したデータのパスの情報",
+        )
+        parser.add_argument(
+            "--model-save-path",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "models"
+            / "pretrained-model.joblib",
+            help="学習済みの classifier のパスの情報",
+        )
+        parser.add_argument(
+            "--label-encoder-save-path",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "label_encoders"
+            / "label-encoder.joblib",
+            help="label encoder のパスの情報",
+        )
+        parser.add_argument(
+            "--vectorizer-save-path",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "vectorizers"
+            / "count-vectorizer.joblib",
+            help="vectorizer のパスの情報",
+        )
+        parser.add_argument(
+            "--num-documents",
+            type=int,
+            default=500,
+            help="推論に使う記事の数",
+        )
+        parser.add_argument(
+            "--top-k",
+            type=int,
+            default=3,
+            help="NumPy の推論エンジンで確率の高い順に返すカテゴリの数",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=1e-6,
+            help="scikit-learn と NumPy の推論エンジンの確率の差の許容値",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        """
+        `python manage.py benchmark_inference` を実行したときに呼び出される関数。
+        NumPy の推論エンジンが scikit-learn と同じ確率を返すことを確認し、1 文書あたりの推論時間を比較する
+        """
+        import numpy as np
+
+        model = load_model(options["model_save_path"])
+        label_encoder = load_label_encoder(options["label_encoder_save_path"])
+        vectorizer = load_vectorizer(options["vectorizer_save_path"])
+
+        with tempfile.TemporaryDirectory() as export_dir:
+            export_shared_model(
+                model, label_encoder, vectorizer, export_dir=pathlib.Path(export_dir)
+            )
+            engine = load_inference_engine(pathlib.Path(export_dir))
+
+            tagger = create_tagger(engine.pos_filter)
+            documents = [
+                tokenize_text(tagger, text, engine.pos_filter)
+                for text, _ in itertools.islice(
+                    iter_dataset(options["data_root_dir"]), options["num_documents"]
+                )
+            ]
+            print(f"推論に使う記事の数: {len(documents)}")
+
+            # 1. scikit-learn と同じ確率を返すことを確認する
+            sklearn_probas = model.predict_proba(vectorizer.transform(documents))
+            engine_probas = engine.predict_proba(documents)
+            max_diff = float(np.abs(sklearn_probas - engine_probas).max())
+            agreement = float(
+                (sklearn_probas.argmax(axis=1) == engine_probas.argmax(axis=1)).mean()
+            )
+            print(f"確率の差の最大値: {max_diff:.3e} (許容値: {options['tolerance']:.0e})")
+            print(f"予測したカテゴリの一致率: {agreement:.1%}")
+            if max_diff > options["tolerance"]:
+                raise CommandError(
+                    f"The NumPy engine differs from scikit-learn by {max_diff:.3e} "
+                    f"(tolerance: {options['tolerance']:.0e})"
+                )
+
+            # 2. 1 文書ずつ推論したときの時間を比較する
+            sklearn_latencies = measure_latencies(
+                lambda document: predict_tokenized_category(
+                    document, model, label_encoder, vectorizer
+                ),
+                documents,
+            )
+            engine_latencies = measure_latencies(
+                lambda document: engine.predict_top_k([document], options["top_k"]),
+                documents,
+            )
+            print("1 文書あたりの推論時間:")
+            print(f"  scikit-learn: {format_latencies(sklearn_latencies)}")
+            print(f"  NumPy       : {format_latencies(engine_latencies)}")
+
+            # 3. まとめて推論したときの時間を比較する
+            start_time = time.perf_counter()
+            label_encoder.inverse_transform(
+                model.predict_proba(vectorizer.transform(documents)).argmax(axis=1)
+            )
+            sklearn_batch_time = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            engine.predict_top_k(documents, options["top_k"])
+            engine_batch_time = time.perf_counter() - start_time
+
+            print(f"{len(documents)} 文書をまとめて推論した時間:")
+            print(f"  scikit-learn: {sklearn_batch_time * 1000:>8.1f} ms")
+            print(f"  NumPy       : {engine_batch_time * 1000:>8.1f} ms")
@@ -0,0 +1,64 @@
+import pathlib
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from predictor.shared_model import export_shared_model
+from predictor.utils import load_label_encoder, load_model, load_vectorizer
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser: CommandParser) -> None:
+        """
+        `python manage.py export_shared_model` を実行するときのコマンドラインオプション
+        """
+        parser.add_argument(
+            "--model-save-path",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "models"
+            / "pretrained-model.joblib",
+            help="学習済みの classifier のパスの情報",
+        )
+        parser.add_argument(
+            "--label-encoder-save-path",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "label_encoders"
+            / "label-encoder.joblib",
+            help="label encoder のパスの情報",
+        )
+        parser.add_argument(
+            "--vectorizer-save-path",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "vectorizers"
+            / "count-vectorizer.joblib",
+            help="vectorizer のパスの情報",
+        )
+        parser.add_argument(
+            "--export-dir",
+            type=pathlib.Path,
+            default=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "shared_model",
+            help="worker 間で共有できる形式のモデルを書き出すディレクトリのパスの情報",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        """
+        `python manage.py export_shared_model` を実行したときに呼び出される関数
+        """
+        model = load_model(options["model_save_path"])
+        label_encoder = load_label_encoder(options["label_encoder_save_path"])
+        vectorizer = load_vectorizer(options["vectorizer_save_path"])
+
+        export_shared_model(
+            model,
+            label_encoder,
+            vectorizer,
+            export_dir=options["export_dir"],
+        )
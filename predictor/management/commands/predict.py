@@ -1,9 +1,14 @@
 import pathlib
-from typing import Any
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
 
-import streamlit.web.bootstrap
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandParser
-from streamlit import config as st_config
+
+from newspaper_classifier.profiling import add_profile_arguments
+from predictor.shared_model import get_memory_usage
 
 
 class Command(BaseCommand):
@@ -51,6 +56,37 @@ class Command(BaseCommand):
                 / "count-vectorizer.joblib"
             ),
         )
+        parser.add_argument(
+            "--shared-model-dir",
+            type=str,
+            default=None,
+            help="`export_shared_model` で書き出したモデルのディレクトリ。指定すると語彙と係数を worker 間で共有する",
+        )
+        parser.add_argument(
+            "--engine",
+            type=str,
+            choices=["sklearn", "numpy"],
+            default="sklearn",
+            help="推論に使う実装。numpy は scikit-learn を使わずに推論する (`--shared-model-dir` が必要)",
+        )
+        parser.add_argument(
+            "--num-workers",
+            type=int,
+            default=1,
+            help="起動する streamlit server の数。各 worker は `--port` から順に異なるポートで起動する",
+        )
+        parser.add_argument(
+            "--memory-report-interval",
+            type=float,
+            default=30.0,
+            help="`--num-workers` が 2 以上のときに各 worker のメモリ使用量を表示する間隔 (秒)",
+        )
+        add_profile_arguments(
+            parser,
+            default_dir=pathlib.Path(__file__).resolve().parents[3]
+            / "data"
+            / "profiles",
+        )
 
     def handle(self, *args: Any, **options: Any):
         """
@@ -61,6 +97,17 @@ class Command(BaseCommand):
         今回は django のカスタムコマンドを通して streamlit server を起動したいため、
         以下のように `streamlit.web.bootstrap.run` 関数を通してスクリプトを実行する。
         """
+        if options["engine"] == "numpy" and options["shared_model_dir"] is None:
+            raise ValueError("--engine numpy requires --shared-model-dir")
+
+        if options["num_workers"] > 1:
+            self.run_workers(options)
+            return
+
+        # streamlit の読み込みには時間がかかるため、サーバを起動するときにのみ import する
+        import streamlit.web.bootstrap
+        from streamlit import config as st_config
+
         # streamlit のポート番号の設定
         st_config.set_option("server.port", options["port"])
 
@@ -68,20 +115,83 @@ class Command(BaseCommand):
         # `main_script_path` に対象となる streamlit.py を渡している
         # - /path/to/newspaper-classifier/predictor/streamlit.py
         #
-        # その他、コマンドラインオプションとして、以下の3つを与えている:
+        # その他、コマンドラインオプションとして、以下の3つ (と `shared-model-dir`, `engine`) を与えている:
         # - model-save-path
         # - label-encoder-save-path
         # - vectorizer-save-path
+        script_args = [
+            "--model-save-path",
+            options["model_save_path"],
+            "--label-encoder-save-path",
+            options["label_encoder_save_path"],
+            "--vectorizer-save-path",
+            options["vectorizer_save_path"],
+        ]
+        if options["shared_model_dir"] is not None:
+            script_args += ["--shared-model-dir", options["shared_model_dir"]]
+        script_args += ["--engine", options["engine"]]
+        script_args += self.profile_args(options)
+
         streamlit.web.bootstrap.run(
             main_script_path=options["script_path"],
             command_line="",
-            args=[
+            args=script_args,
+            flag_options={},
+        )
+
+    def profile_args(self, options: Dict[str, Any]) -> List[str]:
+        if options["profile"] is None:
+            return []
+        return [
+            "--profile",
+            options["profile"],
+            "--profile-dir",
+            str(options["profile_dir"]),
+            "--profile-interval",
+            str(options["profile_interval"]),
+        ]
+
+    def run_workers(self, options: Dict[str, Any]) -> None:
+        """
+        `--num-workers` 個の streamlit server を別プロセスで起動し、
+        それぞれのメモリ使用量を定期的に表示する
+        """
+        workers: List[subprocess.Popen] = []
+        for i in range(options["num_workers"]):
+            command = [
+                sys.executable,
+                str(settings.BASE_DIR / "manage.py"),
+                "predict",
+                "--script-path",
+                options["script_path"],
+                "--port",
+                str(options["port"] + i),
                 "--model-save-path",
                 options["model_save_path"],
                 "--label-encoder-save-path",
                 options["label_encoder_save_path"],
                 "--vectorizer-save-path",
                 options["vectorizer_save_path"],
-            ],
-            flag_options={},
-        )
+            ]
+            if options["shared_model_dir"] is not None:
+                command += ["--shared-model-dir", options["shared_model_dir"]]
+            command += ["--engine", options["engine"]]
+            command += self.profile_args(options)
+            workers.append(subprocess.Popen(command))
+
+        try:
+            while all(worker.poll() is None for worker in workers):
+                time.sleep(options["memory_report_interval"])
+                for i, worker in enumerate(workers):
+                    memory_usage = get_memory_usage(worker.pid)
+                    print(
+                        f"[worker {worker.pid} (port {options['port'] + i})] "
+                        f"RSS {memory_usage['Rss'] / 1024:.1f} MiB, "
+                        f"PSS {memory_usage['Pss'] / 1024:.1f} MiB, "
+                        f"共有 {(memory_usage['Shared_Clean'] + memory_usage['Shared_Dirty']) / 1024:.1f} MiB"
+                    )
+        finally:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.wait()
@@ -0,0 +1,297 @@
+import copy
+import hashlib
+import itertools
+import json
+import pathlib
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# 複数の worker プロセスで 1 つの学習済みモデルを共有するための仕組み。
+#
+# joblib で保存したモデルをそのまま各プロセスで読み込むと、語彙の dict や係数の配列が
+# プロセスごとに複製される。また dict は参照カウントの更新でページが書き換わるため、
+# fork 後も copy-on-write で共有され続けることはない。
+# そこで語彙と係数を NumPy の配列としてファイルに書き出し、`mmap` で読み込むことで、
+# 同じホスト上の全ての worker がページキャッシュ上の 1 つの物理メモリを共有するようにする。
+
+MODEL_SKELETON_FILE_NAME = "model-skeleton.joblib"
+VECTORIZER_SKELETON_FILE_NAME = "vectorizer-skeleton.joblib"
+LABEL_ENCODER_FILE_NAME = "label-encoder.joblib"
+COEF_FILE_NAME = "coef.npy"
+INTERCEPT_FILE_NAME = "intercept.npy"
+METADATA_FILE_NAME = "metadata.json"
+TERM_HASHES_FILE_NAME = "term-hashes.npy"
+TERM_OFFSETS_FILE_NAME = "term-offsets.npy"
+TERM_BLOB_FILE_NAME = "term-blob.npy"
+
+
+def term_hash(term: str) -> int:
+    # `hash()` はプロセスごとに値が変わるため、プロセスをまたいで同じ値になるハッシュ関数を使う
+    digest = hashlib.blake2b(term.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class MappedVocabulary(Mapping):
+    """
+    単語 → 特徴のインデックス の対応を、ハッシュ値でソートした配列で表す読み取り専用の Mapping。
+
+    - term_hashes: 各単語のハッシュ値を昇順に並べた配列。i 番目の単語の特徴のインデックスは i
+    - term_offsets / term_blob: 各単語を UTF-8 で連結したバイト列とその区切り位置。
+      ハッシュ値の衝突による誤った一致を防ぐため、見つかった単語と一致するかを確認する
+
+    `CountVectorizer.vocabulary_` の代わりに設定して使う
+    """
+
+    def __init__(self, term_hashes, term_offsets, term_blob) -> None:
+        self.term_hashes = term_hashes
+        self.term_offsets = term_offsets
+        self.term_blob = term_blob
+
+    def _term(self, index: int) -> str:
+        start, end = self.term_offsets[index], self.term_offsets[index + 1]
+        return bytes(self.term_blob[start:end]).decode()
+
+    def lookup_many(self, terms: Sequence[str]):
+        """
+        単語の特徴のインデックスを配列でまとめて返す。語彙にない単語は -1 とする。
+        1 単語ずつ `__getitem__` で引くと NumPy の呼び出しが単語の数だけ起きて遅いため、
+        ハッシュ値を配列にしてから 1 回の `searchsorted` で二分探索する
+        """
+        import numpy as np
+
+        hash_values = np.fromiter(
+            (term_hash(term) for term in terms), dtype=np.uint64, count=len(terms)
+        )
+        indices = np.searchsorted(self.term_hashes, hash_values)
+        indices[indices == len(self.term_hashes)] = 0
+        found = np.asarray(self.term_hashes[indices]) == hash_values
+
+        # ハッシュ値が一致した単語のみ、語彙のバイト列と比べて衝突でないことを確認する。
+        # 一致した単語のバイト列を連結したものと、語彙の対応する範囲を集めたものを一度に比べる
+        candidates = np.flatnonzero(found)
+        encoded_terms = [terms[i].encode() for i in candidates.tolist()]
+        lengths = np.array([len(encoded) for encoded in encoded_terms], dtype=np.int64)
+        starts = np.asarray(self.term_offsets[indices[candidates]])
+        ends = np.asarray(self.term_offsets[indices[candidates] + 1])
+        same_length = ends - starts == lengths
+        found[candidates[~same_length]] = False
+
+        candidates, starts, lengths = (
+            candidates[same_length],
+            starts[same_length],
+            lengths[same_length],
+        )
+        ends = np.cumsum(lengths)
+        positions = np.arange(ends[-1] if len(ends) else 0) + np.repeat(
+            starts - (ends - lengths), lengths
+        )
+        actual = np.asarray(self.term_blob)[positions]
+        expected = np.frombuffer(
+            b"".join(encoded_terms[i] for i in np.flatnonzero(same_length).tolist()),
+            dtype=np.uint8,
+        )
+        mismatched = actual != expected
+        if mismatched.any():
+            # 食い違うバイトを含む単語を、そのバイトの位置から求める
+            owners = np.searchsorted(ends, np.flatnonzero(mismatched), side="right")
+            found[candidates[owners]] = False
+
+        return np.where(found, indices, -1)
+
+    def __getitem__(self, term: str) -> int:
+        index = int(self.lookup_many([term])[0])
+        if index < 0:
+            raise KeyError(term)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.term_hashes)
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(len(self)):
+            yield self._term(index)
+
+
+class MappedVocabularyVectorizer(object):
+    """
+    `MappedVocabulary` を語彙に持つ `CountVectorizer` の `transform` を速くするラッパー。
+
+    `CountVectorizer.transform` は単語ごとに `vocabulary_[term]` を呼ぶため、
+    `MappedVocabulary` ではハッシュ値の計算と二分探索が単語の出現ごとに起きる。
+    ここでは文書群に現れた単語の種類ごとに 1 回だけ、`lookup_many` でまとめて引く。
+    LIME のように同じ単語からなる文書を大量に推論する場合に特に効く。
+    `transform` 以外の属性はラップした vectorizer のものを返す
+    """
+
+    def __init__(self, vectorizer) -> None:
+        self.vectorizer = vectorizer
+
+    def __getattr__(self, name: str) -> Any:
+        # `vectorizer` 自体が未設定のとき (unpickle の途中など) に無限に再帰しないようにする
+        if name == "vectorizer":
+            raise AttributeError(name)
+        return getattr(self.vectorizer, name)
+
+    def transform(self, raw_documents: Sequence[str]) -> Any:
+        import numpy as np
+        import scipy.sparse as sp
+
+        analyze = self.vectorizer.build_analyzer()
+        documents_terms = [analyze(document) for document in raw_documents]
+
+        unique_terms = list(dict.fromkeys(itertools.chain(*documents_terms)))
+        term_indices = {
+            term: index
+            for term, index in zip(
+                unique_terms, self.vectorizer.vocabulary_.lookup_many(unique_terms)
+            )
+            if index >= 0
+        }
+
+        indices: List[int] = []
+        indptr = [0]
+        for terms in documents_terms:
+            indices += [term_indices[term] for term in terms if term in term_indices]
+            indptr.append(len(indices))
+
+        # `CountVectorizer.transform` と同じく、同じ単語の出現回数を足し合わせてインデックス順に並べる
+        X = sp.csr_matrix(
+            (np.ones(len(indices), dtype=self.vectorizer.dtype), indices, indptr),
+            shape=(len(indptr) - 1, len(self.vectorizer.vocabulary_)),
+        )
+        X.sum_duplicates()
+        if self.vectorizer.binary:
+            X.data.fill(1)
+        return X
+
+
+def export_shared_model(
+    model, label_encoder, vectorizer, export_dir: pathlib.Path
+) -> None:
+    """
+    joblib で保存していた学習済みモデルを、`mmap` で共有して読み込める形式で `export_dir` に書き出す
+    """
+    import joblib
+    import numpy as np
+
+    if not hasattr(vectorizer, "vocabulary_"):
+        # `train_incremental` で学習した `HashingVectorizer` は語彙を持たず、そのままでも共有できる
+        raise ValueError("Only vectorizers with a fitted vocabulary can be exported")
+
+    terms = list(vectorizer.vocabulary_.keys())
+    term_hashes = np.array([term_hash(term) for term in terms], dtype=np.uint64)
+
+    order = np.argsort(term_hashes, kind="stable")
+    sorted_term_hashes = term_hashes[order]
+    if np.any(sorted_term_hashes[1:] == sorted_term_hashes[:-1]):
+        raise ValueError("Hash collision detected in vocabulary")
+
+    # 特徴の並びをハッシュ値の順に並べ替え、係数の列もそれに合わせる
+    old_indices = np.array([vectorizer.vocabulary_[term] for term in terms])[order]
+    encoded_terms = [terms[i].encode() for i in order]
+    term_offsets = np.zeros(len(encoded_terms) + 1, dtype=np.int64)
+    term_offsets[1:] = np.cumsum([len(encoded) for encoded in encoded_terms])
+    term_blob = np.frombuffer(b"".join(encoded_terms), dtype=np.uint8)
+    coef = np.ascontiguousarray(model.coef_[:, old_indices])
+
+    export_dir.mkdir(parents=True, exist_ok=True)
+    np.save(export_dir / COEF_FILE_NAME, coef)
+    np.save(export_dir / TERM_HASHES_FILE_NAME, sorted_term_hashes)
+    np.save(export_dir / TERM_OFFSETS_FILE_NAME, term_offsets)
+    np.save(export_dir / TERM_BLOB_FILE_NAME, term_blob)
+
+    # 語彙と係数以外 (ハイパーパラメータや品詞フィルタなど) はそのまま joblib で保存する
+    model_skeleton = copy.copy(model)
+    model_skeleton.coef_ = None
+    vectorizer_skeleton = copy.copy(vectorizer)
+    vectorizer_skeleton.vocabulary_ = None
+    vectorizer_skeleton.stop_words_ = None
+
+    joblib.dump(model_skeleton, export_dir / MODEL_SKELETON_FILE_NAME)
+    joblib.dump(vectorizer_skeleton, export_dir / VECTORIZER_SKELETON_FILE_NAME)
+    joblib.dump(label_encoder, export_dir / LABEL_ENCODER_FILE_NAME)
+
+    # scikit-learn を使わずに推論する `predictor.engine` のため、
+    # 確率の計算方法やトークナイズの設定を JSON で書き出しておく
+    metadata = build_engine_metadata(model, label_encoder, vectorizer)
+    if metadata is None:
+        print("この vectorizer の設定は NumPy の推論エンジンでは扱えないため、metadata は書き出しません")
+    else:
+        np.save(export_dir / INTERCEPT_FILE_NAME, np.asarray(model.intercept_))
+        with open(export_dir / METADATA_FILE_NAME, "w") as wf:
+            json.dump(metadata, wf, ensure_ascii=False, indent=4)
+
+    print(f"Export shared model to {export_dir} (語彙数: {len(terms)})")
+
+
+def build_engine_metadata(model, label_encoder, vectorizer) -> Optional[Dict[str, Any]]:
+    # 単語の unigram を数える設定のみ、正規表現での分割と語彙の引き当てだけで再現できる
+    if (
+        vectorizer.analyzer != "word"
+        or tuple(vectorizer.ngram_range) != (1, 1)
+        or vectorizer.tokenizer is not None
+        or vectorizer.preprocessor is not None
+        or vectorizer.strip_accents is not None
+    ):
+        return None
+
+    if model.coef_.shape[0] == 1:
+        probability = "binary"
+    elif getattr(model, "multi_class", "auto") == "ovr" or (
+        getattr(model, "multi_class", "auto") == "auto"
+        and getattr(model, "solver", None) == "liblinear"
+    ):
+        probability = "ovr"
+    else:
+        probability = "softmax"
+
+    return dict(
+        labels=[
+            str(label) for label in label_encoder.inverse_transform(model.classes_)
+        ],
+        probability=probability,
+        token_pattern=vectorizer.token_pattern,
+        lowercase=bool(vectorizer.lowercase),
+        binary=bool(vectorizer.binary),
+        pos_filter=getattr(vectorizer, "pos_filter_", None),
+    )
+
+
+def load_shared_model_bundle(export_dir: pathlib.Path) -> Tuple:
+    """
+    `export_shared_model` で書き出したモデルを読み込み、(model, label_encoder, vectorizer) を返す。
+    語彙と係数は読み取り専用で `mmap` されるため、全ての worker で物理メモリが共有される
+    """
+    import joblib
+    import numpy as np
+
+    print(f"Load shared model from {export_dir}")
+
+    model = joblib.load(export_dir / MODEL_SKELETON_FILE_NAME)
+    model.coef_ = np.load(export_dir / COEF_FILE_NAME, mmap_mode="r")
+
+    vectorizer = joblib.load(export_dir / VECTORIZER_SKELETON_FILE_NAME)
+    vectorizer.vocabulary_ = MappedVocabulary(
+        term_hashes=np.load(export_dir / TERM_HASHES_FILE_NAME, mmap_mode="r"),
+        term_offsets=np.load(export_dir / TERM_OFFSETS_FILE_NAME, mmap_mode="r"),
+        term_blob=np.load(export_dir / TERM_BLOB_FILE_NAME, mmap_mode="r"),
+    )
+    vectorizer = MappedVocabularyVectorizer(vectorizer)
+
+    label_encoder = joblib.load(export_dir / LABEL_ENCODER_FILE_NAME)
+
+    return model, label_encoder, vectorizer
+
+
+def get_memory_usage(pid: int) -> Dict[str, int]:
+    """
+    `/proc/<pid>/smaps_rollup` からプロセスのメモリ使用量 (kB) を読み取る (Linux のみ)。
+    Pss は他のプロセスと共有しているページを共有しているプロセス数で割って数えた値
+    """
+    memory_usage = {}
+    with open(f"/proc/{pid}/smaps_rollup", "r") as rf:
+        for line in rf:
+            key, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                memory_usage[key] = int(value.split()[0])
+    return memory_usage
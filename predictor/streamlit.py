@@ -1,82 +1,80 @@
 import argparse
 import pathlib
 import sys
-from typing import Tuple
+from typing import Optional, Tuple
 
-import joblib
-import numpy as np
-import requests
 import streamlit as st
-import streamlit.components.v1 as components
-from bs4 import BeautifulSoup
-from lime.lime_text import LimeTextExplainer
-from natto import MeCab
-from sklearn.pipeline import make_pipeline
 
-from classifier.utils import tokenize_text
+from classifier.utils import create_tagger, tokenize_text
 from crawler.utils import scrape_article_content
+from newspaper_classifier.profiling import Profiler, add_profile_arguments
+from predictor.shared_model import load_shared_model_bundle
+from predictor.utils import (
+    CategoryPredictor,
+    build_engine_predictor,
+    build_sklearn_predictor,
+    load_label_encoder,
+    load_model,
+    load_vectorizer,
+)
 
 st.set_page_config(layout="wide")
 
-tagger = MeCab("-Owakati")
-tagger.parse("")
 
-
-def load_model(model_save_path: pathlib.Path):
-    print(f"Load model from {model_save_path}")
-    return joblib.load(model_save_path)
-
-
-def load_label_encoder(label_encoder_save_path: pathlib.Path):
-    print(f"Load label encoder from {label_encoder_save_path}")
-    return joblib.load(label_encoder_save_path)
-
-
-def load_vectorizer(vectorizer_save_path: pathlib.Path):
-    print(f"Load vectorizer from {vectorizer_save_path}")
-    return joblib.load(vectorizer_save_path)
+@st.cache_resource
+def get_tagger(pos_filter: Optional[Tuple[str, ...]]):
+    """
+    MeCab の tagger は初めて使うときに作成し、以降は再実行をまたいで使い回す
+    """
+    tagger = create_tagger(pos_filter)
+    tagger.parse("")
+    return tagger
 
 
 def get_article_content(url: str) -> str:
+    import requests
+    from bs4 import BeautifulSoup
+
     res = requests.get(url)
     soup = BeautifulSoup(res.text, "html.parser")
     return scrape_article_content(soup)
 
 
 def predict_category(
-    article_text, model, label_encoder, vectorizer
-) -> Tuple[int, str, float]:
-    tokenized_text = tokenize_text(tagger, article_text)
-
-    X = vectorizer.transform([tokenized_text]).todense()
-    X = np.array(X)
-
-    y_pred_probas = model.predict_proba(X)
-    y_pred = y_pred_probas.argmax()
+    article_text, predictor: CategoryPredictor
+) -> Tuple[str, int, str, float]:
+    """
+    分かち書きした本文と、予測したカテゴリの (番号, 名前, 確率) を返す
+    """
+    # `st.cache_resource` の引数はハッシュできる必要があるため tuple にする
+    pos_filter = (
+        tuple(predictor.pos_filter) if predictor.pos_filter is not None else None
+    )
+    tokenized_text = tokenize_text(get_tagger(pos_filter), article_text, pos_filter)
 
-    y_pred_label, *_ = label_encoder.inverse_transform([y_pred])
-    y_pred_proba = y_pred_probas[:, y_pred][0]
+    (y_pred_probas,) = predictor.predict_proba([tokenized_text])
+    y_pred = int(y_pred_probas.argmax())
+    y_pred_label = predictor.class_names[y_pred]
+    y_pred_proba = float(y_pred_probas[y_pred])
 
-    return y_pred, y_pred_label, y_pred_proba
+    return tokenized_text, y_pred, y_pred_label, y_pred_proba
 
 
 def apply_lime(
-    article_text,
-    model,
-    vectorizer,
-    label_encoder,
+    tokenized_text,
+    predictor: CategoryPredictor,
     y_pred,
 ):
-    tokenized_text = tokenize_text(tagger, article_text)
+    import streamlit.components.v1 as components
+    from lime.lime_text import LimeTextExplainer
 
-    pipe = make_pipeline(vectorizer, model)
     explainer = LimeTextExplainer(
-        class_names=label_encoder.classes_,
+        class_names=predictor.class_names,
     )
 
     exp = explainer.explain_instance(
         text_instance=tokenized_text,
-        classifier_fn=pipe.predict_proba,
+        classifier_fn=predictor.predict_proba,
         num_features=10,
         labels=[y_pred],
     )
@@ -84,15 +82,17 @@ def apply_lime(
     components.html(html, height=800)
 
 
-def run_streamlit(model, label_encoder, vectorizer):
+def run_streamlit(predictor: CategoryPredictor, profiler: Profiler):
     st.title("ニュース記事のカテゴリ予測くん🐶")
     url = st.text_input("記事 URL:", value="")
 
     if len(url) != 0:
-        article_text = get_article_content(url)
-        y_pred, y_pred_label, y_pred_proba = predict_category(
-            article_text, model, label_encoder, vectorizer
-        )
+        with profiler.stage("get_article_content"):
+            article_text = get_article_content(url)
+        with profiler.stage("predict_category"):
+            tokenized_text, y_pred, y_pred_label, y_pred_proba = predict_category(
+                article_text, predictor
+            )
 
         st.markdown(
             f"""
@@ -107,13 +107,12 @@ def run_streamlit(model, label_encoder, vectorizer):
 
         """
         )
-        apply_lime(
-            article_text=article_text,
-            model=model,
-            vectorizer=vectorizer,
-            label_encoder=label_encoder,
-            y_pred=y_pred,
-        )
+        with profiler.stage("apply_lime"):
+            apply_lime(
+                tokenized_text=tokenized_text,
+                predictor=predictor,
+                y_pred=y_pred,
+            )
 
 
 def parse_args() -> argparse.Namespace:
@@ -142,11 +141,36 @@ def parse_args() -> argparse.Namespace:
         / "vectorizers"
         / "count-vectorizer.joblib",
     )
+    parser.add_argument(
+        "--shared-model-dir",
+        type=pathlib.Path,
+        default=None,
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["sklearn", "numpy"],
+        default="sklearn",
+    )
+    add_profile_arguments(
+        parser,
+        default_dir=pathlib.Path(__file__).resolve().parents[1] / "data" / "profiles",
+    )
     return parser.parse_args(sys.argv[1:])
 
 
-def main():
-    args = parse_args()
+def load_predictor(args: argparse.Namespace) -> CategoryPredictor:
+    if args.engine == "numpy":
+        # scikit-learn を読み込まずに、NumPy のみで推論する
+        from predictor.engine import load_inference_engine
+
+        if args.shared_model_dir is None:
+            raise ValueError("--engine numpy requires --shared-model-dir")
+        return build_engine_predictor(load_inference_engine(args.shared_model_dir))
+
+    if args.shared_model_dir is not None:
+        # worker 間で語彙と係数を共有するモードでは、`mmap` で読み込む
+        return build_sklearn_predictor(*load_shared_model_bundle(args.shared_model_dir))
 
     model = load_model(
         model_save_path=args.model_save_path,
@@ -157,7 +181,23 @@ def main():
     vectorizer = load_vectorizer(
         vectorizer_save_path=args.vectorizer_save_path,
     )
-    run_streamlit(model, label_encoder, vectorizer)
+    return build_sklearn_predictor(model, label_encoder, vectorizer)
+
+
+def main():
+    args = parse_args()
+
+    # streamlit はユーザの操作ごとにこのスクリプトを再実行するため、再実行ごとに結果が保存される
+    profiler = Profiler(
+        mode=args.profile,
+        profile_dir=args.profile_dir,
+        name="predict",
+        interval=args.profile_interval,
+    )
+    with profiler:
+        with profiler.stage("load_model"):
+            predictor = load_predictor(args)
+        run_streamlit(predictor, profiler)
 
 
 if __name__ == "__main__":
@@ -1,3 +1,153 @@
-from django.test import TestCase
+import pathlib
+import random
+import tempfile
+from typing import Any, Dict, List, Tuple
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from predictor.engine import load_inference_engine
+from predictor.shared_model import (
+    MappedVocabularyVectorizer,
+    export_shared_model,
+    load_shared_model_bundle,
+)
+
+
+class MappedVocabularyVectorizerTest(SimpleTestCase):
+    documents = [
+        "政治 法律 成立 法律 首相",
+        "野球 試合 勝利 試合 試合",
+        "法律 試合 語彙にない単語 株価",
+        "",
+    ]
+
+    def setUp(self) -> None:
+        from sklearn.feature_extraction.text import CountVectorizer
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.preprocessing import LabelEncoder
+
+        self.vectorizer = CountVectorizer()
+        X = self.vectorizer.fit_transform(self.documents[:2] + ["株価 上昇"])
+        label_encoder = LabelEncoder().fit(["政治", "スポーツ", "経済"])
+        model = LogisticRegression().fit(X, [0, 1, 2])
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        export_dir = pathlib.Path(tmp_dir.name)
+        export_shared_model(model, label_encoder, self.vectorizer, export_dir)
+        *_, self.mapped_vectorizer = load_shared_model_bundle(export_dir)
+
+    def test_transform_matches_count_vectorizer(self):
+        self.assertIsInstance(self.mapped_vectorizer, MappedVocabularyVectorizer)
+        vocabulary = self.mapped_vectorizer.vocabulary_
+
+        for binary in [False, True]:
+            self.vectorizer.binary = binary
+            self.mapped_vectorizer.vectorizer.binary = binary
+            expected = self.vectorizer.transform(self.documents).toarray()
+            actual = self.mapped_vectorizer.transform(self.documents).toarray()
+
+            # 書き出したモデルでは特徴がハッシュ値の順に並び替えられている
+            for term, index in self.vectorizer.vocabulary_.items():
+                self.assertEqual(
+                    actual[:, vocabulary[term]].tolist(), expected[:, index].tolist()
+                )
+            self.assertEqual(actual.shape, expected.shape)
+            self.assertEqual(actual.sum(), expected.sum())
+
+    def test_lookup_many(self):
+        vocabulary = self.mapped_vectorizer.vocabulary_
+        indices = vocabulary.lookup_many(["法律", "語彙にない単語", "試合"])
+
+        self.assertEqual(indices.tolist(), [vocabulary["法律"], -1, vocabulary["試合"]])
+        self.assertNotIn("語彙にない単語", vocabulary)
+        self.assertEqual(vocabulary.lookup_many([]).tolist(), [])
+
+
+class InferenceEngineTest(SimpleTestCase):
+    category_words = {
+        "政治": ["選挙", "国会", "首相", "法案", "与党", "野党", "内閣", "議員"],
+        "スポーツ": ["試合", "選手", "優勝", "監督", "得点", "球団", "大会", "記録"],
+        "経済": ["株価", "円安", "金利", "企業", "決算", "投資", "物価", "市場"],
+    }
+    common_words = ["東京", "今日", "発表", "Tokyo", "NEWS", "a", "x1"]
+    test_documents = [
+        "選挙 選挙 選挙 首相 東京",
+        "試合 語彙にない単語 NEWS tokyo",
+        "株価-金利 (円安) 決算、投資",
+        "",
+        "語彙にない単語 だけ",
+    ]
+
+    def build_dataset(self, categories: List[str]) -> Tuple[List[str], List[str]]:
+        rng = random.Random(0)
+        documents: List[str] = []
+        labels: List[str] = []
+        for category in categories:
+            for _ in range(20):
+                words = rng.choices(self.category_words[category], k=8)
+                words += rng.choices(self.common_words, k=4)
+                # 1 つの記事にしか現れない単語。`min_df` で語彙から除かれる
+                words.append(f"固有名詞{len(documents)}")
+                documents.append(" ".join(words))
+                labels.append(category)
+        return documents, labels
+
+    def assert_engine_matches_sklearn(
+        self,
+        categories: List[str],
+        vectorizer_params: Dict[str, Any],
+        model_params: Dict[str, Any],
+    ) -> None:
+        import numpy as np
+        from sklearn.feature_extraction.text import CountVectorizer
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.preprocessing import LabelEncoder
+
+        documents, labels = self.build_dataset(categories)
+        vectorizer = CountVectorizer(**vectorizer_params)
+        label_encoder = LabelEncoder().fit(labels)
+        model = LogisticRegression(**model_params).fit(
+            vectorizer.fit_transform(documents), label_encoder.transform(labels)
+        )
+
+        with tempfile.TemporaryDirectory() as export_dir:
+            export_shared_model(
+                model, label_encoder, vectorizer, export_dir=pathlib.Path(export_dir)
+            )
+            engine = load_inference_engine(pathlib.Path(export_dir))
+
+        for tokenized_texts in [
+            self.test_documents,
+            documents,
+            self.test_documents[:1],
+        ]:
+            expected = model.predict_proba(vectorizer.transform(tokenized_texts))
+            actual = engine.predict_proba(tokenized_texts)
+            self.assertEqual(actual.shape, expected.shape)
+            self.assertTrue(np.allclose(actual, expected), (actual, expected))
+
+        self.assertEqual(
+            engine.labels, list(label_encoder.inverse_transform(model.classes_))
+        )
+
+    def test_binary(self):
+        self.assert_engine_matches_sklearn(["政治", "スポーツ"], {}, {})
+
+    def test_multiclass(self):
+        self.assert_engine_matches_sklearn(["政治", "スポーツ", "経済"], {}, {})
+
+    def test_min_df(self):
+        self.assert_engine_matches_sklearn(
+            ["政治", "スポーツ", "経済"], dict(min_df=3, max_df=0.9), {}
+        )
+
+    def test_binary_counts_and_case(self):
+        self.assert_engine_matches_sklearn(
+            ["政治", "スポーツ", "経済"], dict(binary=True, lowercase=False), {}
+        )
+
+    def test_custom_token_pattern(self):
+        self.assert_engine_matches_sklearn(
+            ["政治", "スポーツ", "経済"], dict(token_pattern=r"(?u)\b\w+\b"), {}
+        )
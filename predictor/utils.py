@@ -0,0 +1,80 @@
+import pathlib
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+
+@dataclass
+class CategoryPredictor(object):
+    """
+    scikit-learn のモデルと NumPy のみの推論エンジン (`predictor.engine`) を同じように扱うためのもの
+
+    - predict_proba: 分かち書きした本文のリストから、各カテゴリの確率の行列を返す関数
+    - class_names: predict_proba の各列に対応するカテゴリ名
+    - pos_filter: 学習時に用いた品詞フィルタ
+    """
+
+    predict_proba: Callable[[Sequence[str]], Any]
+    class_names: List[str]
+    pos_filter: Optional[Sequence[str]]
+
+
+def load_model(model_save_path: pathlib.Path):
+    import joblib
+
+    print(f"Load model from {model_save_path}")
+    return joblib.load(model_save_path)
+
+
+def load_label_encoder(label_encoder_save_path: pathlib.Path):
+    import joblib
+
+    print(f"Load label encoder from {label_encoder_save_path}")
+    return joblib.load(label_encoder_save_path)
+
+
+def load_vectorizer(vectorizer_save_path: pathlib.Path):
+    import joblib
+
+    print(f"Load vectorizer from {vectorizer_save_path}")
+    return joblib.load(vectorizer_save_path)
+
+
+def get_pos_filter(vectorizer):
+    # 学習時に品詞フィルタを用いていた場合は推論時も同じ品詞のみを残す
+    return getattr(vectorizer, "pos_filter_", None)
+
+
+def predict_tokenized_category(
+    tokenized_text: str, model, label_encoder, vectorizer
+) -> Tuple[int, str, float]:
+    import numpy as np
+
+    X = vectorizer.transform([tokenized_text]).todense()
+    X = np.array(X)
+
+    y_pred_probas = model.predict_proba(X)
+    y_pred = y_pred_probas.argmax()
+
+    y_pred_label, *_ = label_encoder.inverse_transform([y_pred])
+    y_pred_proba = y_pred_probas[:, y_pred][0]
+
+    return y_pred, y_pred_label, y_pred_proba
+
+
+def build_sklearn_predictor(model, label_encoder, vectorizer) -> CategoryPredictor:
+    def predict_proba(tokenized_texts: Sequence[str]):
+        return model.predict_proba(vectorizer.transform(tokenized_texts))
+
+    return CategoryPredictor(
+        predict_proba=predict_proba,
+        class_names=list(label_encoder.inverse_transform(model.classes_)),
+        pos_filter=get_pos_filter(vectorizer),
+    )
+
+
+def build_engine_predictor(engine) -> CategoryPredictor:
+    return CategoryPredictor(
+        predict_proba=engine.predict_proba,
+        class_names=engine.labels,
+        pos_filter=engine.pos_filter,
+    )